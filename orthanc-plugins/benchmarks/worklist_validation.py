@@ -0,0 +1,51 @@
+"""
+Microbenchmark of worklist validation, run outside of orthanc:
+
+    python benchmarks/worklist_validation.py [count]
+
+curapacs_python.config reads the orthanc configuration at import time, so the orthanc module
+is replaced by a stub answering a minimal configuration.
+"""
+import os
+import sys
+import json
+import types
+import timeit
+
+orthanc_stub = types.ModuleType("orthanc")
+orthanc_stub.GetConfiguration = lambda: json.dumps({"RegisteredUsers": {"orthanc": "orthanc"},
+                                                     "Curapacs": {"LOG_LEVEL": "WARNING"}})
+sys.modules.setdefault("orthanc", orthanc_stub)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from curapacs_python.OrthancMWLCreator import Worklist
+
+
+def validate_with_ruleset_scan(json):
+    """validation as done before the ruleset was compiled, for comparison"""
+    worklist = Worklist()
+    for key, value in Worklist.flattenIterable(json):
+        for rule in Worklist.ruleset:
+            if key in rule.keys():
+                worklist.check_value(key, value, rule[key], **rule["constraints"])
+                break
+    worklist.json = json
+    worklist.check_required_tags()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sample_worklist = {"PatientID": "4711", "PatientName": "Doe^John", "PatientBirthDate": "19700101",
+                       "PatientSex": "M", "AccessionNumber": "A1234", "RequestedProcedureDescription": "CT Thorax",
+                       "ScheduledProcedureStepSequence": [{"Modality": "CT", "ScheduledStationAETitle": "CT01",
+                                                           "ScheduledProcedureStepStartDate": "20240101",
+                                                           "ScheduledProcedureStepStartTime": "083000",
+                                                           "ScheduledPerformingPhysicianName": "Smith^Anna"}]}
+    sample_worklists = [sample_worklist] * count
+    timings = {
+        "ruleset scan": timeit.timeit(lambda: [validate_with_ruleset_scan(item) for item in sample_worklists], number=1),
+        "validate": timeit.timeit(lambda: [Worklist().validate(item) for item in sample_worklists], number=1),
+        "validate_many": timeit.timeit(lambda: Worklist.validate_many(sample_worklists), number=1),
+    }
+    for name, duration in timings.items():
+        print(f"{name:>14}: {duration / count * 1e6:8.2f} us per worklist ({count} worklists)")
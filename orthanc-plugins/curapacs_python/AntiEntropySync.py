@@ -0,0 +1,137 @@
+import time
+import sqlite3
+import threading
+import requests
+from curapacs_python import config
+from curapacs_python.helpers import post_data
+
+
+class AntiEntropySync:
+    """
+    Compares the digest tree of the local PresenceIndex with the one of the remote orthanc
+    (served by its /curapacs/digests) top-down, level by level, and only descends into
+    resources whose digests differ, so a run costs in proportion to the difference.
+
+    Resources the remote orthanc lacks are handed to push_function, instances of series held
+    by both sides but missing locally to pull_function. Studies and series held only by the
+    remote orthanc are left alone, a site keeps just part of the archive of its parent: above
+    the series level, the remote orthanc computes its digests over the children held locally only.
+
+    :param push_function: callable taking a list of local instance IDs to upload
+    :param pull_function: callable taking a list of remote instance IDs to fetch, returns the failed ones
+    """
+
+    def __init__(self, presence_index, remote_orthanc, push_function, pull_function,
+                 interval=config.ANTI_ENTROPY_INTERVAL, batch_size=config.ANTI_ENTROPY_BATCH_SIZE):
+        self.presence_index = presence_index
+        self.remote_orthanc = remote_orthanc
+        self.push_function = push_function
+        self.pull_function = pull_function
+        self.interval = interval
+        self.batch_size = batch_size
+        self._run_requested = threading.Event()
+        self._worker = None
+        self.runs = 0
+        self.last_run = None
+        self.last_result = None
+
+    def getRemoteDigestNodes(self, local_nodes):
+        """
+        :param local_nodes: dict of resource ID -> local digest node
+        :returns: dict of resource ID -> digest node (see PresenceIndex.getDigestNode), None if not held remotely
+        """
+        child_ids = {resource_id: list(local_node["Children"]) for resource_id, local_node in local_nodes.items()
+                     if local_node["Level"] != "series"}
+        content, _ = self.remote_orthanc.requestData(post_data, f"{self.remote_orthanc.url}/curapacs/digests",
+                                                     {"IDs": list(local_nodes), "ChildIDs": child_ids})
+        if not isinstance(content, dict):
+            raise ValueError(f"Unexpected answer to digest query: {content}")
+        return content
+
+    def synchronize(self):
+        """
+        Run one comparison and repair what differs.
+
+        :returns: dict with the number of resources compared, instances pushed and pulled
+        """
+        result = {"Compared": 0, "Differing": 0, "Pushed": 0, "Pulled": 0, "FailedPulls": 0}
+        start_time = time.time()
+        pending_ids = list(self.presence_index.getDigestNode()["Children"])
+        while pending_ids:
+            batch, pending_ids = pending_ids[:self.batch_size], pending_ids[self.batch_size:]
+            local_nodes = {resource_id: self.presence_index.getDigestNode(resource_id) for resource_id in batch}
+            # resources deleted meanwhile
+            local_nodes = {resource_id: local_node for resource_id, local_node in local_nodes.items()
+                           if local_node is not None}
+            if not local_nodes:
+                continue
+            remote_nodes = self.getRemoteDigestNodes(local_nodes)
+            for resource_id, local_node in local_nodes.items():
+                result["Compared"] += 1
+                remote_node = remote_nodes.get(resource_id)
+                if remote_node is None:
+                    result["Pushed"] += self.push(resource_id)
+                    continue
+                if remote_node["Digest"] == local_node["Digest"]:
+                    continue
+                result["Differing"] += 1
+                for child_id, child_digest in local_node["Children"].items():
+                    remote_child_digest = remote_node["Children"].get(child_id)
+                    if remote_child_digest is None:
+                        result["Pushed"] += self.push(child_id)
+                    elif remote_child_digest != child_digest:
+                        pending_ids.append(child_id)
+                if local_node["Level"] == "series":
+                    missing_instance_ids = [child_id for child_id in remote_node["Children"]
+                                            if child_id not in local_node["Children"]]
+                    if missing_instance_ids:
+                        failed_instance_ids = self.pull_function(missing_instance_ids)
+                        result["Pulled"] += len(missing_instance_ids) - len(failed_instance_ids)
+                        result["FailedPulls"] += len(failed_instance_ids)
+        result["Duration"] = time.time() - start_time
+        config.LOGGER.info(f"Anti-entropy run compared {result['Compared']} resources, " + \
+                           f"pushed {result['Pushed']} and pulled {result['Pulled']} instances.")
+        return result
+
+    def push(self, resource_id: str):
+        """
+        :returns: number of instances handed to push_function
+        """
+        instance_ids = self.presence_index.getInstanceIDs(resource_id)
+        if instance_ids:
+            self.push_function(instance_ids)
+        return len(instance_ids)
+
+    def requestRun(self):
+        """
+        Start a run right away, e.g. once the remote orthanc is reachable again after an outage.
+        """
+        self._run_requested.set()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self.run, name="curapacs-anti-entropy", daemon=True)
+            self._worker.start()
+
+    def run(self):
+        while True:
+            self._run_requested.wait(timeout=self.interval)
+            self._run_requested.clear()
+            try:
+                if not self.presence_index.is_ready:
+                    continue
+                self.last_result = self.synchronize()
+            except (requests.RequestException, ValueError, KeyError, sqlite3.Error) as error:
+                config.LOGGER.error(f"Anti-entropy run against {self.remote_orthanc.url} failed: {error}")
+                continue
+            self.runs += 1
+            self.last_run = time.time()
+
+    def getStatistics(self):
+        """
+        :returns: dict describing the last run, as served by the REST API
+        """
+        return {"Runs": self.runs,
+                "Interval": self.interval,
+                "LastRun": self.last_run,
+                "LastResult": self.last_result}
@@ -0,0 +1,112 @@
+import time
+import threading
+import requests
+from curapacs_python import config
+from curapacs_python.helpers import get_data
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised instead of contacting a host whose circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an unreachable host. After failure_threshold consecutive connection
+    failures the circuit opens and every call fails immediately with CircuitOpenError.
+    While open, a background thread probes probe_url every probe_interval seconds and
+    closes the circuit again once the host answers, then calls on_close if given.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+
+    def __init__(self, name, probe_url, session=None, failure_threshold=config.PEER_FAILURE_THRESHOLD,
+                 probe_interval=config.PEER_PROBE_INTERVAL, on_close=None):
+        self.name = name
+        self.probe_url = probe_url
+        self.session = session
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.on_close = on_close
+        self.state = CircuitBreaker.CLOSED
+        self.consecutive_failures = 0
+        self.rejected_calls = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.state == CircuitBreaker.OPEN
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call function unless the circuit is open. Connection errors and timeouts count as
+        failures, errors carrying an HTTP response do not, since the host did answer.
+        get_data is called without retries unless they are asked for, the breaker takes over
+        from the retry loop and every failed attempt would cost a timeout and a backoff.
+
+        :raises CircuitOpenError: circuit is open, function was not called
+        """
+        if self.is_open:
+            with self._lock:
+                self.rejected_calls += 1
+            raise CircuitOpenError(f"Circuit for {self.name} is open, not calling {self.probe_url}")
+        if function is get_data:
+            kwargs.setdefault("retries", 0)
+        try:
+            result = function(*args, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if error.response is None:
+                self.recordFailure()
+            raise
+        self.recordSuccess()
+        return result
+
+    def recordSuccess(self):
+        with self._lock:
+            self.consecutive_failures = 0
+
+    def recordFailure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.is_open or self.consecutive_failures < self.failure_threshold:
+                return
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.time()
+        config.LOGGER.warning(f"{self.consecutive_failures} consecutive failures contacting {self.name}, " + \
+                              f"circuit opened.")
+        probe_thread = threading.Thread(target=self.probeUntilClosed, name=f"curapacs-probe-{self.name}",
+                                        daemon=True)
+        probe_thread.start()
+
+    def probeUntilClosed(self):
+        """
+        Probe the host until it answers, then close the circuit.
+        """
+        while self.is_open:
+            time.sleep(self.probe_interval)
+            try:
+                get_data(self.probe_url, session=self.session, retries=0)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if error.response is None:
+                    config.LOGGER.debug(f"Probe of {self.probe_url} failed, circuit stays open.")
+                    continue
+            with self._lock:
+                self.state = CircuitBreaker.CLOSED
+                self.consecutive_failures = 0
+                self.opened_at = None
+            config.LOGGER.info(f"{self.name} answered probe, circuit closed.")
+            if self.on_close is not None:
+                self.on_close()
+
+    def getStatus(self):
+        """
+        :returns: dict describing the circuit, as served by the REST API
+        """
+        return {"Name": self.name,
+                "State": self.state,
+                "ConsecutiveFailures": self.consecutive_failures,
+                "FailureThreshold": self.failure_threshold,
+                "RejectedCalls": self.rejected_calls,
+                "OpenedAt": self.opened_at}
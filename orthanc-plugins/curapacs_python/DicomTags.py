@@ -0,0 +1,90 @@
+from pydicom.datadict import DicomDictionary, keyword_for_tag
+
+
+class DicomTags:
+    """
+    Translation between the forms a DICOM tag takes in this plugin: orthanc style "0008,0052",
+    dicom json style "00080052" and keyword "QueryRetrieveLevel". The tables are built once from
+    the pydicom dictionary, so a translation is a dict lookup. Tags are written in lowercase
+    hex, like orthanc does, lookups accept either case.
+    """
+    # keyword -> "0008,0052"
+    orthanc_tag_by_keyword = {}
+    # keyword -> "00080052"
+    json_tag_by_keyword = {}
+    # "0008,0052", "00080052" (lower and upper case) -> keyword
+    keyword_by_tag = {}
+
+    @classmethod
+    def build(cls):
+        for tag, entry in DicomDictionary.items():
+            keyword = entry[4]
+            if not keyword:
+                continue
+            json_tag = f"{tag:08x}"
+            orthanc_tag = f"{json_tag[:4]},{json_tag[4:]}"
+            cls.orthanc_tag_by_keyword[keyword] = orthanc_tag
+            cls.json_tag_by_keyword[keyword] = json_tag
+            for key in (orthanc_tag, json_tag, orthanc_tag.upper(), json_tag.upper()):
+                cls.keyword_by_tag[key] = keyword
+
+    @staticmethod
+    def parseTag(tag: str):
+        """
+        :param tag: tag as "0008,0052" or "00080052"
+        :returns: tag as int
+        :raises ValueError: if tag is malformed
+        """
+        return int(tag.replace(",", ""), 16)
+
+    @staticmethod
+    def getKeyword(tag: str):
+        """
+        :param tag: tag as "0008,0052" or "00080052", in any case
+        :returns: keyword of tag, None for private or unknown tags
+        :raises ValueError: if tag is malformed
+        """
+        keyword = DicomTags.keyword_by_tag.get(tag)
+        if keyword is None:
+            # repeating groups (e.g. 50xx,xxxx) are not part of the table
+            keyword = keyword_for_tag(DicomTags.parseTag(tag)) or None
+        return keyword
+
+    @staticmethod
+    def getOrthancTag(keyword: str):
+        """
+        :returns: tag of keyword as "0008,0052", None for unknown keywords
+        """
+        return DicomTags.orthanc_tag_by_keyword.get(keyword)
+
+    @staticmethod
+    def getJsonTag(keyword: str):
+        """
+        :returns: tag of keyword as "00080052", None for unknown keywords
+        """
+        return DicomTags.json_tag_by_keyword.get(keyword)
+
+    @staticmethod
+    def replaceTagsWithKeywords(dataset_json: dict):
+        """
+        Build a copy of a dicom json dataset ({"00100010": {"vr": "PN", "Value": [...]}, ...}) keyed by
+        keywords, descending into sequences of any depth. Elements without sequence are shared with
+        dataset_json instead of being copied, private and unknown tags keep their tag as key.
+
+        :returns: dicom json dict keyed by keywords
+        """
+        keyword_dataset = {}
+        for tag, element in dataset_json.items():
+            try:
+                keyword = DicomTags.getKeyword(tag) or tag
+            except ValueError:
+                keyword = tag
+            values = element.get("Value") if isinstance(element, dict) else None
+            if values and isinstance(values[0], dict) and element.get("vr") == "SQ":
+                element = dict(element)
+                element["Value"] = [DicomTags.replaceTagsWithKeywords(item) for item in values]
+            keyword_dataset[keyword] = element
+        return keyword_dataset
+
+
+DicomTags.build()
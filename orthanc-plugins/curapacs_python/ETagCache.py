@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+from curapacs_python import config
+
+
+class ETagCache:
+    """
+    Thread safe, size bounded LRU cache of the last answer and ETag of GET requests, keyed by URL.
+    The ETag is sent back as If-None-Match, a "304 Not Modified" answer is served from the cache.
+    """
+
+    def __init__(self, max_size=config.ETAG_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, url: str):
+        """
+        :returns: tuple (etag, content) of the last answer to url, None if unknown
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url: str, etag: str, content):
+        """
+        Remember content answered with etag for url, evicting the least recently used entries beyond max_size.
+        """
+        with self._lock:
+            self._entries[url] = (etag, content)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, url: str):
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def recordHit(self):
+        with self._lock:
+            self.hits += 1
+
+    def recordMiss(self):
+        with self._lock:
+            self.misses += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def getStatistics(self):
+        """
+        :returns: dict of cache counters, as served by the REST API
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {"Size": len(self._entries),
+                    "MaxSize": self.max_size,
+                    "Hits": self.hits,
+                    "Misses": self.misses,
+                    "HitRatio": self.hits / requests if requests else 0,
+                    "Evictions": self.evictions}
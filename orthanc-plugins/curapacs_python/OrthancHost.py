@@ -1,8 +1,16 @@
 import json
+import zlib
+import struct
+import itertools
+import threading
 import requests
-from pydicom.datadict import keyword_for_tag, tag_for_keyword
-from curapacs_python.helpers import get_data, post_data
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from curapacs_python.helpers import get_data, post_data, get_session, open_file_stream
 from curapacs_python import config
+from curapacs_python.DicomTags import DicomTags
+from curapacs_python.ETagCache import ETagCache
+from curapacs_python.ResourceCache import ResourceCache
 
 
 
@@ -21,86 +29,324 @@ class OrthancHost:
         "instance":["SOPInstanceUID", "InstanceNumber"]
     }
 
-    def __init__(self, url, http_user=None, http_password=None, find_limit=25):
+    # REST API path of each resource level, ordered from top to bottom of the hierarchy
+    subpaths_for_retrieve_level = {
+        "patient": "patients",
+        "study": "studies",
+        "series": "series",
+        "instance": "instances"
+    }
+
+    # transfer compression negotiated per remote orthanc by openInstanceFile
+    transfer_modes = {}
+    transfer_statistics = {"Instances": 0, "BytesReceived": 0, "BytesDecompressed": 0, "Failures": 0,
+                           "StoreFailures": 0}
+    transfer_statistics_lock = threading.Lock()
+
+    # metadata of stable resources, shared by all hosts and plugin callbacks
+    resource_cache = ResourceCache()
+    # last answers to GET requests carrying an ETag, revalidated with If-None-Match
+    etag_cache = ETagCache()
+
+    def __init__(self, url, http_user=None, http_password=None, find_limit=config.FIND_PAGE_SIZE,
+                 descent_mode=config.SUBRESOURCE_DESCENT, circuit_breaker=None):
         self.url = url
         self.http_user = http_user
         self.http_password = http_password
         self.find_limit = find_limit
+        self.descent_mode = descent_mode
+        self.session = get_session(url, http_user, http_password)
+        self.circuit_breaker = circuit_breaker
+        # only changes of the local orthanc invalidate cached resources
+        if urlsplit(url).hostname in ("localhost", "127.0.0.1", "::1"):
+            self.resource_cache_ttl = config.RESOURCE_CACHE_TTL
+        else:
+            self.resource_cache_ttl = config.RESOURCE_CACHE_REMOTE_TTL
+
+    def requestData(self, request_function, url, *args, **kwargs):
+        """
+        Calls get_data, post_data or open_file_stream with the session of this host, going through
+        circuit_breaker if one is set. Plain GET requests are made conditional
+        on the ETag of the previous answer, see requestConditionally.
+        """
+        kwargs.setdefault("session", self.session)
+        if request_function is get_data and not args and "headers" not in kwargs and OrthancHost.etag_cache.enabled:
+            return self.requestConditionally(url, **kwargs)
+        if self.circuit_breaker is None:
+            return request_function(url, *args, **kwargs)
+        return self.circuit_breaker.call(request_function, url, *args, **kwargs)
+
+    def requestConditionally(self, url, **kwargs):
+        """
+        GET url with If-None-Match set to the ETag orthanc sent with its previous answer.
+        On "304 Not Modified" the previous answer is returned from etag_cache.
+
+        :returns: tuple of content and headers, like get_data
+        """
+        cached_answer = OrthancHost.etag_cache.get(url)
+        headers = {"If-None-Match": cached_answer[0]} if cached_answer else {}
+        if self.circuit_breaker is None:
+            content, response_headers = get_data(url, headers=headers, **kwargs)
+        else:
+            content, response_headers = self.circuit_breaker.call(get_data, url, headers=headers, **kwargs)
+        if content is None and cached_answer:
+            OrthancHost.etag_cache.recordHit()
+            return cached_answer[1], response_headers
+        OrthancHost.etag_cache.recordMiss()
+        etag = response_headers.get("ETag")
+        if etag:
+            OrthancHost.etag_cache.put(url, etag, content)
+        elif cached_answer:
+            OrthancHost.etag_cache.discard(url)
+        return content, response_headers
 
     def getOrthancResource(self, resource_type, resource_id):
         """
         Given the Orthanc ID of a resource (Study/Series), return a resource dict
-        containing metadata (including child resources) of resource
-        
+        containing metadata (including child resources) of resource.
+        Instances and stable resources are answered from resource_cache once fetched.
+
         :param resource_type: "Study" or "Series"
         :param resource_id: Orthanc ID of resource
         :returns: dict containing metadata (including IDs of child resources) of resource
         """
         config.LOGGER.debug(f"getOrthancResource called with args: resource_type: {resource_type}, " + \
                     f"resource_id: {resource_id}, orthanc_uri: {self.url}")
-        if resource_type.lower() == "patient":
-            query_subpath = "patients"
-        elif resource_type.lower() == "study":
-            query_subpath = "studies"
-        elif resource_type.lower() == "series":
-            query_subpath = "series"
-        elif resource_type.lower() == "instance":
-            query_subpath = "instances"
-        else:
+        try:
+            query_subpath = OrthancHost.subpaths_for_retrieve_level[resource_type.lower()]
+        except KeyError:
             raise ValueError(f"Unknown resource type requested ({resource_type})")
+        cache_key = ResourceCache.getKey(self.url, resource_type, resource_id)
+        content = OrthancHost.resource_cache.get(cache_key)
+        if content is not None:
+            return (content, {})
         try:
-            content, headers = get_data(f"{self.url}/{query_subpath}/{resource_id}")
+            content, headers = self.requestData(get_data, f"{self.url}/{query_subpath}/{resource_id}")
         except (requests.ConnectionError, requests.ConnectTimeout):
             config.LOGGER.error(f"Orthanc failed to respond to resource query.")
-            content, headers = {}, {}
+            return ({}, {})
+        if isinstance(content, dict):
+            OrthancHost.resource_cache.put(cache_key, content, self.resource_cache_ttl)
         return (content, headers)
 
     def getMainDicomTagsForOrthancResource(self, resource):
         """
         Given a resource dict grabbed from orthanc, returns a dict of its tags (numeric)
-        & values describing the resource
+        & values describing the resource. resource itself is left unchanged, it may be cached.
         """
         try:
             main_dicom_tags_dict = resource["MainDicomTags"]
         except KeyError:
             config.LOGGER.error(f"Resource did not contain MainDicomTags: {resource}")
-        for keyword in resource["MainDicomTags"].keys():
-            numeric_tag = keyword_for_tag(keyword)
-            main_dicom_tags_dict[numeric_tag] = main_dicom_tags_dict.pop(keyword)
-        return main_dicom_tags_dict
+            raise
+        return {DicomTags.getOrthancTag(keyword) or keyword: value for keyword, value in main_dicom_tags_dict.items()}
         
-    def getOrthancInstances(self):
+    def fetchOrthancInstance(self, instance_id: str, remote_orthanc):
         """
-        Ask remote orthanc API for a complete list of all available instance IDs.
+        Download DICOM Data of instance with instance_id to local orthanc.
+        The file is relayed in chunks of config.RELAY_CHUNK_SIZE bytes from the download
+        into the upload, it is never held in memory as a whole.
 
-        :param orthanc_uri: URI (https://sample.orthanc.org:8080) 
+        :param instance_id: Orthanc instance id string
+        :param remote_orthanc: OrthancHost to fetch instances from
         """
-        instance_list, _ = get_data(f"{self.url}/instances")
-        config.LOGGER.debug(f"local_instances are {instance_list}")
-        return instance_list
+        config.LOGGER.debug(f"Fetching instance {instance_id} from {remote_orthanc.url}")
+        response, file_chunks = self.openInstanceFile(instance_id, remote_orthanc)
+        try:
+            self.requestData(post_data, f"{self.url}/instances", file_chunks, is_json=False)
+        except requests.HTTPError:
+            OrthancHost.countTransfer("StoreFailures")
+            raise
+        finally:
+            # the generator closes the download once exhausted, not if the upload failed before reading it
+            response.close()
 
-    def fetchOrthancInstance(self, instance_id: str, remote_orthanc_uri: str):
+    def fetchOrthancInstances(self, instance_ids, remote_orthanc, parallelism=config.FETCH_PARALLELISM):
         """
-        Download DICOM Data of instance with instance_id to local orthanc.
+        Download DICOM Data of many instances to local orthanc, relaying up to parallelism
+        instances at the same time.
+
+        :param instance_ids: iterable of Orthanc instance id strings
+        :param remote_orthanc: OrthancHost to fetch instances from
+        :returns: list of instance ids that failed to be fetched
+        """
+        def fetch(instance_id):
+            try:
+                self.fetchOrthancInstance(instance_id, remote_orthanc)
+            except (requests.RequestException, ValueError, zlib.error) as error:
+                config.LOGGER.error(f"Failed to fetch instance {instance_id} from {remote_orthanc.url}: {error}")
+                OrthancHost.countTransfer("Failures")
+                return instance_id
+            return None
+
+        with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="curapacs-fetch") as executor:
+            return [instance_id for instance_id in executor.map(fetch, instance_ids) if instance_id is not None]
+
+    def openInstanceFile(self, instance_id: str, remote_orthanc, compression=config.TRANSFER_COMPRESSION):
+        """
+        Start downloading the DICOM file of an instance, compressed for the transfer if possible.
+        "attachment" fetches the attachment as stored by a remote orthanc with StorageCompression,
+        "gzip" asks for a gzip encoded answer, "none" downloads the file as is.
+        "auto" starts with "attachment" and remembers the first mode the remote orthanc supports.
+        Orthanc stores compressed attachments as zlib stream prefixed by the uncompressed
+        size (uint64, little endian); uncompressed attachments are the plain DICOM file.
+        Downloads use the session and circuit breaker of remote_orthanc.
 
         :param instance_id: Orthanc instance id string
-        :param remote_orthanc_uri: URI (https://sample.orthanc.org:8080) to fetch instances from
-        :param local_orthanc_uri: URI of the instance running this plugin
+        :param remote_orthanc: OrthancHost to fetch instances from
+        :param compression: one of "auto", "attachment", "gzip", "none"
+        :returns: tuple of the streamed response and a generator of chunks of the decompressed
+                  DICOM file, which closes the response once exhausted
+        """
+        remote_orthanc_uri = remote_orthanc.url
+        mode = compression
+        if compression == "auto":
+            mode = OrthancHost.transfer_modes.get(remote_orthanc_uri, "auto")
+        if mode in ("auto", "attachment"):
+            attachment_url = f"{remote_orthanc_uri}/instances/{instance_id}/attachments/dicom/compressed-data"
+            try:
+                response = remote_orthanc.requestData(open_file_stream, attachment_url, accept_gzip=False)
+            except requests.ConnectionError as error:
+                if error.response is None:
+                    raise
+                config.LOGGER.warning(f"Compressed attachment of {instance_id} not available from " + \
+                                      f"{remote_orthanc_uri}, falling back to gzip.")
+                if mode == "auto":
+                    OrthancHost.transfer_modes[remote_orthanc_uri] = "gzip"
+            else:
+                header = response.raw.read(132)
+                is_compressed = header[128:132] != b"DICM"
+                if mode == "auto":
+                    OrthancHost.transfer_modes[remote_orthanc_uri] = "attachment" if is_compressed else "gzip"
+                if not is_compressed:
+                    return response, OrthancHost.iterFileChunks(response, header)
+                uncompressed_size, = struct.unpack("<Q", header[:8])
+                return response, OrthancHost.iterFileChunks(response, header[8:], zlib.decompressobj(),
+                                                            uncompressed_size)
+        response = remote_orthanc.requestData(open_file_stream, f"{remote_orthanc_uri}/instances/{instance_id}/file",
+                                              accept_gzip=mode != "none")
+        return response, OrthancHost.iterFileChunks(response)
+
+    @staticmethod
+    def iterFileChunks(response, first_chunk=b"", decompressor=None, expected_size=None,
+                       chunk_size=config.RELAY_CHUNK_SIZE):
+        """
+        Generator over the body of a streamed response in chunks of at most chunk_size bytes,
+        decoding gzip content encoding and, if a decompressor is given, zlib data.
+
+        :param first_chunk: bytes already read from response.raw
+        :param expected_size: size of the decompressed data, checked at the end
         """
-        config.LOGGER.debug(f"Fetching instance {instance_id} from {remote_orthanc_uri}")
-        content, _ = get_data(f"{remote_orthanc_uri}/instances/{instance_id}/file")
-        post_data(f"{self.url}/instances", content, is_json=False)
+        decompressed_bytes = 0
+        try:
+            for chunk in itertools.chain([first_chunk], response.raw.stream(chunk_size, decode_content=True)):
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk, chunk_size)
+                    while chunk:
+                        decompressed_bytes += len(chunk)
+                        yield chunk
+                        chunk = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+                elif chunk:
+                    decompressed_bytes += len(chunk)
+                    yield chunk
+            if decompressor is not None:
+                chunk = decompressor.flush()
+                decompressed_bytes += len(chunk)
+                yield chunk
+            if expected_size is not None and decompressed_bytes != expected_size:
+                raise ValueError(f"Decompressed attachment has {decompressed_bytes} instead of {expected_size} bytes")
+        finally:
+            response.close()
+        OrthancHost.countTransfer("Instances", BytesReceived=response.raw.tell(), BytesDecompressed=decompressed_bytes)
+
+    @staticmethod
+    def countTransfer(counter=None, **amounts):
+        """
+        Increment counter by one and the other transfer counters by amounts, shared by all fetch threads.
+        """
+        with OrthancHost.transfer_statistics_lock:
+            if counter is not None:
+                OrthancHost.transfer_statistics[counter] += 1
+            for amount_counter, amount in amounts.items():
+                OrthancHost.transfer_statistics[amount_counter] += amount
+
+    @staticmethod
+    def getTransferStatistics():
+        """
+        :returns: dict of transfer counters and negotiated compression modes
+        """
+        with OrthancHost.transfer_statistics_lock:
+            statistics = dict(OrthancHost.transfer_statistics)
+        statistics["BytesSaved"] = statistics["BytesDecompressed"] - statistics["BytesReceived"]
+        statistics["Modes"] = dict(OrthancHost.transfer_modes)
+        return statistics
 
     def getSubresourcesOfOrthancResource(self, resource: dict, level: str):
         """
-        Recurse downwards (Patient -> Study -> Series -> Instance) returning all subresources
-        of type level
-         
+        Return all subresources of type level below resource. With descent_mode "bulk",
+        a whole level is fetched with a single request (e.g. /studies/{id}/instances),
+        the recursive descent is only used if the remote orthanc does not support it.
+
         :param resource: dict as returned by orthanc/tools/find, contains infos on resource
         :param level: string as returned by getQueryRetrieveLevel
         :returns: list of dicts of orthanc resources
         """
         config.LOGGER.debug(f"getSubresourcesOfOrthancResource called with args {resource}, {level}")
+        try:
+            resource_type = resource["Type"]
+        except KeyError:
+            config.LOGGER.error(f"Key 'Type' not found in resource: {resource}")
+            return []
+        levels = list(OrthancHost.subpaths_for_retrieve_level)
+        if resource_type.lower() not in levels:
+            raise ValueError(f"Resource has unknown Type {resource_type}")
+        if levels.index(level) <= levels.index(resource_type.lower()):
+            return [resource]
+        if self.descent_mode == "bulk":
+            try:
+                return self.getChildResourcesOfOrthancResource(resource, level)
+            except requests.ConnectionError as error:
+                if error.response is None:
+                    raise
+                config.LOGGER.warning(f"Bulk query for children of {resource['ID']} failed on {self.url} " + \
+                                      f"(status {error.response.status_code}), falling back to recursive descent.")
+        return self.getSubresourcesRecursively(resource, level)
+
+    def getChildResourcesOfOrthancResource(self, resource: dict, level: str):
+        """
+        Fetch all child resources of type level of resource with a single request.
+        The children of stable resources are answered from resource_cache once fetched.
+
+        :param resource: dict of an orthanc resource, containing keys "Type" and "ID"
+        :param level: string as returned by getQueryRetrieveLevel, must be below resource
+        :returns: list of dicts of orthanc resources
+        """
+        parent_subpath = OrthancHost.subpaths_for_retrieve_level[resource["Type"].lower()]
+        child_subpath = OrthancHost.subpaths_for_retrieve_level[level]
+        cache_key = ResourceCache.getKey(self.url, f"{parent_subpath}/{child_subpath}", resource["ID"])
+        is_cacheable = ResourceCache.isCacheable(resource)
+        if is_cacheable:
+            content = OrthancHost.resource_cache.get(cache_key)
+            if content is not None:
+                return content
+        content, _ = self.requestData(get_data,
+                                      f"{self.url}/{parent_subpath}/{resource['ID']}/{child_subpath}?expand")
+        if not isinstance(content, list):
+            config.LOGGER.error(f"Unexpected answer to bulk query for children of {resource['ID']}: {content}")
+            return []
+        if is_cacheable:
+            OrthancHost.resource_cache.put(cache_key, content, self.resource_cache_ttl)
+        return content
+
+    def getSubresourcesRecursively(self, resource: dict, level: str):
+        """
+        Recurse downwards (Patient -> Study -> Series -> Instance) returning all subresources
+        of type level, one request per child resource.
+
+        :param resource: dict as returned by orthanc/tools/find, contains infos on resource
+        :param level: string as returned by getQueryRetrieveLevel
+        :returns: list of dicts of orthanc resources
+        """
         resource_list = []
         try:
             resource_type = resource["Type"]
@@ -113,21 +359,22 @@ class OrthancHost:
             else:
                 for study_id in resource["Studies"]:
                     study_resource, _ = self.getOrthancResource("Study", study_id)
-                    resource_list.extend(self.getSubresourcesOfOrthancResource(study_resource, level))
+                    resource_list.extend(self.getSubresourcesRecursively(study_resource, level))
         elif resource_type == "Study":
             if level == "study":
                 return [resource]
             else:
                 for series_id in resource["Series"]:
                     series_resource, _ = self.getOrthancResource("Series", series_id)
-                    resource_list.extend(self.getSubresourcesOfOrthancResource(series_resource, level))
+                    resource_list.extend(self.getSubresourcesRecursively(series_resource, level))
         elif resource_type == "Series":
             if level == "series":
                 return [resource]
             else:
                 for instance_id in resource["Instances"]:
                     instance_resource, _ = self.getOrthancResource("Instance", instance_id)
-                    resource_list.extend(instance_resource)
+                    if instance_resource:
+                        resource_list.append(instance_resource)
         elif resource_type == "Instance":
             return [resource]
         else:
@@ -145,13 +392,13 @@ class OrthancHost:
         """
         try:
             if level == "patient":
-                dicom_dict, _ = get_data(self.url + f"/patients/{resource_id}/shared-tags?short=True")
+                dicom_dict, _ = self.requestData(get_data, self.url + f"/patients/{resource_id}/shared-tags?short=True")
             elif level == "study":
-                dicom_dict, _ = get_data(self.url + f"/studies/{resource_id}/shared-tags?short=True")
+                dicom_dict, _ = self.requestData(get_data, self.url + f"/studies/{resource_id}/shared-tags?short=True")
             elif level == "series":
-                dicom_dict, _ = get_data(self.url + f"/series/{resource_id}/shared-tags?short=True")
+                dicom_dict, _ = self.requestData(get_data, self.url + f"/series/{resource_id}/shared-tags?short=True")
             elif level == "instance":
-                dicom_dict, _ = get_data(self.url + f"/instances/{resource_id}/tags?short=True")
+                dicom_dict, _ = self.requestData(get_data, self.url + f"/instances/{resource_id}/tags?short=True")
             else:
                 raise ValueError(f"Unknown find level {level}")
         except requests.ConnectionError:
@@ -160,24 +407,45 @@ class OrthancHost:
         config.LOGGER.debug(f"Got dicom dictionary describing resource {resource_id}: {dicom_dict.keys()}")
         return dicom_dict
 
-    def findResources(self, query, level, limit=None):
+    def findResources(self, query, level, limit=None, since=None):
         """
         Does a find request over the orthanc REST API (see https://api.orthanc-server.com/#tag/Find)
         
         :param query: dictionary containing query, see collateFindQuery
         :param level: corresponds to C-FIND retrieve level
         :param limit: cut off after X amount of results
+        :param since: skip the first X results, requires limit
         """
         post_body = {"Level": level,
                      "Expand": True,
-                     "Query": query}
+                     "Query": query,
+                     "RequestedTags": list(query.keys())}
         if limit is not None:
-            post_body.update("limit", self.find_limit)
+            post_body["Limit"] = limit
+            if since is not None:
+                post_body["Since"] = since
         config.LOGGER.debug(f"Searching resources at level {level} and query {query}")
-        content, _ = post_data(f"{self.url}/tools/find", post_body)
-        config.LOGGER.debug(f"Query via {self.url}/tools/find found the following resources: {content}")
+        content, _ = self.requestData(post_data, f"{self.url}/tools/find", post_body)
+        config.LOGGER.debug(f"Query via {self.url}/tools/find found {len(content)} resources.")
         return content
 
+    def iterFindResources(self, query, level, max_results=None):
+        """
+        Generator over the results of findResources, fetched in pages of find_limit resources.
+
+        :param query: dictionary containing query, see collateFindQuery
+        :param level: corresponds to C-FIND retrieve level
+        :param max_results: stop after X amount of results, None for no limit
+        """
+        since = 0
+        while max_results is None or since < max_results:
+            page_size = self.find_limit if max_results is None else min(self.find_limit, max_results - since)
+            page = self.findResources(query, level, limit=page_size, since=since)
+            yield from page
+            if len(page) < page_size:
+                break
+            since += len(page)
+
     def getDictFromRequestBody(self, request_body: bytes):
         """
         Reads the the POST body as sent by orthanc when calling this plugin
@@ -232,14 +500,14 @@ class OrthancHost:
         irrelevant_keywords = ["QueryRetrieveLevel"]
         retrieve_level = OrthancHost.getQueryRetrieveLevel(request_dict).lower()
         for dicom_tag, dicom_value in request_dict.items():
-            dicom_group, dicom_element = dicom_tag.split(",")
             try:
-                hex_tag = int(f"{dicom_group}{dicom_element}", 16)
+                dicom_keyword = DicomTags.getKeyword(dicom_tag)
             except ValueError:
-                config.LOGGER.error(f"Failed to convert dicom_group ({dicom_group}) " +\
-                             f"or dicom_element ({dicom_element}) to hex value.")
+                config.LOGGER.error(f"Failed to convert dicom tag ({dicom_tag}) to hex value.")
                 raise ValueError()
-            dicom_keyword = keyword_for_tag(hex_tag)
+            if dicom_keyword is None:
+                config.LOGGER.warning(f"Find query contains private or unknown tag {dicom_tag}, ignoring it.")
+                continue
             if dicom_keyword not in irrelevant_keywords:
                 if dicom_keyword not in OrthancHost.valid_keywords_for_retrieve_level[retrieve_level]:
                     config.LOGGER.warning(f"Find query contains invalid keyword {dicom_keyword}"+\
@@ -247,6 +515,27 @@ class OrthancHost:
                 find_query[dicom_keyword] = dicom_value
         return find_query
 
+    @staticmethod
+    def getDicomDictFromResource(resource: dict, find_query: dict):
+        """
+        Build the dicom dict answering find_query from the tags an expanded orthanc
+        resource already carries (MainDicomTags, PatientMainDicomTags, RequestedTags).
+
+        :param resource: dict as returned by orthanc/tools/find with "Expand"
+        :param find_query: dict as returned by collateFindQuery
+        :returns: dict of numeric dicom tags / values, None if a queried tag is missing
+        """
+        resource_tags = {}
+        for tags_key in ["PatientMainDicomTags", "MainDicomTags", "RequestedTags"]:
+            resource_tags.update(resource.get(tags_key, {}))
+        #orthanc converts all tag values to utf-8
+        dicom_dict = {"0008,0005": "ISO_IR 192"}
+        for keyword in find_query.keys():
+            if keyword not in resource_tags:
+                return None
+            dicom_dict[DicomTags.getOrthancTag(keyword)] = resource_tags[keyword]
+        return dicom_dict
+
     @staticmethod
     def filterTagsOfDicomDict(dicom_dict, find_query, find_level):
         """
@@ -257,11 +546,12 @@ class OrthancHost:
         #remove picture data ("7fe0,0010", "0002,0002"), otherwise orthanc starts screaming
         #encoding shall be returned with every answer
         required_tags = ["0008,0005"]
-        find_query_tags = [tag_for_keyword(keyword) for keyword in find_query.keys()]
-        find_query_tags = [f"{tag:08X}"[:4] + "," + f"{tag:08X}"[4:] for tag in find_query_tags]
+        find_query_tags = [DicomTags.getOrthancTag(keyword) for keyword in find_query.keys()]
         config.LOGGER.debug(f"Filtering out tags from json structure not in {find_query_tags} or {required_tags}")
-        #return only tags that the user asked for in the c-find query
-        return_dict = {k:v for (k, v) in dicom_dict.items() if k in find_query_tags + required_tags}
+        #return only tags that the user asked for in the c-find query,
+        #orthanc writes tags in lowercase ("0008,103e"), compare case insensitively
+        returned_tags = set(find_query_tags + required_tags)
+        return_dict = {k:v for (k, v) in dicom_dict.items() if k.lower() in returned_tags}
         config.LOGGER.debug(f"Adding QueryRetrieveLevel ({find_level}) to answer.")
         return_dict["0008,0052"] = find_level.capitalize()
         return return_dict
@@ -279,10 +569,9 @@ class OrthancHost:
         return resource_id
     
     @staticmethod
-    def getResourceByID(resource_list, resource_id: str):
+    def indexResourcesByID(resource_list):
         """
-        search for a resource identified by its ID in a list of Orthanc resources
+        Return dict of Orthanc resources keyed by their ID. If a resource
+        occurs more than once, the last occurrence is kept.
         """
-        for resource in resource_list:
-            if resource["ID"] == resource_id:
-                return resource
+        return {OrthancHost.getIDOfResource(resource): resource for resource in resource_list}
@@ -4,18 +4,85 @@ import time
 import os
 import hashlib
 import sys
-import copy
-from json import loads, dumps
+import sqlite3
+import threading
+from json import loads, dumps, JSONDecodeError
 from pydicom import dcmread
 from pydicom.dataset import Dataset
 from pydicom.uid import generate_uid
-from pydicom.datadict import dictionary_VR, keyword_for_tag
+from pydicom.datadict import dictionary_VR
 from curapacs_python import config
+from curapacs_python.DicomTags import DicomTags
+
+
+class WorklistJournal:
+    """
+    SQLite record of worklist ID (SHA1 of the filename) -> filename and creation time of the
+    worklist files, written whenever a worklist is stored, so that deleting one needs no
+    directory scan. Shared by the orthanc and the websocket process through the file.
+    """
+
+    def __init__(self, path=config.WORKLIST_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS worklists ("
+                                 "worklist_id TEXT PRIMARY KEY, "
+                                 "filename TEXT NOT NULL, "
+                                 "created REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS worklists_created ON worklists (created)")
+
+    def execute(self, statement, parameters=()):
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def add(self, worklist_id, filename, created=None):
+        self.execute("INSERT OR REPLACE INTO worklists (worklist_id, filename, created) VALUES (?, ?, ?)",
+                     (worklist_id, filename, created or time.time()))
+
+    def addMany(self, worklists):
+        """
+        :param worklists: iterable of (worklist_id, filename, created) tuples, recorded in one transaction
+        """
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany("INSERT OR REPLACE INTO worklists (worklist_id, filename, created) " + \
+                                             "VALUES (?, ?, ?)", worklists)
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def get(self, worklist_id):
+        """
+        :returns: filename of worklist_id, None if unknown
+        """
+        rows = self.execute("SELECT filename FROM worklists WHERE worklist_id = ?", (worklist_id,))
+        return rows[0][0] if rows else None
+
+    def remove(self, worklist_ids):
+        with self._lock:
+            self._connection.executemany("DELETE FROM worklists WHERE worklist_id = ?",
+                                         [(worklist_id,) for worklist_id in worklist_ids])
+
+    def getCreatedBefore(self, timestamp):
+        """
+        :returns: list of (worklist_id, filename) tuples of the worklists created before timestamp
+        """
+        return self.execute("SELECT worklist_id, filename FROM worklists WHERE created < ?", (timestamp,))
+
+    def getFilenames(self):
+        return {filename for (filename,) in self.execute("SELECT filename FROM worklists")}
 
 
 class Worklist():
     modality_worklist_path = config.WORKLISTS_DATABASE_DIRECTORY
     modality_worklist_suffix = "wl"
+    # opened on first use, so that every process gets its own connection
+    journal = None
 
     # set of rules that need to be respected
     ruleset = [{"PatientID": str, "constraints": {"maxlength": 64, "returnkeytype": 1}},
@@ -25,10 +92,16 @@ class Worklist():
                {"ScheduledProcedureStepStartDate": str, "constraints": {"exactlength": 8, "isnumeric": True, "returnkeytype": 1}},
                {"ScheduledProcedureStepStartTime": str, "constraints": {"returnkeytype": 1}},
                {"ScheduledPerformingPhysicianName": str, "constraints": {"isextendedalpha": True, "returnkeytype": 2}}]
+    # ruleset compiled by get_validators
+    validators = None
+    required_keywords = None
+    extended_alpha_pattern = re.compile(r'^[a-zA-Z^ .]*$')
 
 
     def __init__(self, json=None):
         self.pydicom_dataset = Dataset()
+        # name of the file the worklist was stored in by storeDataSetOnDisk
+        self.filename = None
         if json:
             self.json = loads(json)
 
@@ -42,17 +115,155 @@ class Worklist():
         :param json: json dict containing info on worklist contents
         :returns: sha1 hash of filename created
         """
-        for key, value in Worklist.flattenIterable(json):
-            for rule in Worklist.ruleset:
-                if key in rule.keys():
-                    self.check_value(key, value, rule[key], **rule["constraints"])
-                    break
-        self.check_required_tags()
+        self.validate(json)
         pydicom_json = self.reformatJSON(json)
         self.createDataSetFromJson(pydicom_json)
         filehash = self.storeDataSetOnDisk()
         return {"id": filehash}
 
+    @classmethod
+    def get_validators(cls):
+        """
+        Compile Worklist.ruleset once into a table keyword -> (required type, [(check, constraint value), ...])
+        with the check_* function of every constraint looked up in advance, and the list of required
+        keywords (returnkeytype 1 or 2) in the order of the ruleset.
+
+        :returns: tuple of the validator table and the list of required keywords
+        """
+        if cls.validators is None:
+            validators, required_keywords = {}, []
+            for rule in cls.ruleset:
+                constraints = rule["constraints"]
+                checks = [(getattr(cls, f"check_{constraint}"), constraint_value)
+                          for constraint, constraint_value in constraints.items()
+                          if hasattr(cls, f"check_{constraint}")]
+                for key, required_type in rule.items():
+                    if key == "constraints":
+                        continue
+                    validators.setdefault(key, (required_type, checks))
+                    if constraints.get("returnkeytype", 3) in (1, 2):
+                        required_keywords.append(key)
+            cls.validators, cls.required_keywords = validators, required_keywords
+        return cls.validators, cls.required_keywords
+
+    def validate(self, json: dict):
+        """
+        Check the values of json against Worklist.ruleset and that all required tags are present,
+        in a single pass over json.
+
+        :raises TypeError, ValueError, KeyError: if json is not a valid worklist
+        """
+        validators, required_keywords = Worklist.get_validators()
+        present_keys = set()
+        for key, value in Worklist.flattenIterable(json):
+            present_keys.add(key)
+            validator = validators.get(key)
+            if validator is None:
+                continue
+            required_type, checks = validator
+            if not isinstance(value, required_type):
+                raise TypeError("Value for key {} not of type {}".format(key, str(required_type)))
+            for check, constraint_value in checks:
+                check(key, value, constraint_value)
+        for key in required_keywords:
+            if key not in present_keys:
+                raise KeyError(f"Required DICOM tag \"{key}\" not found in json structure.")
+        self.json = json
+
+    @classmethod
+    def validate_many(cls, items):
+        """
+        Validate a batch of worklist json dicts with the compiled ruleset.
+
+        :returns: list with None for every valid item and the exception raised by validate for every invalid one
+        """
+        errors = []
+        worklist = cls()
+        for item in items:
+            try:
+                if isinstance(item, Exception):
+                    raise ValueError(f"Malformed json: {item}")
+                if not isinstance(item, dict):
+                    raise TypeError(f"Worklist is not a json object")
+                worklist.validate(item)
+            except (TypeError, ValueError, KeyError) as error:
+                errors.append(error)
+                continue
+            errors.append(None)
+        return errors
+
+    @staticmethod
+    def parse_json_items(body: bytes):
+        """
+        Split the body of a bulk request, either a JSON array or NDJSON (one JSON object per line).
+        Lines of NDJSON that fail to parse are returned as their json.JSONDecodeError, so the
+        remaining items can still be imported and the error reported at its position.
+
+        :returns: list of worklist json dicts
+        """
+        text = body.decode() if isinstance(body, bytes) else body
+        try:
+            items = loads(text)
+        except JSONDecodeError:
+            return [Worklist.parse_json_line(line) for line in text.splitlines() if line.strip()]
+        return items if isinstance(items, list) else [items]
+
+    @staticmethod
+    def parse_json_line(line: str):
+        try:
+            return loads(line)
+        except JSONDecodeError as error:
+            return error
+
+    @classmethod
+    def create_worklists_from_json_list(cls, items):
+        """
+        Validate and store many worklists at once. Items failing validation are reported
+        and skipped, the directory is synced to disk once after all files are written.
+
+        :param items: list of json dicts as accepted by create_worklist_from_json
+        :returns: tuple of a list with one dict per item, containing either "ID" or "Error",
+                  and the list of the stored Worklist objects
+        """
+        results, stored_worklists = [], []
+        prefix = time.strftime('%G-%m-%d_%H-%M-%S', time.localtime())
+        index = 0
+        for position, (item, validation_error) in enumerate(zip(items, cls.validate_many(items))):
+            if validation_error is not None:
+                results.append({"Index": position,
+                                "Error": f"{validation_error.__class__.__name__}: {validation_error}"})
+                continue
+            worklist = cls()
+            worklist.json = item
+            try:
+                worklist.createDataSetFromJson(worklist.reformatJSON(item))
+                index = worklist.storeDataSetInNewFile(prefix, index)
+            except (TypeError, ValueError, KeyError, OSError) as error:
+                results.append({"Index": position, "Error": f"{error.__class__.__name__}: {error}"})
+                continue
+            index += 1
+            worklist_id = worklist.hashme(worklist.filename)
+            results.append({"Index": position, "ID": worklist_id})
+            stored_worklists.append(worklist)
+        if stored_worklists:
+            now = time.time()
+            cls.get_journal().addMany((worklist.hashme(worklist.filename), worklist.filename, now)
+                                      for worklist in stored_worklists)
+            cls.sync_directory()
+        config.LOGGER.info(f"Imported {len(stored_worklists)} of {len(results)} worklists.")
+        return results, stored_worklists
+
+    @classmethod
+    def sync_directory(cls):
+        """
+        fsync the worklist directory, making the names of newly written files durable.
+        """
+        directory_descriptor = os.open(cls.modality_worklist_path, os.O_RDONLY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
+
     def create_worklist_from_dicom_json(self, json: dict):
         """
         Expects the dicom json format, e.g. {"AccessionNumber": {"vr": "SH", "Value": ["4389400244813963"]}, ...}
@@ -76,6 +287,34 @@ class Worklist():
             config.LOGGER.info(f"Worklist directory {cls.modality_worklist_path} created.")
         except FileExistsError:
             pass
+
+    @classmethod
+    def get_journal(cls):
+        if cls.journal is None:
+            cls.journal = WorklistJournal()
+        return cls.journal
+
+    @classmethod
+    def synchronize_journal(cls):
+        """
+        Record worklist files the journal does not know yet (e.g. written before it existed or
+        copied into the directory) and forget files that vanished.
+
+        :returns: tuple of the numbers of files recorded and forgotten
+        """
+        journal = cls.get_journal()
+        journaled_filenames = journal.getFilenames()
+        present_filenames = set(Worklist().get_current_worklists())
+        new_filenames = present_filenames - journaled_filenames
+        journal.addMany((Worklist().hashme(filename), filename,
+                         os.stat(os.path.join(cls.modality_worklist_path, filename)).st_mtime)
+                        for filename in new_filenames)
+        vanished_filenames = journaled_filenames - present_filenames
+        journal.remove(Worklist().hashme(filename) for filename in vanished_filenames)
+        if new_filenames or vanished_filenames:
+            config.LOGGER.info(f"Worklist journal recorded {len(new_filenames)} and forgot " + \
+                               f"{len(vanished_filenames)} worklist files.")
+        return len(new_filenames), len(vanished_filenames)
             
 
     @staticmethod
@@ -102,28 +341,15 @@ class Worklist():
 
     def replace_tags_with_keywords(self, worklist_dict):
         """
-        dont ask, just enjoy
         iterate through json structure containing information on existing worklists
-        and replace all occurrences of dicom tags with their corresponding keywords.
+        and replace all occurrences of dicom tags with their corresponding keywords,
+        also inside sequences of any depth. The result is built in a single pass,
+        worklist_dict is left unchanged.
 
         :param worklist_dict: dictonary that contains the worklist elements
         """
-        keyword_dict = copy.deepcopy(worklist_dict)
-        for key, value in worklist_dict.items():
-            if isinstance(value, dict):
-                for dicom_tag, vr_dict in value.items():
-                    dicom_keyword = keyword_for_tag(int(dicom_tag, 16))
-                    keyword_dict[key][dicom_keyword] = keyword_dict[key].pop(dicom_tag)
-                    if vr_dict["Value"] and isinstance(vr_dict["Value"][0], dict):
-                        for index, nested_vr_dict in enumerate(vr_dict["Value"]):
-                            for nested_dicom_tag, _ in nested_vr_dict.items():
-                                try:
-                                    nested_dicom_keyword = keyword_for_tag(int(nested_dicom_tag, 16))
-                                except ValueError:
-                                    continue
-                                keyword_dict[key][dicom_keyword]["Value"][index][nested_dicom_keyword] = \
-                                    keyword_dict[key][dicom_keyword]["Value"][index].pop(nested_dicom_tag)
-        return keyword_dict
+        return {key: DicomTags.replaceTagsWithKeywords(value) if isinstance(value, dict) else value
+                for key, value in worklist_dict.items()}
 
     def create_available_worklists_response_dict(self, replace_tags_with_keywords=True, hashed_code=None):
         """
@@ -189,27 +415,38 @@ class Worklist():
         if not isinstance(value, requiredType):
             raise TypeError("Value for key {} not of type {}".format(key,str(requiredType)))
         
-        for additional_constraint, additional_constraint_value in kwargs.items():         
-            if additional_constraint == "maxsize":                # if pat id co --> give error back
-                if value > additional_constraint_value:
-                    raise ValueError("Value for key {} bigger than {}".format(key, additional_constraint_value))
-            if additional_constraint == "maxlength":
-                # if given lenght is bigger than the one deifined, raise ValErr
-                if len(value) > additional_constraint_value:
-                    raise ValueError("Value for key {} longer than {}".format(key, additional_constraint_value))
-            if additional_constraint == "exactlength":
-                if not len(value) == additional_constraint_value:
-                    raise ValueError("Value for key {} is not exactly {} digits long.".format(key,additional_constraint_value))
-            if additional_constraint == "isnumeric":
-                if not value.isnumeric():
-                   raise ValueError("Value for key {} contains non numeric characters".format(key)) 
-            # remake this, it exculdes space in the name --> always err
-            if additional_constraint == "isextendedalpha":
-                match_pattern = r'^[a-zA-Z^ .]*$'
-                match = re.match(match_pattern, value)
-                if not match:
-                   raise ValueError("Value for key {} does not match pattern {}".format(key, match_pattern))
+        for additional_constraint, additional_constraint_value in kwargs.items():
+            check = getattr(Worklist, f"check_{additional_constraint}", None)
+            if check is not None:
+                check(key, value, additional_constraint_value)
         return True
+
+    @staticmethod
+    def check_maxsize(key, value, maxsize):
+        if value > maxsize:
+            raise ValueError("Value for key {} bigger than {}".format(key, maxsize))
+
+    @staticmethod
+    def check_maxlength(key, value, maxlength):
+        if len(value) > maxlength:
+            raise ValueError("Value for key {} longer than {}".format(key, maxlength))
+
+    @staticmethod
+    def check_exactlength(key, value, exactlength):
+        if not len(value) == exactlength:
+            raise ValueError("Value for key {} is not exactly {} digits long.".format(key, exactlength))
+
+    @staticmethod
+    def check_isnumeric(key, value, isnumeric):
+        if isnumeric and not value.isnumeric():
+            raise ValueError("Value for key {} contains non numeric characters".format(key))
+
+    @staticmethod
+    def check_isextendedalpha(key, value, isextendedalpha):
+        # remake this, it exculdes space in the name --> always err
+        if isextendedalpha and not Worklist.extended_alpha_pattern.match(value):
+            raise ValueError("Value for key {} does not match pattern {}".format(key,
+                                                                             Worklist.extended_alpha_pattern.pattern))
      
     def createDataSetFromJson(self, pydicom_json):
         """creates self.pydicom_dataset from self.json"""
@@ -248,15 +485,11 @@ class Worklist():
         respects all the given constraints
         
         :returns: True if all the constraints are correct """
-        json_keys = [json_tuple[0] for json_tuple in Worklist.flattenIterable(self.json)]
+        json_keys = {json_tuple[0] for json_tuple in Worklist.flattenIterable(self.json)}
         config.LOGGER.debug(f"json_keys are {json_keys}")
-        for rule in Worklist.ruleset:
-            returnkeytype = rule["constraints"].get("returnkeytype", 3)
-            for key in rule:
-                if key == "constraints":
-                    continue
-                if key not in json_keys and returnkeytype in (1, 2):
-                    raise KeyError(f"Required DICOM tag \"{key}\" not found in json structure.")
+        for key in Worklist.get_validators()[1]:
+            if key not in json_keys:
+                raise KeyError(f"Required DICOM tag \"{key}\" not found in json structure.")
         return True
 
     def storeDataSetOnDisk(self):
@@ -271,7 +504,35 @@ class Worklist():
             else:
                 index = index + 1
         self.pydicom_dataset.save_as(concatination_file_name)
-        return self.hashme(filename)
+        self.filename = filename
+        filehash = self.hashme(filename)
+        Worklist.get_journal().add(filehash, filename)
+        return filehash
+
+    def storeDataSetInNewFile(self, prefix: str, index: int):
+        """
+        Write Dataset to the first file named {prefix}_{index}.wl (counting up from index) that
+        does not exist yet. Creating the file exclusively claims its name, even against
+        concurrent writers, without checking every candidate beforehand.
+
+        :returns: index of the file written
+        """
+        while True:
+            filename = f"{prefix}_{index}.{Worklist.modality_worklist_suffix}"
+            try:
+                worklist_file = open(os.path.join(Worklist.modality_worklist_path, filename), "xb")
+            except FileExistsError:
+                index += 1
+                continue
+            break
+        try:
+            with worklist_file:
+                self.pydicom_dataset.save_as(worklist_file)
+        except Exception:
+            os.remove(os.path.join(Worklist.modality_worklist_path, filename))
+            raise
+        self.filename = filename
+        return index
 
     def generateAccessionNumber(self, minlength=8):
         return str(random.randint(10**minlength, 10**16-1))
@@ -279,23 +540,57 @@ class Worklist():
     def generateStudyID(self):
         return generate_uid()
 
+    def find_worklist_filename(self, hashed_code: str):
+        """
+        Look up the file of worklist hashed_code in the journal. Files written before the
+        journal existed are recorded by synchronize_journal at startup.
+
+        :returns: filename of the worklist, None if it does not exist
+        """
+        return Worklist.get_journal().get(hashed_code)
+
     def http_delete(self, hashed_code: str):
         """ 
         Delete the desired Worklist with the hash hashed_code
 
         :param hashed_code: str hashed information of the worklist to be deleted
+        :raises FileNotFoundError: if the worklist does not exist (anymore)
         """
-        # get the list of existing worklists
-        # compare hashed_code local to given hashed_code for each element in worklists
-        for filename_of_exsisting_worklist in self.get_current_worklists():
-            if self.hashme(filename_of_exsisting_worklist) == hashed_code:
-                os.remove(os.path.join(Worklist.modality_worklist_path, filename_of_exsisting_worklist))
-                break
-        else:
+        filename = self.find_worklist_filename(hashed_code)
+        try:
+            if filename is None:
+                raise FileNotFoundError()
+            os.remove(os.path.join(Worklist.modality_worklist_path, filename))
+        except FileNotFoundError:
+            # unknown, or removed by a concurrent delete
+            Worklist.get_journal().remove([hashed_code])
             config.LOGGER.error(f"User ordered deletion of non existing worklist (hash {hashed_code})")
             raise FileNotFoundError(f"The worklist corresponding to hash {hashed_code} does not exist.")
+        Worklist.get_journal().remove([hashed_code])
         return hashed_code
 
+    def http_delete_many(self, hashed_codes=(), created_before=None):
+        """
+        Delete the worklists with the hashes hashed_codes and/or all worklists created before
+        created_before, a unix timestamp.
+
+        :returns: dict with lists of the "Deleted" and the "Missing" worklist IDs
+        """
+        hashed_codes = list(hashed_codes)
+        if created_before is not None:
+            hashed_codes.extend(worklist_id for worklist_id, _ in Worklist.get_journal().getCreatedBefore(created_before))
+        hashed_codes = list(dict.fromkeys(hashed_codes))
+        deleted, missing = [], []
+        for hashed_code in hashed_codes:
+            try:
+                self.http_delete(hashed_code)
+            except FileNotFoundError:
+                missing.append(hashed_code)
+            else:
+                deleted.append(hashed_code)
+        config.LOGGER.info(f"Deleted {len(deleted)} worklists, {len(missing)} did not exist.")
+        return {"Deleted": deleted, "Missing": missing}
+
 
 def worklist_worker(output, uri_path, **kwargs):
     """
@@ -341,4 +636,4 @@ def worklist_worker(output, uri_path, **kwargs):
         except FileNotFoundError as error:
             output.SendHttpStatus(400, f"{error}", len(str(error)))
             return
-        output.AnswerBuffer("{}", 'application/json')
\ No newline at end of file
+        output.AnswerBuffer("{}", 'application/json')
@@ -0,0 +1,179 @@
+import time
+import requests
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from curapacs_python import config
+from curapacs_python.CircuitBreaker import CircuitOpenError
+from curapacs_python.OrthancHost import OrthancHost
+from curapacs_python.QueryCache import QueryCache
+
+
+class OrthancQueryEngine:
+    """
+    Runs the lookups behind a federated C-FIND concurrently.
+    Local and remote searches run in parallel, tag dictionaries are fetched with at most
+    max_workers requests in flight per query. Whatever has not finished once the deadline
+    expired is left out of the answer. Results of remote searches are cached in remote_cache.
+    Searches are paged and every answer is capped at max_answers resources.
+
+    Requests to the local and to the remote orthanc run on separate executors: requests to a
+    slow peer keep running past the deadline (a running future cannot be cancelled), they must
+    not hold up local searches of the queries that follow.
+    """
+    local_executor = ThreadPoolExecutor(max_workers=config.QUERY_CONCURRENCY,
+                                        thread_name_prefix="curapacs-query-local")
+    remote_executor = ThreadPoolExecutor(max_workers=config.QUERY_CONCURRENCY,
+                                         thread_name_prefix="curapacs-query-remote")
+    remote_cache = QueryCache()
+
+    def __init__(self, local_orthanc, remote_orthanc, max_workers=config.QUERY_CONCURRENCY,
+                 deadline=config.QUERY_DEADLINE, max_answers=config.MAX_FIND_ANSWERS):
+        self.local_orthanc = local_orthanc
+        self.remote_orthanc = remote_orthanc
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.max_answers = max_answers or None
+
+    def runFindQuery(self, find_query: dict, find_level: str):
+        """
+        Search local and remote orthanc, merge the results and return the filtered
+        dicom dicts of every resource found.
+
+        :param find_query: dict as returned by OrthancHost.collateFindQuery
+        :param find_level: string as returned by OrthancHost.getQueryRetrieveLevel
+        :returns: list of dicom dicts (numeric dicom tags / dicom values), possibly partial
+        """
+        return list(self.iterFindQuery(find_query, find_level))
+
+    def iterFindQuery(self, find_query: dict, find_level: str):
+        """
+        Generator version of runFindQuery, yielding each dicom dict as soon as it is available.
+        """
+        deadline = time.monotonic() + self.deadline
+        cache_key = QueryCache.getKey(find_level, find_query)
+        cached_remote_resources = self.remote_cache.get(cache_key)
+        if cached_remote_resources is None:
+            remote_future = self.remote_executor.submit(self.searchRemoteResources, find_query,
+                                                        find_level, cache_key)
+        else:
+            config.LOGGER.debug(f"Using cached remote resources for query {cache_key}")
+            remote_future = Future()
+            remote_future.set_result(cached_remote_resources)
+        local_future = self.local_executor.submit(self.searchResources, self.local_orthanc,
+                                                  find_query, find_level, self.max_answers)
+        wait([remote_future, local_future], timeout=self.getRemainingTime(deadline))
+        remote_resources = self.getSearchResult(remote_future, self.remote_orthanc)
+        local_resources = self.getSearchResult(local_future, self.local_orthanc)
+
+        remote_resources_by_id = OrthancHost.indexResourcesByID(remote_resources)
+        local_resources_by_id = OrthancHost.indexResourcesByID(local_resources)
+        # resources present on both sides are answered by the local orthanc, local resources go first
+        # so truncating at max_answers drops remote-only resources before local ones
+        remote_only_requests = [(self.remote_orthanc, resource) for resource_id, resource in remote_resources_by_id.items()
+                                if resource_id not in local_resources_by_id]
+        config.LOGGER.debug(f"Found {len(remote_only_requests)} resources not present on local orthanc, " + \
+                            f"{len(local_resources_by_id)} local resources, " + \
+                            f"{len(remote_resources_by_id) - len(remote_only_requests)} of them also on remote.")
+        tag_requests = [(self.local_orthanc, resource) for resource in local_resources_by_id.values()]
+        tag_requests.extend(remote_only_requests)
+        if self.max_answers is not None and len(tag_requests) > self.max_answers:
+            config.LOGGER.warning(f"C-FIND matched {len(tag_requests)} resources, answering the first {self.max_answers}.")
+            del tag_requests[self.max_answers:]
+        for dicom_dict in self.iterTagsAndValues(tag_requests, find_query, find_level, deadline):
+            yield OrthancHost.filterTagsOfDicomDict(dicom_dict, find_query, find_level)
+
+    @staticmethod
+    def searchResources(orthanc_host, find_query: dict, find_level: str, max_results=None):
+        """
+        Find resources on orthanc_host and descend to resources of type find_level.
+
+        :param max_results: stop after X amount of resources, None for no limit
+        :returns: list of dicts of orthanc resources
+        """
+        resources = []
+        for resource in orthanc_host.iterFindResources(find_query, find_level, max_results):
+            resource_list = orthanc_host.getSubresourcesOfOrthancResource(resource, find_level)
+            config.LOGGER.debug(f"Found {len(resource_list)} resources for resource on {orthanc_host.url}")
+            resources.extend(resource_list)
+            if max_results is not None and len(resources) >= max_results:
+                del resources[max_results:]
+                break
+        return resources
+
+    def searchRemoteResources(self, find_query: dict, find_level: str, cache_key):
+        """
+        searchResources on the remote orthanc, storing the result in remote_cache.
+        Empty results are cached as well.
+        """
+        resources = self.searchResources(self.remote_orthanc, find_query, find_level, self.max_answers)
+        self.remote_cache.put(cache_key, resources, QueryCache.getResourceIDs(resources))
+        return resources
+
+    def iterTagsAndValues(self, tag_requests: list, find_query: dict, find_level: str, deadline: float):
+        """
+        Generator over dicom dicts for (orthanc_host, resource) tuples. Resources whose expanded tags
+        cover find_query are answered directly, for all others the tags are fetched, keeping
+        at most max_workers requests in flight. Requests still pending at the deadline are cancelled.
+
+        :returns: generator of dicom dicts that were fetched in time
+        """
+        answer_count = 0
+        pending_requests = iter(tag_requests)
+        in_flight = set()
+        try:
+            while True:
+                for orthanc_host, resource in pending_requests:
+                    dicom_dict = OrthancHost.getDicomDictFromResource(resource, find_query)
+                    if dicom_dict is not None:
+                        answer_count += 1
+                        yield dicom_dict
+                        continue
+                    executor = self.getExecutor(orthanc_host)
+                    in_flight.add(executor.submit(orthanc_host.getTagsAndValuesOfOrthancResource,
+                                                  OrthancHost.getIDOfResource(resource), find_level))
+                    if len(in_flight) >= self.max_workers:
+                        break
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, timeout=self.getRemainingTime(deadline),
+                                       return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        dicom_dict = future.result()
+                    except (requests.RequestException, ValueError) as error:
+                        config.LOGGER.error(f"Failed to fetch dicom data of resource: {error}")
+                        continue
+                    if dicom_dict:
+                        answer_count += 1
+                        yield dicom_dict
+                if not done:
+                    config.LOGGER.warning(f"C-FIND deadline of {self.deadline}s expired, returning " + \
+                                          f"{answer_count} of {len(tag_requests)} resources.")
+                    break
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def getExecutor(self, orthanc_host):
+        return self.local_executor if orthanc_host is self.local_orthanc else self.remote_executor
+
+    def getSearchResult(self, future, orthanc_host):
+        """
+        Return result of a searchResources future, or an empty list if the search
+        failed or did not finish before the deadline.
+        """
+        if not future.done():
+            future.cancel()
+            config.LOGGER.warning(f"Search on {orthanc_host.url} did not finish within {self.deadline}s.")
+            return []
+        try:
+            return future.result()
+        except CircuitOpenError:
+            config.LOGGER.info(f"Circuit for {orthanc_host.url} is open, skipping its resources.")
+            return []
+        except (requests.RequestException, ValueError):
+            config.LOGGER.error(f"Failed to connect to {orthanc_host.url} to query for resources.")
+            return []
+
+    @staticmethod
+    def getRemainingTime(deadline: float):
+        return max(deadline - time.monotonic(), 0)
@@ -1,6 +1,7 @@
 import asyncio
 import websockets
 import json
+import requests
 import multiprocessing
 import logging
 import sys
@@ -8,6 +9,7 @@ from curapacs_python import config
 from curapacs_python import helpers
 from curapacs_python.OrthancHost import OrthancHost
 from curapacs_python.OrthancMWLCreator import Worklist
+from curapacs_python.WorklistPrefetcher import WorklistPrefetcher
 
 
 class OrthancMessage:
@@ -31,20 +33,97 @@ class OrthancMessage:
     def type(self):
         return self._type
 
+    @staticmethod
+    def _get_remote_orthanc():
+        return OrthancHost(config.PEER_URI,
+                           http_user=config.PEER_HTTP_USER,
+                           http_password=config.PEER_HTTP_PASSWORD)
+
     def _get_new_worklist(self):
         worklist_id = self.content["id"]
         config.LOGGER.debug(f"Fetching worklist with id: {worklist_id}")
-        remote_orthanc = OrthancHost(config.PEER_URI,
-                             http_user=config.PEER_HTTP_USER,
-                             http_password=config.PEER_HTTP_PASSWORD)
-        worklist_as_json, _ = helpers.get_data(f"{remote_orthanc.url}/worklists/{worklist_id}")
+        remote_orthanc = self._get_remote_orthanc()
+        worklist_as_json, _ = remote_orthanc.requestData(helpers.get_data,
+                                                         f"{remote_orthanc.url}/worklists/{worklist_id}")
+        self._store_worklist(worklist_as_json)
+
+    def _get_new_worklists(self, batch_size=config.WORKLIST_FETCH_BATCH_SIZE):
+        """
+        Fetch all worklists announced by one message of a bulk import, batch_size of them per request.
+        """
+        worklist_ids = self.content.get("ids", [])
+        config.LOGGER.debug(f"Fetching {len(worklist_ids)} new worklists.")
+        remote_orthanc = self._get_remote_orthanc()
+        for index in range(0, len(worklist_ids), batch_size):
+            batch = worklist_ids[index:index + batch_size]
+            try:
+                worklists, _ = remote_orthanc.requestData(helpers.get_data,
+                                                          f"{remote_orthanc.url}/worklists?ids={','.join(batch)}")
+            except (requests.RequestException, ValueError) as error:
+                config.LOGGER.error(f"Failed to fetch {len(batch)} worklists: {error}")
+                continue
+            for worklist_id in batch:
+                if worklist_id not in worklists:
+                    config.LOGGER.warning(f"Worklist {worklist_id} is gone from {remote_orthanc.url}.")
+                    continue
+                try:
+                    self._store_worklist(worklists[worklist_id])
+                except (ValueError, TypeError, KeyError) as error:
+                    config.LOGGER.error(f"Failed to store worklist {worklist_id}: {error}")
+
+    def _store_worklist(self, worklist_as_json):
         worklist = Worklist(json=json.dumps(worklist_as_json))
         worklist.create_worklist_from_dicom_json(worklist.json)
         config.LOGGER.debug(f"Created new worklist.")
+        self._request_prefetch(worklist.json)
+
+    def _request_prefetch(self, worklist_json):
+        """
+        Ask the local orthanc to prefetch the prior studies of the scheduled patient,
+        the prefetcher lives in the orthanc process, not in this one.
+        """
+        prefetch_request = {
+            keyword: WorklistPrefetcher.getWorklistValue(worklist_json, keyword)
+            for keyword in ["PatientID", "ScheduledProcedureStepStartDate", "ScheduledProcedureStepStartTime"]}
+        if not prefetch_request["PatientID"]:
+            config.LOGGER.debug("Worklist without PatientID, nothing to prefetch.")
+            return
+        local_url = f"http://localhost:{config.LOCAL_HTTP_PORT}"
+        try:
+            helpers.post_data(f"{local_url}/curapacs/prefetch", prefetch_request,
+                              session=helpers.get_session(local_url, config.LOCAL_HTTP_USER,
+                                                          config.LOCAL_HTTP_PASSWORD))
+        except requests.RequestException as error:
+            config.LOGGER.warning(f"Failed to request prefetch for patient {prefetch_request['PatientID']}: {error}")
+
+    def _store_presence_summary(self, name=None):
+        """
+        Hand the presence summary of a peer to the local orthanc.
+
+        :param name: name to store the summary under, default is the name sent by the peer
+        """
+        summary = dict(self.content)
+        if name is not None:
+            summary["Name"] = name
+        local_url = f"http://localhost:{config.LOCAL_HTTP_PORT}"
+        try:
+            helpers.post_data(f"{local_url}/curapacs/summaries", summary,
+                              session=helpers.get_session(local_url, config.LOCAL_HTTP_USER,
+                                                          config.LOCAL_HTTP_PASSWORD))
+        except requests.RequestException as error:
+            config.LOGGER.warning(f"Failed to store presence summary of {summary.get('Name')}: {error}")
 
     def parse_by_type(self):
         if self.type == "new_worklist":
             self._get_new_worklist()
+        elif self.type == "new_worklists":
+            self._get_new_worklists()
+        elif self.type == "presence_summary":
+            if config.PARENT_NAME:
+                # a site is only connected to its parent
+                self._store_presence_summary(name=config.PEER_NAME)
+            else:
+                config.LOGGER.debug(f"Ignoring presence summary of site {self.content.get('Name')}.")
         else:
             pass
 
@@ -60,7 +139,9 @@ async def producer_handler(websocket, path):
 
 async def consumer_handler(websocket, path):
     async for message in websocket:
-        print("MESSAGE RECEIVED: " + message)
+        config.LOGGER.debug(f"Websocket server received message of {len(message)} bytes.")
+        # parsing requests the local orthanc, which must not stall the event loop
+        await asyncio.get_event_loop().run_in_executor(None, OrthancMessage(message).parse_by_type)
     print("consumer_handler returns")
 
 async def OrthancUnixSocketHandler(reader, writer):
@@ -82,11 +163,12 @@ async def OrthancMessageHandlerClient(uri):
         try:
             config.LOGGER.debug(f"Websocket client connecting to {uri}")
             async with websockets.connect(uri, extra_headers=[auth_header], 
-                                        ping_interval=config.LOCAL_WS_KEEPALIVE_INTERVAL) as websocket_client:
+                                        ping_interval=config.LOCAL_WS_KEEPALIVE_INTERVAL,
+                                        max_size=config.WEBSOCKET_MAX_MESSAGE_SIZE) as websocket_client:
                 async for message in websocket_client:
-                    config.LOGGER.debug(f"Websocket client received message: {message}")
+                    config.LOGGER.debug(f"Websocket client received message of {len(message)} bytes.")
                     parser = OrthancMessage(message)
-                    parser.parse_by_type()
+                    await asyncio.get_event_loop().run_in_executor(None, parser.parse_by_type)
         except (websockets.exceptions.ConnectionClosedError, websockets.exceptions.InvalidStatusCode):
             config.LOGGER.info(f"Websocket connection terminated, retrying...")
             await asyncio.sleep(5)
@@ -116,7 +198,8 @@ event_loop = asyncio.get_event_loop()
 
 if not config.PARENT_NAME:
     config.LOGGER.info("Starting websocket server.")
-    websocket_server = websockets.serve(OrthancMessageHandler, "0.0.0.0", config.LOCAL_WS_PORT)
+    websocket_server = websockets.serve(OrthancMessageHandler, "0.0.0.0", config.LOCAL_WS_PORT,
+                                        max_size=config.WEBSOCKET_MAX_MESSAGE_SIZE)
     event_loop.run_until_complete(websocket_server)
 else:
     config.LOGGER.info("Starting websocket client.")
@@ -0,0 +1,163 @@
+import time
+import threading
+from collections import OrderedDict
+from curapacs_python import config
+
+
+class PeerStoreQueue:
+    """
+    Collects instance IDs and hands them to store_function in batches, so that a new
+    series results in a few store jobs instead of one job per instance.
+    A batch is flushed once batch_size instances are queued, once the oldest queued
+    instance waited flush_interval seconds, or when requestFlush is called.
+    Batches are not grouped by series: instances arrive in series order, and a stable series
+    requests a flush, so a series mostly ends up in batches of its own.
+    Instances are queued per priority, batches of the highest priority are sent first. A
+    priority is raised by one for every aging_interval seconds its oldest instance has waited,
+    so that a steady stream of urgent instances does not starve the others.
+
+    :param store_function: called with list of instance IDs, priority and their size in bytes
+    """
+
+    def __init__(self, store_function, batch_size=config.STORE_BATCH_SIZE,
+                 flush_interval=config.STORE_FLUSH_INTERVAL, aging_interval=config.REPLICATION_AGING_INTERVAL):
+        self.store_function = store_function
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.aging_interval = aging_interval
+        self._pending = {}
+        self._pending_count = 0
+        self._condition = threading.Condition()
+        self._flush_requested = False
+        self._worker = None
+        self.instances_queued = 0
+        self.duplicates_dropped = 0
+        self.jobs_started = 0
+        self.instances_sent = 0
+        self.failed_flushes = 0
+        self.last_flush_latency = 0
+        self.max_flush_latency = 0
+
+    def __len__(self):
+        return self._pending_count
+
+    def __contains__(self, instance_id):
+        return any(instance_id in pending for pending in self._pending.values())
+
+    def put(self, instance_id: str, priority=0, size=0):
+        """
+        Queue an instance for upload, IDs already waiting in the queue are dropped.
+
+        :param priority: higher priorities are sent first
+        :param size: size of the instance in bytes
+        """
+        with self._condition:
+            if instance_id in self:
+                self.duplicates_dropped += 1
+                return
+            self._pending.setdefault(priority, OrderedDict())[instance_id] = (time.monotonic(), size)
+            self._pending_count += 1
+            self.instances_queued += 1
+            if self._worker is None:
+                self._worker = threading.Thread(target=self.run, name="curapacs-store-queue", daemon=True)
+                self._worker.start()
+            #wake the worker to start the flush timer, or because a batch is complete
+            if self._pending_count == 1 or len(self._pending[priority]) == self.batch_size:
+                self._condition.notify()
+
+    def requestFlush(self):
+        """
+        Send everything queued right away, e.g. when a series became stable.
+        """
+        with self._condition:
+            if self._pending_count:
+                self._flush_requested = True
+                self._condition.notify()
+
+    def getOldestEnqueueTime(self):
+        return min(next(iter(pending.values()))[0] for pending in self._pending.values())
+
+    def getAgedPriority(self, priority, now):
+        """
+        :returns: priority raised by the time the oldest instance queued with it waited
+        """
+        if not self.aging_interval:
+            return priority
+        oldest_enqueue_time = next(iter(self._pending[priority].values()))[0]
+        return priority + int((now - oldest_enqueue_time) / self.aging_interval)
+
+    def takeBatch(self):
+        """
+        Block until a batch is due, then remove it from the queue.
+
+        :returns: tuple of list of instance IDs, their priority, their size in bytes
+                  and enqueue time of the oldest instance
+        """
+        with self._condition:
+            while True:
+                if self._pending_count:
+                    waiting_time = time.monotonic() - self.getOldestEnqueueTime()
+                    if self._flush_requested or waiting_time >= self.flush_interval or \
+                       any(len(pending) >= self.batch_size for pending in self._pending.values()):
+                        break
+                    self._condition.wait(timeout=self.flush_interval - waiting_time)
+                else:
+                    self._condition.wait()
+            now = time.monotonic()
+            priority = max(self._pending, key=lambda priority: (self.getAgedPriority(priority, now), priority))
+            pending = self._pending[priority]
+            batch = []
+            batch_size_bytes = 0
+            oldest_enqueue_time = next(iter(pending.values()))[0]
+            while pending and len(batch) < self.batch_size:
+                instance_id, (_, size) = pending.popitem(last=False)
+                batch.append(instance_id)
+                batch_size_bytes += size
+            if not pending:
+                del self._pending[priority]
+            self._pending_count -= len(batch)
+            if not self._pending_count:
+                self._flush_requested = False
+        return batch, priority, batch_size_bytes, oldest_enqueue_time
+
+    def run(self):
+        while True:
+            batch, priority, batch_size_bytes, oldest_enqueue_time = self.takeBatch()
+            try:
+                self.store_function(batch, priority, batch_size_bytes)
+            except Exception as error:
+                self.failed_flushes += 1
+                config.LOGGER.error(f"Failed to store batch of {len(batch)} instances on peer: {error}")
+                continue
+            self.jobs_started += 1
+            self.instances_sent += len(batch)
+            self.last_flush_latency = time.monotonic() - oldest_enqueue_time
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+    def getQueuedBatches(self):
+        """
+        :returns: list of dicts describing the instances waiting per priority
+        """
+        with self._condition:
+            now = time.monotonic()
+            return [{"Priority": priority,
+                     "AgedPriority": self.getAgedPriority(priority, now),
+                     "Instances": len(pending),
+                     "Bytes": sum(size for _, size in pending.values())}
+                    for priority, pending in sorted(self._pending.items(), reverse=True)]
+
+    def getStatistics(self):
+        """
+        :returns: dict of queue metrics, as served by the REST API
+        """
+        return {"QueueDepth": self._pending_count,
+                "BatchSize": self.batch_size,
+                "FlushInterval": self.flush_interval,
+                "AgingInterval": self.aging_interval,
+                "InstancesQueued": self.instances_queued,
+                "DuplicatesDropped": self.duplicates_dropped,
+                "JobsStarted": self.jobs_started,
+                "InstancesSent": self.instances_sent,
+                "FailedFlushes": self.failed_flushes,
+                "LastFlushLatency": self.last_flush_latency,
+                "MaxFlushLatency": self.max_flush_latency}
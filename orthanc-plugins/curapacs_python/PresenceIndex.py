@@ -0,0 +1,343 @@
+import time
+import hashlib
+import sqlite3
+import threading
+import requests
+from curapacs_python import config
+from curapacs_python.helpers import get_data
+
+
+class PresenceIndex:
+    """
+    Index of the resources stored on an orthanc, kept current by tailing its /changes feed.
+    Resources are kept with level, DICOM UID and parent in SQLite together with the sequence
+    number of the last processed change, so only the initial build lists the whole archive.
+    Lookups by orthanc ID or UID are single index lookups.
+
+    UIDs and parents of new instances are filled in once their series is stable,
+    which needs one request per series instead of one per instance.
+
+    The resources also form a digest tree for anti-entropy: an instance's digest is the
+    MD5 of its ID, every other resource combines the digests of its children by XOR.
+    Digests are stored and reset along the parent chain of every change, so only
+    the branches that changed are recomputed.
+    """
+    uid_keywords_for_level = {
+        "patient": "PatientID",
+        "study": "StudyInstanceUID",
+        "series": "SeriesInstanceUID",
+        "instance": "SOPInstanceUID"
+    }
+    parent_keys_for_level = {
+        "study": "ParentPatient",
+        "series": "ParentStudy",
+        "instance": "ParentSeries"
+    }
+    new_resource_changes = {
+        "NewPatient": "patient",
+        "NewStudy": "study",
+        "NewSeries": "series",
+        "NewInstance": "instance"
+    }
+
+    def __init__(self, orthanc_host, path=config.PRESENCE_INDEX_PATH, poll_interval=config.PRESENCE_POLL_INTERVAL,
+                 page_size=config.PRESENCE_PAGE_SIZE):
+        self.orthanc_host = orthanc_host
+        self.path = path
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._worker = None
+        self._generation = 0
+        self.changes_processed = 0
+        self.last_update = None
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS resources ("
+                                 "id TEXT PRIMARY KEY, "
+                                 "level TEXT NOT NULL, "
+                                 "uid TEXT, "
+                                 "parent TEXT, "
+                                 "digest TEXT)")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(resources)")]
+        if "digest" not in columns:
+            self._connection.execute("ALTER TABLE resources ADD COLUMN digest TEXT")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS resources_uid ON resources (uid)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS resources_parent ON resources (parent)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)")
+
+    def execute(self, statement, parameters=()):
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def executeTransaction(self, statements, last_sequence=None):
+        """
+        Run (statement, parameters) tuples in one transaction, optionally storing last_sequence with them.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                for statement, parameters in statements:
+                    self._connection.execute(statement, parameters)
+                self._generation += 1
+                if last_sequence is not None:
+                    self._connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('last_sequence', ?)",
+                                             (last_sequence,))
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    @property
+    def last_sequence(self):
+        rows = self.execute("SELECT value FROM state WHERE key = 'last_sequence'")
+        return rows[0][0] if rows else None
+
+    @property
+    def is_ready(self):
+        return self.last_sequence is not None
+
+    def contains(self, resource_id: str):
+        return bool(self.execute("SELECT 1 FROM resources WHERE id = ?", (resource_id,)))
+
+    def containsUID(self, uid: str, level=None):
+        """
+        :param level: "patient", "study", "series" or "instance", None for any level
+        """
+        if level is None:
+            return bool(self.execute("SELECT 1 FROM resources WHERE uid = ?", (uid,)))
+        return bool(self.execute("SELECT 1 FROM resources WHERE uid = ? AND level = ?", (uid, level)))
+
+    def iterResourceIDs(self):
+        """
+        Generator over the IDs of all indexed resources, read in pages to keep memory flat.
+        """
+        last_id = ""
+        while True:
+            rows = self.execute("SELECT id FROM resources WHERE id > ? ORDER BY id LIMIT ?", (last_id, self.page_size))
+            for row in rows:
+                yield row[0]
+            if len(rows) < self.page_size:
+                break
+            last_id = rows[-1][0]
+
+    def getParentID(self, resource_id: str):
+        """
+        :returns: ID of the parent of resource_id, None if it is not indexed (yet)
+        """
+        rows = self.execute("SELECT parent FROM resources WHERE id = ?", (resource_id,))
+        return rows[0][0] if rows else None
+
+    def getChildIDs(self, resource_id: str):
+        return [row[0] for row in self.execute("SELECT id FROM resources WHERE parent = ?", (resource_id,))]
+
+    def getSeriesIDs(self, resource: dict):
+        """
+        :param resource: dict of an orthanc resource, containing keys "Type" and "ID"
+        :returns: IDs of the indexed series below (or above, for instances) resource
+        """
+        if resource["Type"] == "Series":
+            return [resource["ID"]]
+        if resource["Type"] == "Instance":
+            return [row[0] for row in self.execute("SELECT parent FROM resources WHERE id = ? AND parent IS NOT NULL",
+                                                   (resource["ID"],))]
+        series_ids = self.getChildIDs(resource["ID"])
+        if resource["Type"] == "Patient":
+            series_ids = [series_id for study_id in series_ids for series_id in self.getChildIDs(study_id)]
+        return series_ids
+
+    @staticmethod
+    def getInvalidateStatement(resource_id: str):
+        """
+        :returns: (statement, parameters) tuple resetting the digests of all ancestors of resource_id
+        """
+        return ("WITH RECURSIVE ancestors(id) AS ("
+                "SELECT parent FROM resources WHERE id = ? AND parent IS NOT NULL "
+                "UNION SELECT resources.parent FROM resources JOIN ancestors ON resources.id = ancestors.id "
+                "WHERE resources.parent IS NOT NULL) "
+                "UPDATE resources SET digest = NULL WHERE id IN ancestors", (resource_id,))
+
+    @staticmethod
+    def combineDigests(child_digests):
+        """
+        :param child_digests: iterable of (child_id, child_digest) tuples
+        :returns: hex digest, independent of the order of the children
+        """
+        combined = 0
+        for child_id, child_digest in child_digests:
+            combined ^= int(hashlib.md5(f"{child_id}:{child_digest}".encode()).hexdigest(), 16)
+        return f"{combined:032x}"
+
+    def getDigest(self, resource_id: str):
+        """
+        :returns: hex digest of the subtree of resource_id, None if it is not indexed
+        """
+        rows = self.execute("SELECT level, digest FROM resources WHERE id = ?", (resource_id,))
+        if not rows:
+            return None
+        level, digest = rows[0]
+        if level == "instance":
+            return hashlib.md5(resource_id.encode()).hexdigest()
+        if digest is None:
+            with self._lock:
+                generation = self._generation
+            digest = PresenceIndex.combineDigests(self.getChildDigests(resource_id).items())
+            with self._lock:
+                # a change applied meanwhile may have made the digest stale, it is recomputed next time
+                if generation == self._generation:
+                    self._connection.execute("UPDATE resources SET digest = ? WHERE id = ?", (digest, resource_id))
+        return digest
+
+    def getChildDigests(self, resource_id=None):
+        """
+        :param resource_id: orthanc ID, None for the root, whose children are the patients
+        :returns: dict of child ID -> digest
+        """
+        if resource_id is None:
+            child_ids = [row[0] for row in self.execute("SELECT id FROM resources WHERE level = 'patient'")]
+        else:
+            child_ids = self.getChildIDs(resource_id)
+        return {child_id: self.getDigest(child_id) for child_id in child_ids}
+
+    def getDigestNode(self, resource_id=None, child_ids=None):
+        """
+        :param resource_id: orthanc ID, None for the root
+        :param child_ids: IDs of the children to cover, e.g. those another orthanc holds of resource_id,
+                          None for all children
+        :returns: dict with the digest of resource_id over the children covered and the digests of
+                  these children, None if resource_id is not indexed
+        """
+        if resource_id is not None and self.getDigest(resource_id) is None:
+            return None
+        child_digests = self.getChildDigests(resource_id)
+        if child_ids is not None:
+            child_digests = {child_id: child_digests[child_id] for child_id in child_ids if child_id in child_digests}
+        if resource_id is None or child_ids is not None:
+            digest = PresenceIndex.combineDigests(child_digests.items())
+        else:
+            digest = self.getDigest(resource_id)
+        level = "root" if resource_id is None else self.execute("SELECT level FROM resources WHERE id = ?",
+                                                                (resource_id,))[0][0]
+        return {"ID": resource_id, "Level": level, "Digest": digest, "Children": child_digests}
+
+    def getInstanceIDs(self, resource_id: str):
+        """
+        :returns: IDs of the indexed instances of resource_id and below
+        """
+        rows = self.execute("WITH RECURSIVE descendants(id, level) AS ("
+                            "SELECT id, level FROM resources WHERE id = ? "
+                            "UNION SELECT resources.id, resources.level FROM resources "
+                            "JOIN descendants ON resources.parent = descendants.id) "
+                            "SELECT id FROM descendants WHERE level = 'instance'", (resource_id,))
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def getIndexStatement(resource: dict, level: str):
+        """
+        :param resource: expanded orthanc resource dict
+        :returns: (statement, parameters) tuple inserting or updating resource
+        """
+        uid = resource.get("MainDicomTags", {}).get(PresenceIndex.uid_keywords_for_level[level])
+        parent = resource.get(PresenceIndex.parent_keys_for_level.get(level))
+        return ("INSERT OR REPLACE INTO resources (id, level, uid, parent) VALUES (?, ?, ?, ?)",
+                (resource["ID"], level, uid, parent))
+
+    def build(self):
+        """
+        Index every resource of the orthanc, page by page, then continue from the
+        change that was the latest before the listing started.
+        """
+        changes, _ = self.orthanc_host.requestData(get_data, f"{self.orthanc_host.url}/changes?last")
+        last_sequence = changes.get("Last", 0)
+        config.LOGGER.info(f"Building presence index of {self.orthanc_host.url} up to change {last_sequence}")
+        self.executeTransaction([("DELETE FROM resources", ())])
+        for level, subpath in [("patient", "patients"), ("study", "studies"),
+                               ("series", "series"), ("instance", "instances")]:
+            since = 0
+            while True:
+                page, _ = self.orthanc_host.requestData(
+                    get_data, f"{self.orthanc_host.url}/{subpath}?expand&since={since}&limit={self.page_size}")
+                self.executeTransaction([PresenceIndex.getIndexStatement(resource, level) for resource in page])
+                if len(page) < self.page_size:
+                    break
+                since += len(page)
+        self.executeTransaction([], last_sequence=last_sequence)
+        config.LOGGER.info(f"Presence index holds {self.getStatistics()['Resources']} resources.")
+
+    def update(self):
+        """
+        Apply all changes since the last processed one.
+
+        :returns: number of changes processed
+        """
+        change_count = 0
+        while True:
+            changes, _ = self.orthanc_host.requestData(
+                get_data, f"{self.orthanc_host.url}/changes?since={self.last_sequence}&limit={self.page_size}")
+            statements = []
+            for change in changes.get("Changes", []):
+                statements.extend(self.getChangeStatements(change))
+            self.executeTransaction(statements, last_sequence=changes["Last"])
+            change_count += len(changes.get("Changes", []))
+            if changes.get("Done", True):
+                break
+        self.changes_processed += change_count
+        self.last_update = time.time()
+        return change_count
+
+    def getChangeStatements(self, change: dict):
+        """
+        :param change: entry of the /changes feed
+        :returns: list of (statement, parameters) tuples applying change to the index
+        """
+        change_type = change["ChangeType"]
+        resource_id = change["ID"]
+        if change_type == "Deleted":
+            return [PresenceIndex.getInvalidateStatement(resource_id),
+                    ("DELETE FROM resources WHERE id = ?", (resource_id,))]
+        if change_type == "NewInstance":
+            return [("INSERT OR IGNORE INTO resources (id, level) VALUES (?, 'instance')", (resource_id,))]
+        try:
+            if change_type in PresenceIndex.new_resource_changes:
+                level = PresenceIndex.new_resource_changes[change_type]
+                resource, _ = self.orthanc_host.requestData(get_data, f"{self.orthanc_host.url}{change['Path']}")
+                return [PresenceIndex.getIndexStatement(resource, level),
+                        PresenceIndex.getInvalidateStatement(resource_id)]
+            if change_type == "StableSeries":
+                instances, _ = self.orthanc_host.requestData(get_data,
+                                                             f"{self.orthanc_host.url}{change['Path']}/instances")
+                return [PresenceIndex.getIndexStatement(instance, "instance") for instance in instances] + \
+                       [PresenceIndex.getInvalidateStatement(instance["ID"]) for instance in instances[:1]]
+        except requests.ConnectionError as error:
+            if error.response is None:
+                raise
+            # deleted in the meantime, a later Deleted change removes it
+        return []
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self.run, name="curapacs-presence-index", daemon=True)
+            self._worker.start()
+
+    def run(self):
+        while True:
+            try:
+                if not self.is_ready:
+                    self.build()
+                self.update()
+            except (requests.RequestException, ValueError, sqlite3.Error) as error:
+                config.LOGGER.error(f"Failed to update presence index of {self.orthanc_host.url}: {error}")
+            time.sleep(self.poll_interval)
+
+    def getStatistics(self):
+        """
+        :returns: dict of index metrics, as served by the REST API
+        """
+        statistics = {"Resources": 0, "patient": 0, "study": 0, "series": 0, "instance": 0}
+        statistics.update(self.execute("SELECT level, COUNT(*) FROM resources GROUP BY level"))
+        statistics["Resources"] = sum(statistics[level] for level in PresenceIndex.uid_keywords_for_level)
+        statistics.update({"LastSequence": self.last_sequence,
+                           "ChangesProcessed": self.changes_processed,
+                           "LastUpdate": self.last_update})
+        return statistics
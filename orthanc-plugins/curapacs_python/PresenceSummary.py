@@ -0,0 +1,139 @@
+import json
+import math
+import time
+import base64
+import hashlib
+import threading
+from curapacs_python import config
+
+
+class BloomFilter:
+    """
+    Compact set of strings without false negatives: "not in" is certain, "in" is wrong
+    with probability error_rate once capacity strings were added. Bit positions are
+    derived from the SHA1 of a string by double hashing, so filters built by any
+    orthanc of the installation can be compared.
+    """
+
+    def __init__(self, capacity=1000, error_rate=config.PRESENCE_SUMMARY_ERROR_RATE, bit_count=None,
+                 hash_count=None, bits=None):
+        capacity = max(capacity, 1)
+        self.bit_count = bit_count or max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = hash_count or max(round(self.bit_count / capacity * math.log(2)), 1)
+        self.bits = bits if bits is not None else bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def getPositions(self, item: str):
+        digest = hashlib.sha1(item.encode()).digest()
+        first_hash = int.from_bytes(digest[:8], "little")
+        second_hash = int.from_bytes(digest[8:16], "little") | 1
+        return [(first_hash + index * second_hash) % self.bit_count for index in range(self.hash_count)]
+
+    def add(self, item: str):
+        for position in self.getPositions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.getPositions(item))
+
+    def toDict(self):
+        return {"BitCount": self.bit_count,
+                "HashCount": self.hash_count,
+                "Count": self.count,
+                "Bits": base64.b64encode(bytes(self.bits)).decode()}
+
+    @classmethod
+    def fromDict(cls, filter_dict: dict):
+        bloom_filter = cls(bit_count=filter_dict["BitCount"], hash_count=filter_dict["HashCount"],
+                           bits=bytearray(base64.b64decode(filter_dict["Bits"])))
+        if len(bloom_filter.bits) * 8 < bloom_filter.bit_count:
+            raise ValueError(f"Bloom filter with {bloom_filter.bit_count} bits has only {len(bloom_filter.bits)} bytes")
+        bloom_filter.count = filter_dict.get("Count", 0)
+        return bloom_filter
+
+
+class PresenceSummaries:
+    """
+    Bloom filters of the orthanc IDs (all levels) held by this orthanc and by its peers.
+    The local summary is rebuilt from a PresenceIndex every interval seconds and handed
+    to publish_function, summaries of peers arrive through put. Only the parent publishes,
+    its sites use its summary to skip uploading what it already holds. A summary larger
+    than max_message_size is not published, since the websocket would refuse it.
+    """
+
+    def __init__(self, presence_index=None, publish_function=None, interval=config.PRESENCE_SUMMARY_INTERVAL,
+                 error_rate=config.PRESENCE_SUMMARY_ERROR_RATE, max_message_size=config.WEBSOCKET_MAX_MESSAGE_SIZE):
+        self.presence_index = presence_index
+        self.publish_function = publish_function
+        self.interval = interval
+        self.error_rate = error_rate
+        self.max_message_size = max_message_size
+        self._summaries = {}
+        self._lock = threading.Lock()
+        self._worker = None
+        self.local_summary = None
+
+    def put(self, name: str, filter_dict: dict):
+        """
+        Store the summary received from peer name, replacing its previous one.
+        """
+        bloom_filter = BloomFilter.fromDict(filter_dict)
+        with self._lock:
+            self._summaries[name] = (bloom_filter, time.time())
+        config.LOGGER.debug(f"Received presence summary of {name} with {bloom_filter.count} resources.")
+
+    def get(self, name: str):
+        """
+        :returns: BloomFilter of peer name, None if it did not send one yet
+        """
+        with self._lock:
+            summary = self._summaries.get(name)
+        return summary[0] if summary else None
+
+    def buildLocalSummary(self):
+        """
+        :returns: BloomFilter of all resources in presence_index
+        """
+        resource_count = self.presence_index.getStatistics()["Resources"]
+        # room for growth until the next rebuild
+        bloom_filter = BloomFilter(capacity=int(resource_count * 1.25) + 1000, error_rate=self.error_rate)
+        for resource_id in self.presence_index.iterResourceIDs():
+            bloom_filter.add(resource_id)
+        return bloom_filter
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self.run, name="curapacs-presence-summary", daemon=True)
+            self._worker.start()
+
+    def run(self):
+        while True:
+            if self.presence_index.is_ready:
+                try:
+                    self.local_summary = self.buildLocalSummary()
+                    summary = {"Name": config.LOCAL_NAME, "Filter": self.local_summary.toDict()}
+                    summary_size = len(json.dumps(summary))
+                    # websocket peers drop messages above max_message_size, along with the connection
+                    if summary_size >= self.max_message_size:
+                        config.LOGGER.error(f"Presence summary of {summary_size} bytes exceeds the websocket " + \
+                                            f"message size of {self.max_message_size} bytes, not publishing it.")
+                    else:
+                        self.publish_function(summary)
+                except Exception as error:
+                    config.LOGGER.error(f"Failed to publish presence summary: {error}")
+            time.sleep(self.interval)
+
+    def getStatistics(self):
+        """
+        :returns: dict describing the local and the received summaries, as served by the REST API
+        """
+        with self._lock:
+            summaries = dict(self._summaries)
+        statistics = {name: {"Resources": bloom_filter.count, "Bytes": len(bloom_filter.bits), "Received": received}
+                      for name, (bloom_filter, received) in summaries.items()}
+        if self.local_summary is not None:
+            statistics[config.LOCAL_NAME] = {"Resources": self.local_summary.count,
+                                             "Bytes": len(self.local_summary.bits),
+                                             "Received": None}
+        return statistics
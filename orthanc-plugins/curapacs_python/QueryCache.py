@@ -0,0 +1,170 @@
+import time
+import fnmatch
+import threading
+from collections import OrderedDict
+from curapacs_python import config
+
+
+class QueryCache:
+    """
+    Thread safe, size bounded LRU cache whose entries expire after ttl seconds.
+    Every entry remembers the orthanc IDs it covers, so it can be dropped
+    as soon as one of those resources changes. Entries a new resource might
+    be added to are dropped by invalidateMatching.
+    """
+    parent_keys = ["ParentPatient", "ParentStudy", "ParentSeries"]
+
+    def __init__(self, max_size=config.QUERY_CACHE_SIZE, ttl=config.QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    @staticmethod
+    def getKey(find_level: str, find_query: dict):
+        """
+        Normalize a find query, so that equivalent C-FIND queries share one cache entry.
+        Surrounding whitespace is ignored and "*" is treated like an empty (universal) match.
+
+        :param find_level: string as returned by OrthancHost.getQueryRetrieveLevel
+        :param find_query: dict as returned by OrthancHost.collateFindQuery
+        :returns: hashable cache key
+        """
+        normalized_query = []
+        for keyword, value in sorted(find_query.items()):
+            value = value.strip() if isinstance(value, str) else value
+            normalized_query.append((keyword, "" if value == "*" else value))
+        return (find_level, tuple(normalized_query))
+
+    @staticmethod
+    def getResourceIDs(resources: list):
+        """
+        Collect IDs of resources and of their parents as found in expanded orthanc resources.
+        """
+        resource_ids = set()
+        for resource in resources:
+            resource_ids.add(resource.get("ID"))
+            resource_ids.update(resource[key] for key in QueryCache.parent_keys if key in resource)
+        resource_ids.discard(None)
+        return resource_ids
+
+    def get(self, key):
+        """
+        :returns: cached value, or None if key is unknown or expired
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, resource_ids=()):
+        """
+        Store value under key, evicting the least recently used entries beyond max_size.
+
+        :param resource_ids: orthanc IDs whose change invalidates this entry
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value, frozenset(resource_ids))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, resource_ids):
+        """
+        Drop every entry covering one of resource_ids.
+
+        :returns: number of entries dropped
+        """
+        resource_ids = set(resource_ids)
+        with self._lock:
+            stale_keys = [key for key, entry in self._entries.items() if entry[2] & resource_ids]
+            for key in stale_keys:
+                del self._entries[key]
+            self.invalidations += len(stale_keys)
+        if stale_keys:
+            config.LOGGER.debug(f"Invalidated {len(stale_keys)} cached queries for resources {resource_ids}")
+        return len(stale_keys)
+
+    @staticmethod
+    def matchesValue(query_value, tag_value):
+        """
+        Loose version of the dicom matching rules, wildcards (*, ?), ranges (a-b) and lists of UIDs (a\\b),
+        case insensitive. Errs on the side of a match, so that no stale entry survives.
+        """
+        if not isinstance(query_value, str) or not isinstance(tag_value, str) or not query_value:
+            return True
+        query_value, tag_value = query_value.casefold(), tag_value.strip().casefold()
+        for value in query_value.split("\\"):
+            if fnmatch.fnmatchcase(tag_value, value.replace("[", "[[]")):
+                return True
+            if value.count("-") == 1:
+                range_start, range_end = value.split("-")
+                if (not range_start or range_start <= tag_value) and (not range_end or tag_value <= range_end):
+                    return True
+        return False
+
+    @staticmethod
+    def matchesQuery(key, tags: dict):
+        """
+        :param key: cache key as returned by getKey
+        :param tags: dict of keywords and values of a resource (main dicom tags of it and its parents)
+        :returns: True if the query of key might match the resource, keywords missing from tags match anything
+        """
+        return all(keyword not in tags or QueryCache.matchesValue(value, tags[keyword]) for keyword, value in key[1])
+
+    def invalidateMatching(self, tags: dict):
+        """
+        Drop every entry whose query might match a new resource with tags, cached (partial or empty)
+        results of such a query lack the new resource.
+
+        :returns: number of entries dropped
+        """
+        with self._lock:
+            stale_keys = [key for key in self._entries if self.matchesQuery(key, tags)]
+            for key in stale_keys:
+                del self._entries[key]
+            self.invalidations += len(stale_keys)
+        if stale_keys:
+            config.LOGGER.debug(f"Invalidated {len(stale_keys)} cached queries matching a new resource")
+        return len(stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def getStatistics(self):
+        """
+        :returns: dict of cache counters, as served by the REST API
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"Size": len(self._entries),
+                    "MaxSize": self.max_size,
+                    "TTL": self.ttl,
+                    "Hits": self.hits,
+                    "Misses": self.misses,
+                    "HitRatio": self.hits / lookups if lookups else 0,
+                    "Evictions": self.evictions,
+                    "Invalidations": self.invalidations}
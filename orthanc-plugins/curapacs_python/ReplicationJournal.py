@@ -0,0 +1,328 @@
+import time
+import queue
+import sqlite3
+import threading
+from curapacs_python import config
+from curapacs_python.PeerStoreQueue import PeerStoreQueue
+
+
+class ReplicationJournal:
+    """
+    SQLite journal of instances that still have to be uploaded to the peer.
+    An instance is "queued" until its store job was started, "sending" while
+    the job runs and "retry" after the job failed. Finished instances are removed.
+    Priority and size of every instance are kept, so a restart keeps the scheduling order.
+    """
+    QUEUED = "queued"
+    SENDING = "sending"
+    RETRY = "retry"
+    max_retry_delay = 3600
+
+    def __init__(self, path=config.REPLICATION_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        #WAL with synchronous=NORMAL survives a crash of the orthanc process without an fsync per insert
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS pending_instances ("
+                                 "instance_id TEXT PRIMARY KEY, "
+                                 "state TEXT NOT NULL, "
+                                 "job_id TEXT, "
+                                 "attempts INTEGER NOT NULL DEFAULT 0, "
+                                 "next_attempt REAL NOT NULL DEFAULT 0, "
+                                 "added REAL NOT NULL, "
+                                 "priority INTEGER NOT NULL DEFAULT 0, "
+                                 "size INTEGER NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(pending_instances)")]
+        for column in ["priority", "size"]:
+            if column not in columns:
+                self._connection.execute(f"ALTER TABLE pending_instances ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS pending_instances_job_id "
+                                 "ON pending_instances (job_id)")
+
+    def execute(self, statement, parameters=()):
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def executemany(self, statement, parameters):
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(statement, parameters)
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def add(self, instances):
+        """
+        Record instances as queued, instances already in the journal are left alone.
+
+        :param instances: list of (instance_id, priority, size) tuples
+        """
+        now = time.time()
+        self.executemany("INSERT OR IGNORE INTO pending_instances (instance_id, state, added, priority, size) " + \
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(instance_id, ReplicationJournal.QUEUED, now, priority, size)
+                          for instance_id, priority, size in instances])
+
+    def setPriority(self, instance_id, priority, size):
+        self.execute("UPDATE pending_instances SET priority = ?, size = ? WHERE instance_id = ?",
+                     (priority, size, instance_id))
+
+    def markQueued(self, instance_ids):
+        self.executemany("UPDATE pending_instances SET state = ?, job_id = NULL WHERE instance_id = ?",
+                         [(ReplicationJournal.QUEUED, instance_id) for instance_id in instance_ids])
+
+    def markSending(self, instance_ids, job_id):
+        self.executemany("UPDATE pending_instances SET state = ?, job_id = ? WHERE instance_id = ?",
+                         [(ReplicationJournal.SENDING, job_id, instance_id) for instance_id in instance_ids])
+
+    def markDone(self, job_id):
+        self.execute("DELETE FROM pending_instances WHERE job_id = ?", (job_id,))
+
+    def remove(self, instance_ids):
+        self.executemany("DELETE FROM pending_instances WHERE instance_id = ?",
+                         [(instance_id,) for instance_id in instance_ids])
+
+    def markFailed(self, instance_ids=None, job_id=None, backoff=config.REPLICATION_RETRY_BACKOFF):
+        """
+        Schedule a retry for the instances of a failed job (or given instance_ids),
+        the delay doubles with every failed attempt.
+        """
+        now = time.time()
+        statement = "UPDATE pending_instances SET state = ?, job_id = NULL, attempts = attempts + 1, " + \
+                    "next_attempt = ? + MIN(? * (1 << MIN(attempts, 16)), ?) WHERE "
+        parameters = [ReplicationJournal.RETRY, now, backoff, ReplicationJournal.max_retry_delay]
+        if job_id is not None:
+            self.execute(statement + "job_id = ?", parameters + [job_id])
+        else:
+            self.executemany(statement + "instance_id = ?",
+                             [parameters + [instance_id] for instance_id in instance_ids])
+
+    def getInstancesInState(self, state):
+        """
+        :returns: list of (instance_id, priority, size) tuples
+        """
+        return self.execute("SELECT instance_id, priority, size FROM pending_instances WHERE state = ? " + \
+                            "ORDER BY added", (state,))
+
+    def getPendingInstanceIDs(self, instance_ids, chunk_size=500):
+        """
+        :returns: list of the IDs among instance_ids that are still in the journal
+        """
+        instance_ids = list(instance_ids)
+        pending_instance_ids = []
+        for start in range(0, len(instance_ids), chunk_size):
+            chunk = instance_ids[start:start + chunk_size]
+            rows = self.execute("SELECT instance_id FROM pending_instances " + \
+                                f"WHERE instance_id IN ({', '.join('?' * len(chunk))})", chunk)
+            pending_instance_ids.extend(row[0] for row in rows)
+        return pending_instance_ids
+
+    def getInstancesDueForRetry(self):
+        """
+        :returns: list of (instance_id, priority, size) tuples
+        """
+        return self.execute("SELECT instance_id, priority, size FROM pending_instances " + \
+                            "WHERE state = ? AND next_attempt <= ? ORDER BY added",
+                            (ReplicationJournal.RETRY, time.time()))
+
+    def getRunningJobs(self):
+        """
+        :returns: list of (job_id, priority, instance count, size) tuples
+        """
+        return self.execute("SELECT job_id, MAX(priority), COUNT(*), SUM(size) FROM pending_instances " + \
+                            "WHERE state = ? GROUP BY job_id", (ReplicationJournal.SENDING,))
+
+    def getStatistics(self):
+        statistics = {ReplicationJournal.QUEUED: 0, ReplicationJournal.SENDING: 0, ReplicationJournal.RETRY: 0}
+        statistics.update(self.execute("SELECT state, COUNT(*) FROM pending_instances GROUP BY state"))
+        return statistics
+
+
+class ReplicationSender:
+    """
+    Uploads instances to the peer. Every instance is recorded in the journal before it
+    is queued and only removed once the orthanc job that uploaded it succeeded, so a
+    restart resumes where it stopped. At most max_jobs store jobs run at the same time,
+    their start is paced by scheduler if one is given.
+
+    :param store_function: callable starting a store job for a list of instance IDs and a
+                           job priority, returns job ID
+    :param job_state_function: callable returning the state of an orthanc job, None if it is unknown
+    :param scheduler: ReplicationScheduler
+    :param presence_function: callable returning the instance IDs among a list that the peer
+                              already holds, these are not sent
+    :param lookup_function: callable returning priority and size of an instance ID, called by a
+                            worker thread for instances put without priority
+    """
+
+    def __init__(self, journal, store_function, job_state_function, scheduler=None, presence_function=None,
+                 lookup_function=None, max_jobs=config.REPLICATION_MAX_JOBS,
+                 poll_interval=config.REPLICATION_POLL_INTERVAL):
+        self.journal = journal
+        self.store_function = store_function
+        self.job_state_function = job_state_function
+        self.scheduler = scheduler
+        self.presence_function = presence_function
+        self.lookup_function = lookup_function
+        self._lookups = queue.Queue()
+        self._lookup_worker = None
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.store_queue = PeerStoreQueue(self.storeBatch)
+        self._running_jobs = {}
+        self._jobs_condition = threading.Condition()
+        self._worker = None
+        self.jobs_succeeded = 0
+        self.jobs_failed = 0
+        self.instances_skipped = 0
+        self.failed_lookups = 0
+
+    def put(self, instance_id: str, priority=None, size=0):
+        """
+        Record instance_id in the journal and queue it. Without priority, priority and size are
+        looked up by the lookup worker first, so that the caller (e.g. the change callback) does not wait for them.
+
+        :param priority: priority of the store job, see ReplicationScheduler.getPriority
+        :param size: size of the instance in bytes
+        """
+        if priority is None and self.lookup_function is not None:
+            self.journal.add([(instance_id, 0, size)])
+            self._lookups.put(instance_id)
+            if self._lookup_worker is None:
+                self._lookup_worker = threading.Thread(target=self.runLookups, name="curapacs-replication-lookup",
+                                                       daemon=True)
+                self._lookup_worker.start()
+        else:
+            priority = priority or 0
+            self.journal.add([(instance_id, priority, size)])
+            self.store_queue.put(instance_id, priority, size)
+        self.start()
+
+    def runLookups(self):
+        while True:
+            instance_id = self._lookups.get()
+            try:
+                priority, size = self.lookup_function(instance_id)
+                self.journal.setPriority(instance_id, priority, size)
+            except Exception as error:
+                # e.g. deleted in the meantime, the store job will tell
+                config.LOGGER.warning(f"Failed to look up instance {instance_id} for replication: {error}")
+                self.failed_lookups += 1
+                priority, size = 0, 0
+            self.store_queue.put(instance_id, priority, size)
+
+    def storeBatch(self, instance_ids, priority, size):
+        """
+        Start a store job for instance_ids, waiting while max_jobs jobs are running
+        and, if there is a scheduler, until size bytes fit into the rate limit.
+        Called by the worker thread of store_queue.
+        """
+        if self.presence_function is not None:
+            present_instance_ids = set(self.presence_function(instance_ids))
+            if present_instance_ids:
+                config.LOGGER.debug(f"Peer already holds {len(present_instance_ids)} of {len(instance_ids)} " + \
+                                    f"instances, not sending them.")
+                self.journal.remove(present_instance_ids)
+                self.instances_skipped += len(present_instance_ids)
+                instance_ids = [instance_id for instance_id in instance_ids if instance_id not in present_instance_ids]
+                if not instance_ids:
+                    return
+        with self._jobs_condition:
+            while len(self._running_jobs) >= self.max_jobs:
+                self._jobs_condition.wait()
+        if self.scheduler is not None:
+            self.scheduler.waitForBandwidth(size)
+        try:
+            job_id = self.store_function(instance_ids, priority)
+        except Exception:
+            self.journal.markFailed(instance_ids=instance_ids)
+            raise
+        self.journal.markSending(instance_ids, job_id)
+        with self._jobs_condition:
+            self._running_jobs[job_id] = {"ID": job_id, "Priority": priority, "Instances": len(instance_ids),
+                                          "Bytes": size, "Started": time.time()}
+
+    def resume(self):
+        """
+        Queue everything the journal holds from before a restart and start polling jobs.
+        """
+        running_jobs = self.journal.getRunningJobs()
+        with self._jobs_condition:
+            for job_id, priority, instance_count, size in running_jobs:
+                self._running_jobs[job_id] = {"ID": job_id, "Priority": priority, "Instances": instance_count,
+                                              "Bytes": size, "Started": None}
+        queued_instances = self.journal.getInstancesInState(ReplicationJournal.QUEUED)
+        config.LOGGER.info(f"Resuming replication of {len(queued_instances)} queued instances, " + \
+                           f"{len(running_jobs)} running jobs.")
+        for instance_id, priority, size in queued_instances:
+            self.store_queue.put(instance_id, priority, size)
+        self.start()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self.run, name="curapacs-replication", daemon=True)
+            self._worker.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.checkRunningJobs()
+                self.requeueFailedInstances()
+            except Exception as error:
+                config.LOGGER.error(f"Replication sender failed to process journal: {error}")
+
+    def checkRunningJobs(self):
+        """
+        Remove instances of succeeded jobs from the journal, schedule retries for failed ones.
+        """
+        with self._jobs_condition:
+            running_jobs = list(self._running_jobs)
+        for job_id in running_jobs:
+            job_state = self.job_state_function(job_id)
+            if job_state == "Success":
+                self.journal.markDone(job_id)
+                self.jobs_succeeded += 1
+            elif job_state in ("Failure", None):
+                config.LOGGER.warning(f"Store job {job_id} ended in state {job_state}, scheduling retry.")
+                self.journal.markFailed(job_id=job_id)
+                self.jobs_failed += 1
+            else:
+                continue
+            with self._jobs_condition:
+                self._running_jobs.pop(job_id, None)
+                self._jobs_condition.notify_all()
+
+    def requeueFailedInstances(self):
+        instances = self.journal.getInstancesDueForRetry()
+        if not instances:
+            return
+        config.LOGGER.debug(f"Retrying upload of {len(instances)} instances.")
+        self.journal.markQueued([instance_id for instance_id, _, _ in instances])
+        for instance_id, priority, size in instances:
+            self.store_queue.put(instance_id, priority, size)
+
+    def getStatistics(self):
+        """
+        :returns: dict of replication metrics, as served by the REST API
+        """
+        statistics = self.store_queue.getStatistics()
+        with self._jobs_condition:
+            running_jobs = list(self._running_jobs.values())
+        statistics.update({"Journal": self.journal.getStatistics(),
+                           "Queue": self.store_queue.getQueuedBatches(),
+                           "RunningJobs": running_jobs,
+                           "MaxJobs": self.max_jobs,
+                           "JobsSucceeded": self.jobs_succeeded,
+                           "JobsFailed": self.jobs_failed,
+                           "InstancesSkipped": self.instances_skipped,
+                           "PendingLookups": self._lookups.qsize(),
+                           "FailedLookups": self.failed_lookups})
+        if self.scheduler is not None:
+            statistics.update({"RateLimit": self.scheduler.getRateLimit(),
+                               "RateLimitDelay": self.scheduler.total_delay})
+        return statistics
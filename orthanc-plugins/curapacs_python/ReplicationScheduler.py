@@ -0,0 +1,95 @@
+import time
+import datetime
+import threading
+from curapacs_python import config
+
+
+class ReplicationScheduler:
+    """
+    Assigns priorities to instances waiting for replication and paces the start of store
+    jobs to the rate limit of the current time of day. Orthanc sends each job at full
+    speed, so the limit is kept on average: after a job of n bytes, the next job
+    starts n / rate_limit seconds later.
+
+    rate_windows is a list of dicts like {"From": "07:00", "To": "18:00", "BytesPerSecond": 1000000},
+    outside of all windows rate_limit applies. A limit of 0 means unlimited.
+    """
+    PRIORITY_CURRENT_DAY = 2
+    PRIORITY_RECENT = 1
+    PRIORITY_BACKFILL = 0
+
+    def __init__(self, rate_limit=config.REPLICATION_RATE_LIMIT, rate_windows=config.REPLICATION_RATE_WINDOWS,
+                 recent_days=config.REPLICATION_RECENT_DAYS):
+        self.rate_limit = rate_limit
+        self.rate_windows = [(ReplicationScheduler.parseTimeOfDay(window["From"]),
+                              ReplicationScheduler.parseTimeOfDay(window["To"]),
+                              int(window["BytesPerSecond"])) for window in rate_windows]
+        self.recent_days = recent_days
+        self._next_start_time = 0
+        self._lock = threading.Lock()
+        self.total_delay = 0
+
+    @staticmethod
+    def parseTimeOfDay(time_string: str):
+        """
+        :param time_string: time of day as "HH:MM"
+        :returns: datetime.time
+        """
+        try:
+            return datetime.datetime.strptime(time_string, "%H:%M").time()
+        except ValueError:
+            config.LOGGER.error(f"Invalid time of day in replication rate window: {time_string}")
+            raise
+
+    def getRateLimit(self, now=None):
+        """
+        :returns: rate limit in bytes per second valid at now (default: current local time)
+        """
+        time_of_day = (now or datetime.datetime.now()).time()
+        for window_start, window_end, rate_limit in self.rate_windows:
+            if window_start <= window_end:
+                in_window = window_start <= time_of_day < window_end
+            else:
+                in_window = time_of_day >= window_start or time_of_day < window_end
+            if in_window:
+                return rate_limit
+        return self.rate_limit
+
+    def getPriority(self, study_date: str, today=None):
+        """
+        Studies of today are sent first, then studies of the last recent_days, then everything else.
+
+        :param study_date: StudyDate as found in the dicom tags (YYYYMMDD)
+        :returns: priority for the store job, higher is more urgent
+        """
+        today = today or datetime.date.today()
+        try:
+            study_day = datetime.datetime.strptime(study_date, "%Y%m%d").date()
+        except (TypeError, ValueError):
+            return ReplicationScheduler.PRIORITY_BACKFILL
+        if study_day >= today:
+            return ReplicationScheduler.PRIORITY_CURRENT_DAY
+        if (today - study_day).days <= self.recent_days:
+            return ReplicationScheduler.PRIORITY_RECENT
+        return ReplicationScheduler.PRIORITY_BACKFILL
+
+    def waitForBandwidth(self, byte_count: int):
+        """
+        Block until a job sending byte_count bytes may start.
+
+        :returns: seconds waited
+        """
+        rate_limit = self.getRateLimit()
+        if not rate_limit:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            start_time = max(now, self._next_start_time)
+            self._next_start_time = start_time + byte_count / rate_limit
+            delay = start_time - now
+            if delay > 0:
+                self.total_delay += delay
+        if delay > 0:
+            config.LOGGER.debug(f"Delaying store job by {delay:.1f}s to respect rate limit of {rate_limit} bytes/s")
+            time.sleep(delay)
+        return delay
@@ -0,0 +1,258 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from curapacs_python import config
+
+
+class ResourceCache:
+    """
+    Thread safe, size bounded LRU cache of orthanc resource dicts (as answered by /studies/{id},
+    /series/{id}, ...) and lists of child resources (/studies/{id}/instances, ...) keyed by
+    (orthanc URL, level, orthanc ID). Only instances and stable resources are cached, their
+    metadata does not change anymore. Entries pushed out of memory are spilled to the SQLite
+    file spill_path, if one is given, and promoted back on their next hit.
+
+    Every entry remembers the IDs of its resource, of its parents and of its children, so that
+    a change event of any of them (STABLE_SERIES, DELETED) drops it on all hosts.
+    """
+    related_keys = ["ParentPatient", "ParentStudy", "ParentSeries", "Studies", "Series", "Instances"]
+
+    def __init__(self, max_size=config.RESOURCE_CACHE_SIZE, ttl=config.RESOURCE_CACHE_TTL,
+                 spill_path=config.RESOURCE_CACHE_SPILL_PATH, spill_size=config.RESOURCE_CACHE_SPILL_SIZE):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.spill_size = spill_size if spill_path else 0
+        self._entries = OrderedDict()
+        # orthanc ID -> keys of the entries in memory related to it
+        self._related = {}
+        self._lock = threading.Lock()
+        self._connection = None
+        self._spilled = 0
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if self.spill_size > 0:
+            self._connection = sqlite3.connect(spill_path, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS resources (host TEXT, level TEXT, id TEXT, " + \
+                                     "content TEXT, expires REAL, PRIMARY KEY (host, level, id))")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS related (resource_id TEXT, host TEXT, " + \
+                                     "level TEXT, id TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS related_resource_id ON related (resource_id)")
+            # resources may have changed while orthanc was down
+            self._connection.execute("DELETE FROM resources")
+            self._connection.execute("DELETE FROM related")
+
+    def __len__(self):
+        return len(self._entries) + self._spilled
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    @staticmethod
+    def getKey(host: str, level: str, resource_id: str):
+        return (host, level.lower(), resource_id)
+
+    @staticmethod
+    def isCacheable(resource):
+        """
+        :param resource: resource dict or list of resource dicts
+        :returns: True if the metadata of resource is final, i.e. it is an instance or stable
+        """
+        if isinstance(resource, list):
+            return all(ResourceCache.isCacheable(item) for item in resource)
+        return resource.get("Type") == "Instance" or resource.get("IsStable") is True
+
+    @staticmethod
+    def getRelatedIDs(resource):
+        """
+        Collect the ID of resource and the IDs of its parents and children.
+
+        :param resource: resource dict or list of resource dicts
+        """
+        if isinstance(resource, list):
+            return set().union(*map(ResourceCache.getRelatedIDs, resource))
+        resource_ids = {resource.get("ID")}
+        for key in ResourceCache.related_keys:
+            value = resource.get(key)
+            if isinstance(value, list):
+                resource_ids.update(value)
+            elif value:
+                resource_ids.add(value)
+        resource_ids.discard(None)
+        return resource_ids
+
+    def get(self, key):
+        """
+        :returns: cached resource dict, or None if key is unknown or expired
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._spilled:
+                entry = self._loadSpilled(key)
+                if entry is not None:
+                    self.spill_hits += 1
+                    self._store(key, entry)
+                    self._evict()
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, resource, ttl=None):
+        """
+        Store resource under key if it is cacheable, evicting the least recently used entries
+        beyond max_size to the spill file. The entry is related to the ID of key as well,
+        so a list of children is dropped with its parent.
+
+        :param resource: resource dict or list of child resource dicts
+        :param ttl: seconds until the entry expires, default is the ttl of the cache
+        :returns: True if resource was stored
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if not self.enabled or ttl <= 0 or not self.isCacheable(resource):
+            return False
+        with self._lock:
+            self._remove(key)
+            self._store(key, (time.time() + ttl, resource,
+                              frozenset(self.getRelatedIDs(resource) | {key[2]})))
+            self._evict()
+        return True
+
+    def invalidate(self, resource_ids):
+        """
+        Drop every entry of one of resource_ids, of their parents or of their children.
+
+        :returns: number of entries dropped
+        """
+        resource_ids = set(resource_ids)
+        with self._lock:
+            stale_keys = set()
+            for resource_id in resource_ids:
+                stale_keys.update(self._related.get(resource_id, ()))
+            if self._spilled:
+                stale_keys.update(self._getSpilledKeys(resource_ids))
+            for key in stale_keys:
+                self._remove(key)
+            self.invalidations += len(stale_keys)
+        if stale_keys:
+            config.LOGGER.debug(f"Invalidated {len(stale_keys)} cached resources for {resource_ids}")
+        return len(stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._related.clear()
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM resources")
+                self._connection.execute("DELETE FROM related")
+            self._spilled = 0
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        for resource_id in entry[2]:
+            self._related.setdefault(resource_id, set()).add(key)
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            evicted_key, evicted_entry = self._entries.popitem(last=False)
+            self._unrelate(evicted_key, evicted_entry[2])
+            self.evictions += 1
+            if self._connection is not None:
+                self._spill(evicted_key, evicted_entry)
+
+    def _unrelate(self, key, related_ids):
+        for resource_id in related_ids:
+            keys = self._related.get(resource_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._related[resource_id]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._unrelate(key, entry[2])
+        if self._spilled:
+            self._unspill(key)
+
+    def _spill(self, key, entry):
+        """
+        Write entry to the spill file, dropping the entries closest to expiry beyond spill_size.
+        """
+        expires, resource, related_ids = entry
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.execute("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)",
+                                     (*key, json.dumps(resource), expires))
+            self._connection.executemany("INSERT INTO related VALUES (?, ?, ?, ?)",
+                                         [(resource_id, *key) for resource_id in related_ids])
+            self._spilled += 1
+            if self._spilled > self.spill_size:
+                dropped_keys = self._connection.execute("SELECT host, level, id FROM resources ORDER BY expires " + \
+                                                        "LIMIT ?", (self._spilled - self.spill_size,)).fetchall()
+                for dropped_key in dropped_keys:
+                    self._deleteSpilled(dropped_key)
+            self._connection.execute("COMMIT")
+        except sqlite3.Error as error:
+            self._connection.execute("ROLLBACK")
+            config.LOGGER.error(f"Failed to spill cached resource {key}: {error}")
+
+    def _deleteSpilled(self, key):
+        cursor = self._connection.execute("DELETE FROM resources WHERE host = ? AND level = ? AND id = ?", key)
+        self._connection.execute("DELETE FROM related WHERE host = ? AND level = ? AND id = ?", key)
+        self._spilled -= cursor.rowcount
+
+    def _unspill(self, key):
+        self._connection.execute("BEGIN")
+        self._deleteSpilled(key)
+        self._connection.execute("COMMIT")
+
+    def _loadSpilled(self, key):
+        row = self._connection.execute("SELECT content, expires FROM resources WHERE host = ? AND level = ? " + \
+                                       "AND id = ?", key).fetchone()
+        if row is None:
+            return None
+        self._unspill(key)
+        resource = json.loads(row[0])
+        return (row[1], resource, frozenset(self.getRelatedIDs(resource) | {key[2]}))
+
+    def _getSpilledKeys(self, resource_ids):
+        resource_ids = list(resource_ids)
+        keys = set()
+        # stay below the default limit of SQLite host parameters
+        for index in range(0, len(resource_ids), 500):
+            chunk = resource_ids[index:index + 500]
+            keys.update(self._connection.execute("SELECT host, level, id FROM related WHERE resource_id IN " + \
+                                                 f"({','.join('?' * len(chunk))})", chunk).fetchall())
+        return keys
+
+    def getStatistics(self):
+        """
+        :returns: dict of cache counters, as served by the REST API
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"Size": len(self._entries),
+                    "MaxSize": self.max_size,
+                    "Spilled": self._spilled,
+                    "MaxSpilled": self.spill_size,
+                    "TTL": self.ttl,
+                    "Hits": self.hits,
+                    "SpillHits": self.spill_hits,
+                    "Misses": self.misses,
+                    "HitRatio": self.hits / lookups if lookups else 0,
+                    "Evictions": self.evictions,
+                    "Invalidations": self.invalidations}
@@ -0,0 +1,168 @@
+import requests
+import threading
+from collections import OrderedDict
+from curapacs_python import config
+from curapacs_python.helpers import get_data
+from curapacs_python.OrthancHost import OrthancHost
+
+
+class StudyPrefetcher:
+    """
+    Makes the resources of a C-MOVE available on the local orthanc. Instances only present
+    on the remote orthanc are fetched series by series, up to max_workers at the same time.
+    on_series_complete is called with the ID of every series as soon as all of its instances
+    are local, so sending can start while the rest of the study is still being fetched.
+    """
+    uid_keywords_for_retrieve_level = {
+        "patient": "PatientID",
+        "study": "StudyInstanceUID",
+        "series": "SeriesInstanceUID",
+        "instance": "SOPInstanceUID"
+    }
+
+    # instances fetched from the remote orthanc, they must not be replicated back to it. Entries are
+    # taken by the NEW_INSTANCE event, the oldest beyond max_fetched_instance_ids are dropped
+    # (e.g. instances orthanc already held, which raise no event)
+    fetched_instance_ids = OrderedDict()
+    fetched_instance_ids_lock = threading.Lock()
+    max_fetched_instance_ids = 100000
+
+    def __init__(self, local_orthanc, remote_orthanc, max_workers=config.FETCH_PARALLELISM, presence_index=None):
+        self.local_orthanc = local_orthanc
+        self.remote_orthanc = remote_orthanc
+        self.max_workers = max_workers
+        self.presence_index = presence_index
+
+    def resolveResources(self, move_request: dict):
+        """
+        Find the orthanc resources a C-MOVE refers to, on the remote orthanc and on the local one.
+
+        :param move_request: dict with key "Level" and the UID of that level, e.g. "StudyInstanceUID"
+        :returns: list of dicts of orthanc resources
+        """
+        level = move_request.get("Level", "").lower()
+        try:
+            uid_keyword = StudyPrefetcher.uid_keywords_for_retrieve_level[level]
+        except KeyError:
+            raise ValueError(f"Unknown C-MOVE level {move_request.get('Level')}")
+        uid = move_request.get(uid_keyword)
+        if not uid:
+            raise ValueError(f"C-MOVE at level {level} without {uid_keyword}")
+        query = {uid_keyword: uid}
+        resources_by_id = OrderedDict()
+        for orthanc_host in [self.remote_orthanc, self.local_orthanc]:
+            try:
+                resources = orthanc_host.findResources(query, level)
+            except requests.RequestException as error:
+                config.LOGGER.warning(f"Failed to resolve C-MOVE {query} on {orthanc_host.url}: {error}")
+                continue
+            for resource_id, resource in OrthancHost.indexResourcesByID(resources).items():
+                resources_by_id.setdefault(resource_id, resource)
+        return list(resources_by_id.values())
+
+    def getLocalInstances(self, resource: dict):
+        """
+        :returns: list of dicts of the instances of resource present on the local orthanc
+        """
+        try:
+            if resource["Type"] == "Instance":
+                instance, _ = self.local_orthanc.requestData(get_data,
+                                                             f"{self.local_orthanc.url}/instances/{resource['ID']}")
+                return [instance]
+            return self.local_orthanc.getChildResourcesOfOrthancResource(resource, "instance")
+        except requests.ConnectionError as error:
+            if error.response is None:
+                raise
+            # resource is unknown to the local orthanc
+            return []
+
+    @staticmethod
+    def markFetched(instance_ids):
+        with StudyPrefetcher.fetched_instance_ids_lock:
+            for instance_id in instance_ids:
+                StudyPrefetcher.fetched_instance_ids[instance_id] = None
+            while len(StudyPrefetcher.fetched_instance_ids) > StudyPrefetcher.max_fetched_instance_ids:
+                StudyPrefetcher.fetched_instance_ids.popitem(last=False)
+
+    @staticmethod
+    def unmarkFetched(instance_ids):
+        with StudyPrefetcher.fetched_instance_ids_lock:
+            for instance_id in instance_ids:
+                StudyPrefetcher.fetched_instance_ids.pop(instance_id, None)
+
+    @staticmethod
+    def takeFetched(instance_id: str):
+        """
+        :returns: True if instance_id was fetched from the remote orthanc, forgetting it
+        """
+        with StudyPrefetcher.fetched_instance_ids_lock:
+            return StudyPrefetcher.fetched_instance_ids.pop(instance_id, False) is None
+
+    def fetchInstances(self, instance_ids):
+        """
+        Fetch instance_ids from the remote orthanc, up to max_workers at the same time.
+
+        :returns: list of instance IDs that failed to be fetched
+        """
+        StudyPrefetcher.markFetched(instance_ids)
+        failed_instance_ids = self.local_orthanc.fetchOrthancInstances(instance_ids, self.remote_orthanc,
+                                                                       parallelism=self.max_workers)
+        StudyPrefetcher.unmarkFetched(failed_instance_ids)
+        return failed_instance_ids
+
+    def prefetch(self, resource: dict, on_series_complete=None):
+        """
+        Fetch the instances of resource that are missing locally, series by series.
+        Series that are already complete are handed to on_series_complete first.
+        What is present locally is looked up in presence_index once it is built,
+        otherwise the instances of resource are listed on the local orthanc.
+
+        :param resource: dict of an orthanc resource
+        :param on_series_complete: callable taking the orthanc ID of a series
+        :returns: dict with counts of series, series present locally before, instances found,
+                  missing and fetched and the IDs of fetched and of failed instances
+        """
+        try:
+            remote_instances = self.remote_orthanc.getSubresourcesOfOrthancResource(resource, "instance")
+        except requests.RequestException as error:
+            config.LOGGER.warning(f"Failed to list instances of {resource['ID']} on {self.remote_orthanc.url}, " + \
+                                  f"serving local instances only: {error}")
+            remote_instances = []
+        if self.presence_index is not None and self.presence_index.is_ready and remote_instances:
+            local_instances = [instance for instance in remote_instances
+                               if self.presence_index.contains(instance["ID"])]
+            local_series_ids = set(self.presence_index.getSeriesIDs(resource))
+        else:
+            local_instances = self.getLocalInstances(resource)
+            local_series_ids = set()
+        local_instance_ids = {instance["ID"] for instance in local_instances}
+        local_series_ids.update(instance["ParentSeries"] for instance in local_instances)
+        missing_by_series = OrderedDict((series_id, []) for series_id in local_series_ids)
+        for instance in remote_instances:
+            missing_instance_ids = missing_by_series.setdefault(instance["ParentSeries"], [])
+            if instance["ID"] not in local_instance_ids and instance["ID"] not in missing_instance_ids:
+                missing_instance_ids.append(instance["ID"])
+        result = {"Series": len(missing_by_series),
+                  "LocalSeries": len(local_series_ids),
+                  "Instances": len(local_instance_ids) + sum(map(len, missing_by_series.values())),
+                  "Missing": sum(map(len, missing_by_series.values())),
+                  "Fetched": 0,
+                  "FetchedInstances": [],
+                  "Failed": []}
+        config.LOGGER.info(f"Prefetching {result['Missing']} of {result['Instances']} instances " + \
+                           f"of {resource['Type']} {resource['ID']} from {self.remote_orthanc.url}")
+        # complete series can be sent right away, the others follow as they arrive
+        for series_id, missing_instance_ids in sorted(missing_by_series.items(), key=lambda item: len(item[1])):
+            if missing_instance_ids:
+                failed_instance_ids = self.fetchInstances(missing_instance_ids)
+                result["Fetched"] += len(missing_instance_ids) - len(failed_instance_ids)
+                result["FetchedInstances"].extend(instance_id for instance_id in missing_instance_ids
+                                                  if instance_id not in failed_instance_ids)
+                if failed_instance_ids:
+                    config.LOGGER.error(f"Failed to fetch {len(failed_instance_ids)} instances of series " + \
+                                        f"{series_id}, not sending it.")
+                    result["Failed"].extend(failed_instance_ids)
+                    continue
+            if on_series_complete is not None:
+                on_series_complete(series_id)
+        return result
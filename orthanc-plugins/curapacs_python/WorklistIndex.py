@@ -0,0 +1,174 @@
+import os
+import time
+import threading
+from json import dumps
+from pydicom.errors import InvalidDicomError
+from curapacs_python import config
+from curapacs_python.OrthancMWLCreator import Worklist
+
+
+class WorklistIndex:
+    """
+    In-memory index of the worklist files in Worklist.modality_worklist_path, keyed by worklist ID
+    (SHA1 of the filename). Every file is read and converted once, GET /worklists and
+    GET /worklists/{id} are answered from the index without touching the disk.
+
+    Worklists created or deleted through the REST API are put into / dropped from the index right away,
+    files changed by anyone else are picked up by comparing modification times every poll_interval seconds.
+    """
+
+    def __init__(self, path=None, poll_interval=config.WORKLIST_POLL_INTERVAL):
+        self.path = path or Worklist.modality_worklist_path
+        self.poll_interval = poll_interval
+        # worklist ID -> (filename, mtime, worklist dict with keywords, worklist as json string)
+        self._entries = {}
+        self._filenames = {}
+        self._lock = threading.RLock()
+        self._worklist = Worklist()
+        self._worker = None
+        self._response = None
+        self.is_ready = False
+        self.refreshes = 0
+        self.last_refresh = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, worklist_id: str):
+        return worklist_id in self._entries
+
+    def put(self, filename: str, dataset=None):
+        """
+        Index worklist file filename, read from disk unless its dataset is given.
+
+        :returns: worklist ID
+        """
+        filepath = os.path.join(self.path, filename)
+        mtime = os.stat(filepath).st_mtime_ns
+        if dataset is None:
+            dataset = self._worklist.create_dataset_from_file(filepath)
+        worklist_id = self._worklist.hashme(filename)
+        worklist_dict = self._worklist.replace_tags_with_keywords({worklist_id: dataset.to_json_dict()})[worklist_id]
+        with self._lock:
+            self._entries[worklist_id] = (filename, mtime, worklist_dict, dumps(worklist_dict))
+            self._filenames[filename] = worklist_id
+            self._response = None
+        return worklist_id
+
+    def discard(self, worklist_id: str):
+        """
+        Drop worklist_id from the index, the file itself is left alone.
+
+        :returns: filename of the dropped worklist, None if it was not indexed
+        """
+        with self._lock:
+            entry = self._entries.pop(worklist_id, None)
+            if entry is None:
+                return None
+            self._filenames.pop(entry[0], None)
+            self._response = None
+        return entry[0]
+
+    def getFilename(self, worklist_id: str):
+        self.ensureReady()
+        entry = self._entries.get(worklist_id)
+        return entry[0] if entry else None
+
+    def get(self, worklist_id: str):
+        """
+        :returns: worklist dict with keywords, None if worklist_id is unknown
+        """
+        self.ensureReady()
+        entry = self._entries.get(worklist_id)
+        return entry[2] if entry else None
+
+    def getResponse(self, worklist_id=None):
+        """
+        :param worklist_id: ID of a single worklist, None for all worklists
+        :returns: json string answering GET /worklists (dict of worklist ID -> worklist) or
+                  GET /worklists/{id}, None if worklist_id is unknown
+        """
+        self.ensureReady()
+        with self._lock:
+            if worklist_id is not None:
+                entry = self._entries.get(worklist_id)
+                return entry[3] if entry else None
+            if self._response is None:
+                self._response = "{" + ", ".join(f'"{indexed_id}": {entry[3]}'
+                                                 for indexed_id, entry in self._entries.items()) + "}"
+            return self._response
+
+    def getResponseForIDs(self, worklist_ids):
+        """
+        :returns: json string of a dict of worklist ID -> worklist, answering GET /worklists?ids=...,
+                  unknown IDs are left out
+        """
+        self.ensureReady()
+        with self._lock:
+            entries = [(worklist_id, self._entries.get(worklist_id)) for worklist_id in worklist_ids]
+            return "{" + ", ".join(f'"{worklist_id}": {entry[3]}' for worklist_id, entry in entries if entry) + "}"
+
+    def ensureReady(self):
+        if not self.is_ready:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Bring the index in line with the worklist directory: new and modified files are (re)read,
+        entries of vanished files dropped.
+
+        :returns: tuple of the numbers of files read and dropped
+        """
+        with self._lock:
+            read_count, dropped_count = 0, 0
+            present_filenames = set()
+            with os.scandir(self.path) as directory_entries:
+                for directory_entry in directory_entries:
+                    if not directory_entry.name.endswith(Worklist.modality_worklist_suffix):
+                        continue
+                    present_filenames.add(directory_entry.name)
+                    worklist_id = self._filenames.get(directory_entry.name)
+                    try:
+                        if worklist_id is not None and \
+                                self._entries[worklist_id][1] == directory_entry.stat().st_mtime_ns:
+                            continue
+                        self.put(directory_entry.name)
+                    except (OSError, InvalidDicomError) as error:
+                        # vanished or still being written
+                        config.LOGGER.warning(f"Failed to index worklist file {directory_entry.name}: {error}")
+                        continue
+                    read_count += 1
+            for filename in set(self._filenames) - present_filenames:
+                self.discard(self._filenames[filename])
+                dropped_count += 1
+            if not self.is_ready:
+                config.LOGGER.info(f"Worklist index holds {len(self._entries)} worklists.")
+            self.is_ready = True
+            self.refreshes += 1
+            self.last_refresh = time.time()
+        if read_count or dropped_count:
+            config.LOGGER.debug(f"Worklist index read {read_count} and dropped {dropped_count} worklists.")
+        return read_count, dropped_count
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self.run, name="curapacs-worklist-index", daemon=True)
+            self._worker.start()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except OSError as error:
+                config.LOGGER.error(f"Failed to refresh worklist index of {self.path}: {error}")
+            time.sleep(self.poll_interval)
+
+    def getStatistics(self):
+        """
+        :returns: dict describing the index, as served by the REST API
+        """
+        return {"Worklists": len(self._entries),
+                "Ready": self.is_ready,
+                "Refreshes": self.refreshes,
+                "LastRefresh": self.last_refresh,
+                "PollInterval": self.poll_interval}
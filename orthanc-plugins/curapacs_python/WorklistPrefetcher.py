@@ -0,0 +1,357 @@
+import time
+import heapq
+import sqlite3
+import datetime
+import threading
+import requests
+from curapacs_python import config
+from curapacs_python.DicomTags import DicomTags
+from curapacs_python.helpers import get_data, delete_data
+from curapacs_python.StudyPrefetcher import StudyPrefetcher
+
+
+class PrefetchJournal:
+    """
+    SQLite record of the studies the prefetcher brought to the local orthanc, with their
+    size on disk, the time of their last C-MOVE and the IDs of the fetched instances.
+    Only studies that were not present locally at all are recorded, and evicting one deletes
+    only the recorded instances, never data that came from elsewhere.
+    """
+
+    def __init__(self, path=config.PREFETCH_JOURNAL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS prefetched_studies ("
+                                 "study_id TEXT PRIMARY KEY, "
+                                 "patient_id TEXT, "
+                                 "size INTEGER NOT NULL DEFAULT 0, "
+                                 "prefetched REAL NOT NULL, "
+                                 "last_access REAL NOT NULL, "
+                                 "accesses INTEGER NOT NULL DEFAULT 0)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS prefetched_instances ("
+                                 "instance_id TEXT PRIMARY KEY, "
+                                 "study_id TEXT NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS prefetched_instances_study_id "
+                                 "ON prefetched_instances (study_id)")
+
+    def execute(self, statement, parameters=()):
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def add(self, study_id, patient_id, size, instance_ids):
+        """
+        Record a prefetched study together with the IDs of the instances fetched of it.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.execute("INSERT OR REPLACE INTO prefetched_studies " + \
+                                         "(study_id, patient_id, size, prefetched, last_access) VALUES (?, ?, ?, ?, ?)",
+                                         (study_id, patient_id, size, now, now))
+                self._connection.executemany("INSERT OR REPLACE INTO prefetched_instances (instance_id, study_id) " + \
+                                             "VALUES (?, ?)", [(instance_id, study_id) for instance_id in instance_ids])
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def touch(self, study_ids):
+        """
+        Record an access to the studies, unknown study IDs are ignored.
+
+        :returns: number of prefetched studies among study_ids
+        """
+        touched = 0
+        for study_id in study_ids:
+            with self._lock:
+                cursor = self._connection.execute("UPDATE prefetched_studies SET last_access = ?, " + \
+                                                  "accesses = accesses + 1 WHERE study_id = ?",
+                                                  (time.time(), study_id))
+                touched += cursor.rowcount
+        return touched
+
+    def remove(self, study_id):
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.execute("DELETE FROM prefetched_instances WHERE study_id = ?", (study_id,))
+                self._connection.execute("DELETE FROM prefetched_studies WHERE study_id = ?", (study_id,))
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def getInstanceIDs(self, study_id):
+        """
+        :returns: list of the IDs of the instances fetched of study_id
+        """
+        return [row[0] for row in self.execute("SELECT instance_id FROM prefetched_instances WHERE study_id = ?",
+                                               (study_id,))]
+
+    def getTotalSize(self):
+        return self.execute("SELECT COALESCE(SUM(size), 0) FROM prefetched_studies")[0][0]
+
+    def getLeastRecentlyUsed(self):
+        """
+        :returns: list of (study_id, size, accesses, last_access) tuples, the study accessed longest ago first
+        """
+        return self.execute("SELECT study_id, size, accesses, last_access FROM prefetched_studies ORDER BY last_access")
+
+    def getStatistics(self):
+        study_count, total_size = self.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM prefetched_studies")[0]
+        return {"Studies": study_count, "Bytes": total_size}
+
+
+class WorklistPrefetcher:
+    """
+    Pulls the prior studies of scheduled patients from the remote orthanc before they are
+    examined. Each patient is processed lead_time seconds before the scheduled time, at most
+    max_studies of the most recent studies per patient. Prefetched studies are kept within
+    disk_budget bytes (uncompressed size, as the remote orthanc may store compressed), evicting
+    the least recently moved ones first. A study is not evicted while one of its prefetched
+    instances is still waiting in replication_journal or not confirmed on the remote orthanc
+    by presence_function.
+
+    A C-MOVE of a prefetched study counts as hit, a C-MOVE that still had to fetch
+    instances from the remote orthanc as miss.
+    """
+
+    def __init__(self, journal, local_orthanc, remote_orthanc, disk_budget=config.PREFETCH_DISK_BUDGET,
+                 max_studies=config.PREFETCH_MAX_STUDIES, max_workers=config.PREFETCH_PARALLELISM,
+                 lead_time=config.PREFETCH_LEAD_TIME, presence_index=None, replication_journal=None,
+                 presence_function=None):
+        self.journal = journal
+        self.presence_index = presence_index
+        self.replication_journal = replication_journal
+        self.presence_function = presence_function
+        self.local_orthanc = local_orthanc
+        self.remote_orthanc = remote_orthanc
+        self.disk_budget = disk_budget
+        self.max_studies = max_studies
+        self.max_workers = max_workers
+        self.lead_time = lead_time
+        self._schedule = []
+        self._condition = threading.Condition()
+        self._worker = None
+        self.patients_queued = 0
+        self.studies_prefetched = 0
+        self.studies_skipped = 0
+        self.failed_prefetches = 0
+        self.evictions = 0
+        self.unused_evictions = 0
+        self.skipped_evictions = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def getWorklistValue(worklist: dict, keyword: str):
+        """
+        Search a dicom json worklist, keyed by keywords or tags, for the first value of keyword,
+        descending into sequences.
+
+        :returns: value, None if the worklist does not contain keyword
+        """
+        tag = DicomTags.getJsonTag(keyword)
+        for key, element in worklist.items():
+            if not isinstance(element, dict):
+                continue
+            values = element.get("Value") or []
+            if key == keyword or key.lower() == tag:
+                return values[0] if values else None
+            for value in values:
+                if isinstance(value, dict):
+                    nested_value = WorklistPrefetcher.getWorklistValue(value, keyword)
+                    if nested_value is not None:
+                        return nested_value
+        return None
+
+    @staticmethod
+    def getScheduledTime(start_date, start_time=None):
+        """
+        :param start_date: ScheduledProcedureStepStartDate (YYYYMMDD)
+        :param start_time: ScheduledProcedureStepStartTime (HHMM[SS[.FFFFFF]])
+        :returns: scheduled time as unix timestamp, None if start_date is invalid
+        """
+        try:
+            scheduled_time = datetime.datetime.strptime(start_date, "%Y%m%d")
+        except (TypeError, ValueError):
+            return None
+        time_digits = (start_time or "").split(".")[0]
+        if time_digits.isdigit() and len(time_digits) >= 4:
+            scheduled_time = scheduled_time.replace(hour=min(int(time_digits[0:2]), 23),
+                                                    minute=min(int(time_digits[2:4]), 59))
+        return scheduled_time.timestamp()
+
+    def put(self, patient_id: str, scheduled_time=None):
+        """
+        Queue the prior studies of patient_id for prefetching. Patients scheduled before
+        today are not queued.
+
+        :param scheduled_time: unix timestamp of the scheduled procedure step, None for now
+        """
+        if scheduled_time is None:
+            scheduled_time = time.time()
+        start_of_today = datetime.datetime.combine(datetime.date.today(), datetime.time()).timestamp()
+        if scheduled_time < start_of_today:
+            config.LOGGER.debug(f"Not prefetching studies of {patient_id}, scheduled in the past.")
+            return
+        with self._condition:
+            heapq.heappush(self._schedule, (scheduled_time, patient_id))
+            self.patients_queued += 1
+            if self._worker is None:
+                self._worker = threading.Thread(target=self.run, name="curapacs-prefetch", daemon=True)
+                self._worker.start()
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._schedule:
+                        waiting_time = self._schedule[0][0] - self.lead_time - time.time()
+                        if waiting_time <= 0:
+                            break
+                        self._condition.wait(timeout=waiting_time)
+                    else:
+                        self._condition.wait()
+                _, patient_id = heapq.heappop(self._schedule)
+            try:
+                self.prefetchPatient(patient_id)
+            except Exception as error:
+                self.failed_prefetches += 1
+                config.LOGGER.error(f"Failed to prefetch studies of patient {patient_id}: {error}")
+
+    def prefetchPatient(self, patient_id: str):
+        """
+        Fetch the most recent studies of patient_id that are not present locally.
+        """
+        studies = self.remote_orthanc.findResources({"PatientID": patient_id}, "study")
+        studies.sort(key=lambda study: study.get("MainDicomTags", {}).get("StudyDate", ""), reverse=True)
+        config.LOGGER.info(f"Prefetching {min(len(studies), self.max_studies)} of {len(studies)} studies " + \
+                           f"of patient {patient_id}")
+        prefetcher = StudyPrefetcher(self.local_orthanc, self.remote_orthanc, max_workers=self.max_workers,
+                                     presence_index=self.presence_index)
+        start_time = time.time()
+        for study in studies[:self.max_studies]:
+            study_size = self.getStudySize(self.remote_orthanc, study["ID"], "UncompressedSize")
+            if study_size > self.disk_budget or not self.evict(self.disk_budget - study_size, start_time):
+                config.LOGGER.warning(f"Study {study['ID']} of {study_size} bytes does not fit into " + \
+                                      f"prefetch disk budget of {self.disk_budget} bytes, skipping it.")
+                self.studies_skipped += 1
+                continue
+            result = prefetcher.prefetch(study)
+            if not result["Fetched"] or result["LocalSeries"]:
+                # nothing fetched, or partially present before and not ours to evict
+                continue
+            self.journal.add(study["ID"], patient_id,
+                             self.getStudySize(self.local_orthanc, study["ID"], "UncompressedSize"),
+                             result["FetchedInstances"])
+            self.studies_prefetched += 1
+
+    @staticmethod
+    def getStudySize(orthanc_host, study_id: str, statistic: str):
+        """
+        :param statistic: "DiskSize" or "UncompressedSize"
+        :returns: size in bytes as reported by /studies/{id}/statistics
+        """
+        statistics, _ = orthanc_host.requestData(get_data, f"{orthanc_host.url}/studies/{study_id}/statistics")
+        return int(statistics.get(statistic, 0))
+
+    def evict(self, max_size: int, accessed_before=None):
+        """
+        Delete the prefetched instances of least recently used studies until these take at most
+        max_size bytes. Studies accessed (or prefetched) at or after accessed_before are kept,
+        as are studies isEvictable refuses.
+
+        :returns: True if max_size was reached
+        """
+        total_size = self.journal.getTotalSize()
+        for study_id, size, accesses, last_access in self.journal.getLeastRecentlyUsed():
+            if total_size <= max_size:
+                break
+            if accessed_before is not None and last_access >= accessed_before:
+                break
+            instance_ids = self.journal.getInstanceIDs(study_id)
+            if not self.isEvictable(study_id, instance_ids):
+                self.skipped_evictions += 1
+                continue
+            config.LOGGER.info(f"Evicting {len(instance_ids)} prefetched instances of study {study_id} " + \
+                               f"({size} bytes) from local orthanc.")
+            for instance_id in instance_ids:
+                try:
+                    self.local_orthanc.requestData(delete_data, f"{self.local_orthanc.url}/instances/{instance_id}")
+                except requests.ConnectionError as error:
+                    if error.response is None:
+                        raise
+                    # instance was deleted by someone else
+            self.journal.remove(study_id)
+            total_size -= size
+            self.evictions += 1
+            if not accesses:
+                self.unused_evictions += 1
+        return total_size <= max_size
+
+    def isEvictable(self, study_id: str, instance_ids: list):
+        """
+        :returns: False if one of instance_ids still has to be replicated or is not confirmed
+                  on the remote orthanc
+        """
+        if self.replication_journal is not None:
+            pending_instance_ids = self.replication_journal.getPendingInstanceIDs(instance_ids)
+            if pending_instance_ids:
+                config.LOGGER.info(f"Not evicting study {study_id}, {len(pending_instance_ids)} of its " + \
+                                   f"instances are waiting for replication.")
+                return False
+        if self.presence_function is not None:
+            missing_instance_ids = set(instance_ids) - set(self.presence_function(instance_ids))
+            if missing_instance_ids:
+                config.LOGGER.info(f"Not evicting study {study_id}, {len(missing_instance_ids)} of its " + \
+                                   f"instances are not confirmed on {self.remote_orthanc.url}.")
+                return False
+        return True
+
+    def recordMove(self, resource: dict, result: dict):
+        """
+        Count a C-MOVE of resource as hit or miss.
+
+        :param result: dict as returned by StudyPrefetcher.prefetch
+        """
+        if resource["Type"] == "Patient":
+            study_ids = resource.get("Studies", [])
+        elif resource["Type"] == "Study":
+            study_ids = [resource["ID"]]
+        elif resource["Type"] == "Series":
+            study_ids = [resource.get("ParentStudy")]
+        else:
+            study_ids = []
+        is_prefetched = self.journal.touch(study_ids) > 0
+        if result["Missing"]:
+            self.misses += 1
+        elif is_prefetched:
+            self.hits += 1
+
+    def getStatistics(self):
+        """
+        :returns: dict of prefetch metrics, as served by the REST API
+        """
+        with self._condition:
+            queued_patients = len(self._schedule)
+        moves = self.hits + self.misses
+        return {"QueuedPatients": queued_patients,
+                "PatientsQueued": self.patients_queued,
+                "StudiesPrefetched": self.studies_prefetched,
+                "StudiesSkipped": self.studies_skipped,
+                "FailedPrefetches": self.failed_prefetches,
+                "DiskBudget": self.disk_budget,
+                "LeadTime": self.lead_time,
+                "Journal": self.journal.getStatistics(),
+                "Evictions": self.evictions,
+                "UnusedEvictions": self.unused_evictions,
+                "SkippedEvictions": self.skipped_evictions,
+                "Hits": self.hits,
+                "Misses": self.misses,
+                "HitRate": self.hits / moves if moves else None}
@@ -1,3 +1,4 @@
+import os
 import sys
 import logging
 from orthanc import GetConfiguration
@@ -38,3 +39,105 @@ LOCAL_UNIX_SOCKET_PATH = orthanc_config.get(curapacs_config_section, {}).get("UN
 LOCAL_HTTP_USER = list(orthanc_config.get("RegisteredUsers").keys())[0] or "orthanc"
 LOCAL_HTTP_PASSWORD = orthanc_config.get("RegisteredUsers", {}).get(LOCAL_HTTP_USER) or "orthanc"
 WORKLISTS_DATABASE_DIRECTORY = orthanc_config.get("Worklists", {}).get("Database")
+QUERY_CONCURRENCY = orthanc_config.get(curapacs_config_section, {}).get("QUERY_CONCURRENCY") or 8
+QUERY_CONCURRENCY = int(QUERY_CONCURRENCY)
+QUERY_DEADLINE = orthanc_config.get(curapacs_config_section, {}).get("QUERY_DEADLINE") or 10
+QUERY_DEADLINE = float(QUERY_DEADLINE)
+HTTP_POOL_SIZE = orthanc_config.get(curapacs_config_section, {}).get("HTTP_POOL_SIZE") or QUERY_CONCURRENCY
+HTTP_POOL_SIZE = int(HTTP_POOL_SIZE)
+HTTP_RETRIES = orthanc_config.get(curapacs_config_section, {}).get("HTTP_RETRIES", 3)
+HTTP_RETRIES = int(HTTP_RETRIES)
+HTTP_RETRY_BACKOFF = orthanc_config.get(curapacs_config_section, {}).get("HTTP_RETRY_BACKOFF") or 0.3
+HTTP_RETRY_BACKOFF = float(HTTP_RETRY_BACKOFF)
+SUBRESOURCE_DESCENT = orthanc_config.get(curapacs_config_section, {}).get("SUBRESOURCE_DESCENT") or "bulk"
+SUBRESOURCE_DESCENT = SUBRESOURCE_DESCENT.lower()
+QUERY_CACHE_SIZE = orthanc_config.get(curapacs_config_section, {}).get("QUERY_CACHE_SIZE", 256)
+QUERY_CACHE_SIZE = int(QUERY_CACHE_SIZE)
+QUERY_CACHE_TTL = orthanc_config.get(curapacs_config_section, {}).get("QUERY_CACHE_TTL", 30)
+QUERY_CACHE_TTL = float(QUERY_CACHE_TTL)
+RESOURCE_CACHE_SIZE = orthanc_config.get(curapacs_config_section, {}).get("RESOURCE_CACHE_SIZE", 4096)
+RESOURCE_CACHE_SIZE = int(RESOURCE_CACHE_SIZE)
+RESOURCE_CACHE_TTL = orthanc_config.get(curapacs_config_section, {}).get("RESOURCE_CACHE_TTL", 3600)
+RESOURCE_CACHE_TTL = float(RESOURCE_CACHE_TTL)
+# remote hosts raise no change events here, their entries are only dropped when they expire
+RESOURCE_CACHE_REMOTE_TTL = orthanc_config.get(curapacs_config_section, {}).get("RESOURCE_CACHE_REMOTE_TTL", 60)
+RESOURCE_CACHE_REMOTE_TTL = float(RESOURCE_CACHE_REMOTE_TTL)
+# an empty path keeps the resource cache in memory only
+RESOURCE_CACHE_SPILL_PATH = orthanc_config.get(curapacs_config_section, {}).get("RESOURCE_CACHE_SPILL_PATH", "")
+RESOURCE_CACHE_SPILL_SIZE = orthanc_config.get(curapacs_config_section, {}).get("RESOURCE_CACHE_SPILL_SIZE") or 100000
+RESOURCE_CACHE_SPILL_SIZE = int(RESOURCE_CACHE_SPILL_SIZE)
+ETAG_CACHE_SIZE = orthanc_config.get(curapacs_config_section, {}).get("ETAG_CACHE_SIZE", 1024)
+ETAG_CACHE_SIZE = int(ETAG_CACHE_SIZE)
+WORKLIST_POLL_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("WORKLIST_POLL_INTERVAL") or 5
+WORKLIST_POLL_INTERVAL = float(WORKLIST_POLL_INTERVAL)
+WORKLIST_FETCH_BATCH_SIZE = orthanc_config.get(curapacs_config_section, {}).get("WORKLIST_FETCH_BATCH_SIZE") or 100
+WORKLIST_FETCH_BATCH_SIZE = int(WORKLIST_FETCH_BATCH_SIZE)
+WORKLIST_JOURNAL_PATH = orthanc_config.get(curapacs_config_section, {}).get("WORKLIST_JOURNAL_PATH") or \
+                        os.path.join(orthanc_config.get("StorageDirectory", "/var/lib/orthanc/db"),
+                                     "curapacs-worklists.sqlite")
+PEER_FAILURE_THRESHOLD = orthanc_config.get(curapacs_config_section, {}).get("PEER_FAILURE_THRESHOLD") or 3
+PEER_FAILURE_THRESHOLD = int(PEER_FAILURE_THRESHOLD)
+PEER_PROBE_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("PEER_PROBE_INTERVAL") or 10
+PEER_PROBE_INTERVAL = float(PEER_PROBE_INTERVAL)
+FIND_PAGE_SIZE = orthanc_config.get(curapacs_config_section, {}).get("FIND_PAGE_SIZE") or 100
+FIND_PAGE_SIZE = int(FIND_PAGE_SIZE)
+MAX_FIND_ANSWERS = orthanc_config.get(curapacs_config_section, {}).get("MAX_FIND_ANSWERS", 500)
+MAX_FIND_ANSWERS = int(MAX_FIND_ANSWERS)
+STORE_BATCH_SIZE = orthanc_config.get(curapacs_config_section, {}).get("STORE_BATCH_SIZE") or 100
+STORE_BATCH_SIZE = int(STORE_BATCH_SIZE)
+STORE_FLUSH_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("STORE_FLUSH_INTERVAL") or 2
+STORE_FLUSH_INTERVAL = float(STORE_FLUSH_INTERVAL)
+REPLICATION_JOURNAL_PATH = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_JOURNAL_PATH") or \
+                           os.path.join(orthanc_config.get("StorageDirectory", "/var/lib/orthanc/db"),
+                                        "curapacs-replication.sqlite")
+REPLICATION_MAX_JOBS = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_MAX_JOBS") or 4
+REPLICATION_MAX_JOBS = int(REPLICATION_MAX_JOBS)
+REPLICATION_POLL_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_POLL_INTERVAL") or 5
+REPLICATION_POLL_INTERVAL = float(REPLICATION_POLL_INTERVAL)
+REPLICATION_RETRY_BACKOFF = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_RETRY_BACKOFF") or 10
+REPLICATION_RETRY_BACKOFF = float(REPLICATION_RETRY_BACKOFF)
+REPLICATION_RATE_LIMIT = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_RATE_LIMIT") or 0
+REPLICATION_RATE_LIMIT = int(REPLICATION_RATE_LIMIT)
+REPLICATION_RATE_WINDOWS = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_RATE_WINDOWS") or []
+REPLICATION_RECENT_DAYS = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_RECENT_DAYS") or 7
+REPLICATION_RECENT_DAYS = int(REPLICATION_RECENT_DAYS)
+REPLICATION_AGING_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("REPLICATION_AGING_INTERVAL") or 600
+REPLICATION_AGING_INTERVAL = float(REPLICATION_AGING_INTERVAL)
+TRANSFER_COMPRESSION = orthanc_config.get(curapacs_config_section, {}).get("TRANSFER_COMPRESSION") or "auto"
+TRANSFER_COMPRESSION = TRANSFER_COMPRESSION.lower()
+RELAY_CHUNK_SIZE = orthanc_config.get(curapacs_config_section, {}).get("RELAY_CHUNK_SIZE") or 1024 * 1024
+RELAY_CHUNK_SIZE = int(RELAY_CHUNK_SIZE)
+FETCH_PARALLELISM = orthanc_config.get(curapacs_config_section, {}).get("FETCH_PARALLELISM") or 4
+FETCH_PARALLELISM = int(FETCH_PARALLELISM)
+MOVE_POLL_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("MOVE_POLL_INTERVAL") or 1
+MOVE_POLL_INTERVAL = float(MOVE_POLL_INTERVAL)
+PREFETCH_DISK_BUDGET = orthanc_config.get(curapacs_config_section, {}).get("PREFETCH_DISK_BUDGET", 10 * 1024 ** 3)
+PREFETCH_DISK_BUDGET = int(PREFETCH_DISK_BUDGET)
+PREFETCH_MAX_STUDIES = orthanc_config.get(curapacs_config_section, {}).get("PREFETCH_MAX_STUDIES") or 5
+PREFETCH_MAX_STUDIES = int(PREFETCH_MAX_STUDIES)
+PREFETCH_PARALLELISM = orthanc_config.get(curapacs_config_section, {}).get("PREFETCH_PARALLELISM") or 2
+PREFETCH_PARALLELISM = int(PREFETCH_PARALLELISM)
+PREFETCH_LEAD_TIME = orthanc_config.get(curapacs_config_section, {}).get("PREFETCH_LEAD_TIME", 4 * 3600)
+PREFETCH_LEAD_TIME = float(PREFETCH_LEAD_TIME)
+PREFETCH_JOURNAL_PATH = orthanc_config.get(curapacs_config_section, {}).get("PREFETCH_JOURNAL_PATH") or \
+                        os.path.join(orthanc_config.get("StorageDirectory", "/var/lib/orthanc/db"),
+                                     "curapacs-prefetch.sqlite")
+PRESENCE_INDEX_PATH = orthanc_config.get(curapacs_config_section, {}).get("PRESENCE_INDEX_PATH") or \
+                      os.path.join(orthanc_config.get("StorageDirectory", "/var/lib/orthanc/db"),
+                                   "curapacs-presence.sqlite")
+PRESENCE_POLL_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("PRESENCE_POLL_INTERVAL") or 2
+PRESENCE_POLL_INTERVAL = float(PRESENCE_POLL_INTERVAL)
+PRESENCE_PAGE_SIZE = orthanc_config.get(curapacs_config_section, {}).get("PRESENCE_PAGE_SIZE") or 1000
+PRESENCE_PAGE_SIZE = int(PRESENCE_PAGE_SIZE)
+LOCAL_NAME = orthanc_config.get("Name") or "ORTHANC"
+PRESENCE_SUMMARY_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("PRESENCE_SUMMARY_INTERVAL") or 300
+PRESENCE_SUMMARY_INTERVAL = float(PRESENCE_SUMMARY_INTERVAL)
+PRESENCE_SUMMARY_ERROR_RATE = orthanc_config.get(curapacs_config_section, {}).get("PRESENCE_SUMMARY_ERROR_RATE") or 0.01
+PRESENCE_SUMMARY_ERROR_RATE = float(PRESENCE_SUMMARY_ERROR_RATE)
+WEBSOCKET_MAX_MESSAGE_SIZE = orthanc_config.get(curapacs_config_section, {}).get("WEBSOCKET_MAX_MESSAGE_SIZE") or \
+                             64 * 1024 * 1024
+WEBSOCKET_MAX_MESSAGE_SIZE = int(WEBSOCKET_MAX_MESSAGE_SIZE)
+ANTI_ENTROPY_INTERVAL = orthanc_config.get(curapacs_config_section, {}).get("ANTI_ENTROPY_INTERVAL") or 3600
+ANTI_ENTROPY_INTERVAL = float(ANTI_ENTROPY_INTERVAL)
+ANTI_ENTROPY_BATCH_SIZE = orthanc_config.get(curapacs_config_section, {}).get("ANTI_ENTROPY_BATCH_SIZE") or 100
+ANTI_ENTROPY_BATCH_SIZE = int(ANTI_ENTROPY_BATCH_SIZE)
@@ -1,21 +1,55 @@
 import json
 import base64
+import time
+import threading
 import requests
 import socket
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 from curapacs_python import config
 
-def post_data(url, data, headers=None, timeout=config.HTTP_TIMEOUT, is_json=True):
+_sessions = {}
+_sessions_lock = threading.Lock()
+RETRY_STATUS_CODES = (502, 503, 504)
+
+def get_session(url, http_user=None, http_password=None):
+    """
+    Returns the shared requests session for the host of url. Each session keeps a pool
+    of keep-alive connections and carries a prebuilt basic auth header.
+
+    :param url: any URL of the host, only scheme and network location are used
+    :param http_user: Basic Auth Username
+    :param http_password: Basic Auth Password
+    :returns: requests.Session
+    """
+    split_url = urlsplit(url)
+    session_key = (split_url.scheme, split_url.netloc, http_user)
+    with _sessions_lock:
+        session = _sessions.get(session_key)
+        if session is None:
+            config.LOGGER.debug(f"Creating HTTP session for {split_url.netloc} with pool size {config.HTTP_POOL_SIZE}")
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if http_user:
+                session.headers.update(get_http_auth_header(http_user, http_password))
+            _sessions[session_key] = session
+    return session
+
+def post_data(url, data, headers=None, timeout=config.HTTP_TIMEOUT, is_json=True, session=None):
     """
-    Issues http POST to a url
+    Issues http POST to a url. Without is_json, an error status raises requests.HTTPError.
     """
-    config.LOGGER.debug(f"post_data called with args: {url}, headers: {headers}, body with size: {len(data)}")
+    body_size = len(data) if hasattr(data, "__len__") else "unknown (streamed)"
+    config.LOGGER.debug(f"post_data called with args: {url}, headers: {headers}, body with size: {body_size}")
     if headers is None:
         headers = {}
-    if config.PEER_HTTP_USER:
-        headers.update(get_http_auth_header(config.PEER_HTTP_USER, config.PEER_HTTP_PASSWORD))
+    if session is None:
+        session = get_session(url, config.PEER_HTTP_USER, config.PEER_HTTP_PASSWORD)
     if is_json:
         headers.update({"Content-Type": "application/json"})
-        response = requests.post(url, json=data, headers=headers, timeout=timeout)
+        response = session.post(url, json=data, headers=headers, timeout=timeout)
         try: 
             json_response = response.json()
         except json.JSONDecodeError:
@@ -23,22 +57,40 @@ def post_data(url, data, headers=None, timeout=config.HTTP_TIMEOUT, is_json=True
             json_response = {}
         return json_response, response.headers
     else:
-        response = requests.post(url, data=data, headers=headers, timeout=timeout)
+        response = session.post(url, data=data, headers=headers, timeout=timeout)
+        response.raise_for_status()
         return response.content, response.headers
 
-def get_data(url, headers=None, timeout=config.HTTP_TIMEOUT):
+def get_data(url, headers=None, timeout=config.HTTP_TIMEOUT, session=None, retries=config.HTTP_RETRIES):
     """
-    Issues http GET to a url
+    Issues http GET to a url. Connection errors, timeouts and 502/503/504 responses are
+    retried up to retries times with exponential backoff. A "304 Not Modified" answer to
+    a request with If-None-Match header returns None as content.
     """
     if not headers:
         headers = {}
-    if config.PEER_HTTP_USER:
-        headers.update(get_http_auth_header(config.PEER_HTTP_USER, config.PEER_HTTP_PASSWORD))
+    if session is None:
+        session = get_session(url, config.PEER_HTTP_USER, config.PEER_HTTP_PASSWORD)
     headers.update({"Accept":"application/json"})
-    response = requests.get(url, headers=headers, timeout=timeout)
-    if response.status_code > 299:
+    for attempt in range(retries + 1):
+        is_last_attempt = attempt == retries
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if is_last_attempt:
+                raise
+            config.LOGGER.debug(f"HTTP GET of {url} failed, retrying (attempt {attempt + 1}).")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or is_last_attempt:
+                break
+            config.LOGGER.debug(f"HTTP GET of {url} returned {response.status_code}, retrying (attempt {attempt + 1}).")
+        time.sleep(config.HTTP_RETRY_BACKOFF * 2 ** attempt)
+    if response.status_code == 304:
+        config.LOGGER.debug(f"HTTP GET of {url} not modified.")
+        return None, response.headers
+    elif response.status_code > 299:
         config.LOGGER.warning(f"HTTP GET got bad response, status {response.status_code}, content {response.content}")
-        raise requests.ConnectionError()
+        raise requests.ConnectionError(response=response)
     elif "Content-Type" in response.headers and "application/json" in response.headers["Content-Type"]:
         config.LOGGER.debug("HTTP GET received JSON structure.")
         return response.json(), response.headers
@@ -46,6 +98,36 @@ def get_data(url, headers=None, timeout=config.HTTP_TIMEOUT):
         config.LOGGER.info("HTTP GET received NON-JSON structure.")
         return response.content, response.headers
 
+def open_file_stream(url, headers=None, timeout=config.HTTP_TIMEOUT, session=None, accept_gzip=True):
+    """
+    Issues http GET for binary content without reading the body. With accept_gzip the
+    server may answer with a gzip encoded body.
+
+    :returns: streamed requests.Response, the body is read from response.raw
+    """
+    if not headers:
+        headers = {}
+    if session is None:
+        session = get_session(url, config.PEER_HTTP_USER, config.PEER_HTTP_PASSWORD)
+    headers.update({"Accept-Encoding": "gzip" if accept_gzip else "identity"})
+    response = session.get(url, headers=headers, timeout=timeout, stream=True)
+    if response.status_code > 299:
+        config.LOGGER.warning(f"HTTP GET got bad response, status {response.status_code}, content {response.content}")
+        raise requests.ConnectionError(response=response)
+    return response
+
+def delete_data(url, headers=None, timeout=config.HTTP_TIMEOUT, session=None):
+    """
+    Issues http DELETE to a url
+    """
+    if session is None:
+        session = get_session(url, config.PEER_HTTP_USER, config.PEER_HTTP_PASSWORD)
+    response = session.delete(url, headers=headers, timeout=timeout)
+    if response.status_code > 299:
+        config.LOGGER.warning(f"HTTP DELETE got bad response, status {response.status_code}, content {response.content}")
+        raise requests.ConnectionError(response=response)
+    return response.content, response.headers
+
 def get_http_auth_header(username, password):
     """
     :param username: Basic Auth Username
@@ -62,7 +144,7 @@ def send_over_unix_socket(message):
     try:
         sock.connect(config.LOCAL_UNIX_SOCKET_PATH)
         sock.sendall(data.encode("utf-8"))
-        config.LOGGER.debug(f"Sent message over unix socket: {message}")
+        config.LOGGER.debug(f"Sent message of type {message.get('type')} and {len(data)} bytes over unix socket.")
         sock.close()
     except (OSError, TypeError):
         config.LOGGER.error(f"Failed to open socket connection with {config.LOCAL_UNIX_SOCKET_PATH}")
@@ -1,18 +1,158 @@
 import sys
 import json
+import time
+import hashlib
 import requests
 import socket
 from curapacs_python import helpers
 from curapacs_python import config
+from curapacs_python.AntiEntropySync import AntiEntropySync
+from curapacs_python.CircuitBreaker import CircuitBreaker
 from curapacs_python.OrthancHost import OrthancHost
+from curapacs_python.OrthancQueryEngine import OrthancQueryEngine
 from curapacs_python.OrthancMWLCreator import Worklist
 from curapacs_python.OrthancWebsocket import OrthancMessage
+from curapacs_python.ReplicationJournal import ReplicationJournal, ReplicationSender
+from curapacs_python.ReplicationScheduler import ReplicationScheduler
+from curapacs_python.PresenceIndex import PresenceIndex
+from curapacs_python.PresenceSummary import PresenceSummaries
+from curapacs_python.StudyPrefetcher import StudyPrefetcher
+from curapacs_python.WorklistIndex import WorklistIndex
+from curapacs_python.WorklistPrefetcher import PrefetchJournal, WorklistPrefetcher
 
 try:
     import orthanc
 except ImportError:
     config.LOGGER.warning("Failed to import orthanc module.")
 
+def store_instances_on_peer(instance_ids, priority=0):
+    """
+    Starts one asynchronous orthanc job uploading instance_ids to the peer.
+
+    :param priority: priority of the orthanc job, higher runs first
+    :returns: ID of the orthanc job
+    """
+    body = json.dumps({"Resources": instance_ids, "Asynchronous": True, "Priority": priority})
+    config.LOGGER.debug(f"Uploading {len(instance_ids)} instances to peer {config.PEER_NAME}")
+    result = orthanc.RestApiPost(f"/peers/{config.PEER_NAME}/store", body)
+    result_dict = json.loads(result.decode())
+    config.LOGGER.debug(f"Orthanc job with ID {result_dict['ID']} started.")
+    return result_dict["ID"]
+
+def get_job_state(job_id):
+    """
+    :returns: state of orthanc job job_id ("Pending", "Running", "Success", "Failure", ...),
+              None if orthanc does not know the job (anymore)
+    """
+    try:
+        job_dict = json.loads(orthanc.RestApiGet(f"/jobs/{job_id}").decode())
+    except Exception:
+        #depending on the plugin version, unknown jobs raise ValueError or orthanc.OrthancException
+        return None
+    return job_dict.get("State")
+
+def get_instances_on_peer(instance_ids):
+    """
+    Returns the IDs among instance_ids the peer already holds. Candidates are taken from the
+    presence summary of the peer and, since bloom filters have false positives, confirmed
+    with one request per series listing the instances the peer holds of it.
+    """
+    peer_summary = PRESENCE_SUMMARIES.get(config.PEER_NAME)
+    if peer_summary is None:
+        return []
+    candidate_ids_by_series = {}
+    for instance_id in instance_ids:
+        if instance_id not in peer_summary:
+            continue
+        try:
+            instance_dict = json.loads(orthanc.RestApiGet(f"/instances/{instance_id}").decode())
+        except Exception:
+            #deleted in the meantime, depending on the plugin version ValueError or orthanc.OrthancException
+            continue
+        candidate_ids_by_series.setdefault(instance_dict["ParentSeries"], []).append(instance_id)
+    present_instance_ids = []
+    for series_id, candidate_ids in candidate_ids_by_series.items():
+        try:
+            series_dict, _ = PEER_CIRCUIT_BREAKER.call(helpers.get_data, f"{config.PEER_URI}/series/{series_id}",
+                                                       session=PEER_CIRCUIT_BREAKER.session)
+        except requests.RequestException:
+            continue
+        peer_instance_ids = set(series_dict.get("Instances", []))
+        present_instance_ids.extend(instance_id for instance_id in candidate_ids if instance_id in peer_instance_ids)
+    return present_instance_ids
+
+def publish_presence_summary(summary):
+    helpers.send_over_unix_socket({"type": "presence_summary", "content": summary})
+
+def push_instances_to_peer(instance_ids):
+    """
+    Queue instances the peer is missing for replication, behind everything of recent days.
+    """
+    for instance_id in instance_ids:
+        PEER_REPLICATION.put(instance_id, priority=ReplicationScheduler.PRIORITY_BACKFILL)
+
+def get_instance_and_study(instance_id):
+    """
+    Returns the orthanc resource dicts of an instance and of its study.
+    """
+    instance_dict = json.loads(orthanc.RestApiGet(f"/instances/{instance_id}").decode())
+    study_dict = json.loads(orthanc.RestApiGet(f"/instances/{instance_id}/study").decode())
+    return instance_dict, study_dict
+
+def look_up_new_instance(instance_id):
+    """
+    Drops cached queries and resources a new instance changes and returns its replication
+    priority and size. Called by the replication lookup worker, off the change callback thread.
+    """
+    instance_dict, study_dict = get_instance_and_study(instance_id)
+    changed_resource_ids = {instance_id, instance_dict["ParentSeries"], study_dict["ID"], study_dict["ParentPatient"]}
+    if len(OrthancQueryEngine.remote_cache):
+        OrthancQueryEngine.remote_cache.invalidate(changed_resource_ids)
+        #queries whose cached answer lacks the new resource, series tags are unknown and match anything
+        OrthancQueryEngine.remote_cache.invalidateMatching({**study_dict.get("PatientMainDicomTags", {}),
+                                                            **study_dict["MainDicomTags"],
+                                                            **instance_dict.get("MainDicomTags", {})})
+    if len(OrthancHost.resource_cache):
+        OrthancHost.resource_cache.invalidate(changed_resource_ids)
+    priority = PEER_REPLICATION.scheduler.getPriority(study_dict["MainDicomTags"].get("StudyDate"))
+    return priority, instance_dict.get("FileSize", 0)
+
+def start_anti_entropy_run():
+    ANTI_ENTROPY.requestRun()
+
+LOCAL_PRESENCE_INDEX = PresenceIndex(OrthancHost(f"http://localhost:{config.LOCAL_HTTP_PORT}",
+                                                 http_user=config.LOCAL_HTTP_USER,
+                                                 http_password=config.LOCAL_HTTP_PASSWORD))
+#only the parent publishes its summary, sites keep the one of their parent
+PRESENCE_SUMMARIES = PresenceSummaries(LOCAL_PRESENCE_INDEX, publish_presence_summary)
+
+if config.PARENT_NAME:
+    PEER_REPLICATION = ReplicationSender(ReplicationJournal(), store_instances_on_peer, get_job_state,
+                                         scheduler=ReplicationScheduler(),
+                                         presence_function=get_instances_on_peer,
+                                         lookup_function=look_up_new_instance)
+    PEER_CIRCUIT_BREAKER = CircuitBreaker(config.PEER_NAME, f"{config.PEER_URI}/system",
+                                          session=helpers.get_session(config.PEER_URI,
+                                                                      config.PEER_HTTP_USER,
+                                                                      config.PEER_HTTP_PASSWORD),
+                                          on_close=start_anti_entropy_run)
+    PEER_PREFETCHER = WorklistPrefetcher(PrefetchJournal(),
+                                         OrthancHost(f"http://localhost:{config.LOCAL_HTTP_PORT}",
+                                                     http_user=config.LOCAL_HTTP_USER,
+                                                     http_password=config.LOCAL_HTTP_PASSWORD),
+                                         OrthancHost(config.PEER_URI,
+                                                     http_user=config.PEER_HTTP_USER,
+                                                     http_password=config.PEER_HTTP_PASSWORD,
+                                                     circuit_breaker=PEER_CIRCUIT_BREAKER),
+                                         presence_index=LOCAL_PRESENCE_INDEX,
+                                         replication_journal=PEER_REPLICATION.journal,
+                                         presence_function=get_instances_on_peer)
+    ANTI_ENTROPY = AntiEntropySync(LOCAL_PRESENCE_INDEX, PEER_PREFETCHER.remote_orthanc, push_instances_to_peer,
+                                   StudyPrefetcher(PEER_PREFETCHER.local_orthanc,
+                                                   PEER_PREFETCHER.remote_orthanc).fetchInstances)
+else:
+    WORKLIST_INDEX = WorklistIndex()
+
 def enhance_query(output, uri_path, **kwargs):
     config.LOGGER.debug(f"{uri_path} called with body: {kwargs['body']}")
     local_orthanc = OrthancHost(f"http://localhost:{config.LOCAL_HTTP_PORT}",
@@ -20,7 +160,8 @@ def enhance_query(output, uri_path, **kwargs):
                             http_password=config.LOCAL_HTTP_PASSWORD)
     remote_orthanc = OrthancHost(config.PEER_URI,
                              http_user=config.PEER_HTTP_USER,
-                             http_password=config.PEER_HTTP_PASSWORD)
+                             http_password=config.PEER_HTTP_PASSWORD,
+                             circuit_breaker=PEER_CIRCUIT_BREAKER)
 
     request_body_dict = local_orthanc.getDictFromRequestBody(kwargs["body"])
     config.LOGGER.debug(f"Request body decoded to: {request_body_dict}")
@@ -28,72 +169,318 @@ def enhance_query(output, uri_path, **kwargs):
     find_level = OrthancHost.getQueryRetrieveLevel(request_body_dict)
     find_query = OrthancHost.collateFindQuery(request_body_dict)
 
-    #Search for resources via Orthanc API (remote), store all resources found in list
-    try:
-        remote_resources = []
-        remote_orthanc_resources_found = remote_orthanc.findResources(find_query, find_level)
-    except (requests.ConnectTimeout, requests.ConnectionError):
-        config.LOGGER.error(f"Failed to connect to {remote_orthanc.url} to query for resources.")
+    query_engine = OrthancQueryEngine(local_orthanc, remote_orthanc)
+    #serialize every dicom dict as soon as it arrives instead of dumping the whole list at once,
+    #the parts are joined once into the body AnswerBuffer needs
+    serialized_dicom_dicts = [json.dumps(dicom_dict).encode()
+                              for dicom_dict in query_engine.iterFindQuery(find_query, find_level)]
+    dicom_list_as_json = b"[" + b",".join(serialized_dicom_dicts) + b"]"
+    config.LOGGER.debug(f"Returning list of {len(serialized_dicom_dicts)} dicom dicts to caller.")
+
+    if output is not None:
+        output.AnswerBuffer(dicom_list_as_json, 'application/json')
+
+def get_modality_for_aet(aet):
+    """
+    Returns the name of the orthanc modality with AET aet, None if none is configured.
+    """
+    modalities = json.loads(orthanc.RestApiGet("/modalities?expand").decode())
+    for modality_name, modality in modalities.items():
+        if modality.get("AET") == aet:
+            return modality_name
+    return None
+
+def wait_for_jobs(job_ids, poll_interval=config.MOVE_POLL_INTERVAL):
+    """
+    Blocks until none of the orthanc jobs job_ids is pending or running anymore.
+
+    :returns: dict of the IDs of jobs that did not succeed and their state
+    """
+    failed_jobs = {}
+    pending_job_ids = list(job_ids)
+    while pending_job_ids:
+        job_states = {job_id: get_job_state(job_id) for job_id in pending_job_ids}
+        pending_job_ids = [job_id for job_id, state in job_states.items() if state in ("Pending", "Running")]
+        failed_jobs.update((job_id, state) for job_id, state in job_states.items()
+                           if state not in ("Pending", "Running", "Success"))
+        if pending_job_ids:
+            time.sleep(poll_interval)
+    return failed_jobs
+
+def run_c_move(prefetcher, resources, target_modality):
+    """
+    Fetches whatever is missing locally of resources from the peer and sends every series
+    to target_modality by its own asynchronous store job as soon as it is complete, then
+    waits for the store jobs.
+
+    :raises RuntimeError: an instance could not be fetched or a store job did not succeed
+    """
+    job_ids = []
+    def send_series(series_id):
+        body = json.dumps({"Resources": [series_id], "Asynchronous": True})
+        result = orthanc.RestApiPost(f"/modalities/{target_modality}/store", body)
+        job_ids.append(json.loads(result.decode())["ID"])
+        config.LOGGER.debug(f"Sending series {series_id} to {target_modality}, job {job_ids[-1]}")
+
+    errors = []
+    fetched_count, missing_count = 0, 0
+    for resource in resources:
+        try:
+            result = prefetcher.prefetch(resource, on_series_complete=send_series)
+        except Exception as error:
+            errors.append(f"{resource['Type']} {resource['ID']}: {error}")
+            continue
+        PEER_PREFETCHER.recordMove(resource, result)
+        fetched_count += result["Fetched"]
+        missing_count += result["Missing"]
+        if result["Failed"]:
+            errors.append(f"{resource['Type']} {resource['ID']}: failed to fetch {len(result['Failed'])} instances")
+    failed_jobs = wait_for_jobs(job_ids)
+    errors.extend(f"store job {job_id} ended in state {state}" for job_id, state in failed_jobs.items())
+    config.LOGGER.info(f"C-MOVE to {target_modality}: fetched {fetched_count} of {missing_count} " + \
+                       f"missing instances, {len(job_ids) - len(failed_jobs)} of {len(job_ids)} store jobs succeeded.")
+    if errors:
+        raise RuntimeError(f"C-MOVE to {target_modality} failed: " + "; ".join(errors))
+
+def on_move(**move_request):
+    """
+    Serves a C-MOVE from the local orthanc, fetching whatever is missing locally from the peer first.
+    move_request holds the fields of the C-MOVE request (Level, PatientID, StudyInstanceUID,
+    SeriesInstanceUID, SOPInstanceUID, TargetAET, ...). Returns once everything is sent,
+    raising makes orthanc answer the C-MOVE with a failure.
+    """
+    config.LOGGER.debug(f"C-MOVE requested: {move_request}")
+    target_modality = get_modality_for_aet(move_request.get("TargetAET"))
+    if target_modality is None:
+        raise ValueError(f"C-MOVE target {move_request.get('TargetAET')} is not a configured modality")
+    prefetcher = StudyPrefetcher(PEER_PREFETCHER.local_orthanc, PEER_PREFETCHER.remote_orthanc,
+                                 presence_index=LOCAL_PRESENCE_INDEX)
+    resources = prefetcher.resolveResources(move_request)
+    if not resources:
+        raise ValueError(f"C-MOVE matched no resources: {move_request}")
+    run_c_move(prefetcher, resources, target_modality)
+
+def query_cache_worker(output, uri_path, **kwargs):
+    """
+    GET returns the counters of the remote query cache, the resource cache and the ETag cache,
+    DELETE empties them.
+    """
+    if kwargs["method"] == "GET":
+        statistics = OrthancQueryEngine.remote_cache.getStatistics()
+        statistics["Resources"] = OrthancHost.resource_cache.getStatistics()
+        statistics["ETags"] = OrthancHost.etag_cache.getStatistics()
+        output.AnswerBuffer(json.dumps(statistics), 'application/json')
+    elif kwargs["method"] == "DELETE":
+        OrthancQueryEngine.remote_cache.clear()
+        OrthancHost.resource_cache.clear()
+        OrthancHost.etag_cache.clear()
+        output.AnswerBuffer("{}", 'application/json')
     else:
-        for resource in remote_orthanc_resources_found:
-            resource_list = remote_orthanc.getSubresourcesOfOrthancResource(resource, find_level)
-            config.LOGGER.debug(f"Resources found for remote resource: {resource_list}")
-            remote_resources.extend(resource_list)
-
-    #Search for resources via Orthanc API (local), store all resources found in list
-    local_orthanc_resources_found = local_orthanc.findResources(find_query, find_level)
-    local_resources = []
-    for resource in local_orthanc_resources_found:
-        resource_list = local_orthanc.getSubresourcesOfOrthancResource(resource, find_level)
-        config.LOGGER.debug(f"Resources found for local resource: {resource_list}")
-        local_resources.extend(resource_list)
-
-
-    remote_ids = [OrthancHost.getIDOfResource(resource) for resource in remote_resources]
-    local_ids = [OrthancHost.getIDOfResource(resource) for resource in local_resources]
-    strictly_remote_ids = set(remote_ids) - set(local_ids)
-    strictly_local_ids = set(local_ids) - set(remote_ids)
-    intersecting_ids = set(local_ids) & set(remote_ids)
-    config.LOGGER.debug(f"Required resources not present on local orthanc are: {strictly_remote_ids}")
-    config.LOGGER.debug(f"Resources present on both local and remote ortanc are: {strictly_local_ids}")
-    config.LOGGER.debug(f"Resources present on both local and remote ortanc are: {intersecting_ids}")
-
-    #Collate dictionaries (numeric dicom tags / dicom values) for every resource found
-    dicom_list = []
-    try:
-        for resource_id in strictly_remote_ids:
-            resource = OrthancHost.getResourceByID(remote_resources, resource_id)
-            dicom_dict = remote_orthanc.getTagsAndValuesOfOrthancResource(resource_id, find_level)
-            dicom_list.append(OrthancHost.filterTagsOfDicomDict(dicom_dict, find_query, find_level))
-    except (requests.ConnectTimeout, requests.ConnectionError):
-        config.LOGGER.error(f"Failed to connect to {remote_orthanc.url} to get dicom data for instances.")
+        output.SendMethodNotAllowed("GET,DELETE")
 
-    for resource_id in strictly_local_ids | intersecting_ids:
-        resource = OrthancHost.getResourceByID(local_resources, resource_id)
-        dicom_dict = local_orthanc.getTagsAndValuesOfOrthancResource(resource_id, find_level)
-        dicom_list.append(OrthancHost.filterTagsOfDicomDict(dicom_dict, find_query, find_level))
+def peer_status_worker(output, uri_path, **kwargs):
+    """
+    GET returns the state of the circuit breaker guarding the peer orthanc.
+    """
+    if kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(PEER_CIRCUIT_BREAKER.getStatus()), 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET")
 
-    dicom_list_as_json = json.dumps(dicom_list)
-    config.LOGGER.debug(f"Returning list of dicom dicts to caller: {dicom_list_as_json}")
+def replication_worker(output, uri_path, **kwargs):
+    """
+    GET returns the queued and running uploads to the peer, flush latency, rate limit and journal contents.
+    """
+    if kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(PEER_REPLICATION.getStatistics()), 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET")
 
-    if output is not None:
-        output.AnswerBuffer(dicom_list_as_json, 'application/json')
+def transfer_statistics_worker(output, uri_path, **kwargs):
+    """
+    GET returns the number of instances and bytes fetched from the peer, the bytes saved by compression
+    and the numbers of failed fetches and of uploads rejected by the local orthanc.
+    """
+    if kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(OrthancHost.getTransferStatistics()), 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET")
+
+def prefetch_worker(output, uri_path, **kwargs):
+    """
+    POST queues the prior studies of a scheduled patient for prefetching, the body contains
+    PatientID, ScheduledProcedureStepStartDate and ScheduledProcedureStepStartTime.
+    GET returns disk usage, evictions and hit rate of the prefetched studies.
+    """
+    if kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(PEER_PREFETCHER.getStatistics()), 'application/json')
+    elif kwargs["method"] == "POST":
+        try:
+            prefetch_request = json.loads(kwargs["body"].decode())
+            if not isinstance(prefetch_request, dict):
+                raise ValueError("expected a json object")
+        except ValueError as error:
+            message = f"Malformed prefetch request: {error}"
+            output.SendHttpStatus(400, message, len(message))
+            return
+        patient_id = prefetch_request.get("PatientID")
+        if not patient_id:
+            message = "PatientID missing"
+            output.SendHttpStatus(400, message, len(message))
+            return
+        scheduled_time = WorklistPrefetcher.getScheduledTime(prefetch_request.get("ScheduledProcedureStepStartDate"),
+                                                             prefetch_request.get("ScheduledProcedureStepStartTime"))
+        PEER_PREFETCHER.put(patient_id, scheduled_time)
+        output.AnswerBuffer("{}", 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET,POST")
+
+def presence_index_worker(output, uri_path, **kwargs):
+    """
+    GET returns the number of indexed local resources and the last processed change.
+    """
+    if kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(LOCAL_PRESENCE_INDEX.getStatistics()), 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET")
 
-def enhance_c_move():
-    pass
+def presence_summary_worker(output, uri_path, **kwargs):
+    """
+    POST stores the presence summary of a peer, as relayed by the websocket process.
+    GET returns size and age of the local summary and of those received from peers.
+    """
+    if kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(PRESENCE_SUMMARIES.getStatistics()), 'application/json')
+    elif kwargs["method"] == "POST":
+        summary = json.loads(kwargs["body"].decode())
+        try:
+            PRESENCE_SUMMARIES.put(summary["Name"], summary["Filter"])
+        except (KeyError, ValueError) as error:
+            message = f"Invalid presence summary: {error}"
+            output.SendHttpStatus(400, message, len(message))
+            return
+        output.AnswerBuffer("{}", 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET,POST")
+
+def digest_worker(output, uri_path, **kwargs):
+    """
+    GET returns the root of the digest tree of the local presence index, POST with body
+    {"IDs": [...]} the digests of these resources and of their children (null if not held).
+    Resources listed in the optional "ChildIDs": {ID: [child IDs]} of the body get their digest
+    over these children only, so a site holding part of a resource can compare its own digest.
+    """
+    if not LOCAL_PRESENCE_INDEX.is_ready:
+        message = "Presence index is not built yet"
+        output.SendHttpStatus(503, message, len(message))
+    elif kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(LOCAL_PRESENCE_INDEX.getDigestNode()), 'application/json')
+    elif kwargs["method"] == "POST":
+        request_dict = json.loads(kwargs["body"].decode())
+        child_ids = request_dict.get("ChildIDs", {})
+        digest_nodes = {resource_id: LOCAL_PRESENCE_INDEX.getDigestNode(resource_id, child_ids.get(resource_id))
+                        for resource_id in request_dict.get("IDs", [])}
+        output.AnswerBuffer(json.dumps(digest_nodes), 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET,POST")
+
+def anti_entropy_worker(output, uri_path, **kwargs):
+    """
+    GET returns the result of the last comparison with the peer, POST starts one now.
+    """
+    if kwargs["method"] == "GET":
+        output.AnswerBuffer(json.dumps(ANTI_ENTROPY.getStatistics()), 'application/json')
+    elif kwargs["method"] == "POST":
+        ANTI_ENTROPY.requestRun()
+        output.AnswerBuffer("{}", 'application/json')
+    else:
+        output.SendMethodNotAllowed("GET,POST")
+
+def on_parent_change(changeType, level, resource):
+    if changeType == orthanc.ChangeType.ORTHANC_STARTED:
+        LOCAL_PRESENCE_INDEX.start()
+        PRESENCE_SUMMARIES.start()
+        WORKLIST_INDEX.start()
 
 def on_change(changeType, level, resource):    
     if changeType == orthanc.ChangeType.NEW_INSTANCE:
-        body = json.dumps({"Resources": [resource], "Asynchronous": True})
-        config.LOGGER.debug(f"Change Callback started, type: {changeType}, body: {body}")
-        config.LOGGER.debug(f"Uploading instance {resource} to peer {config.PEER_NAME}")
-        result = orthanc.RestApiPost(f"/peers/{config.PEER_NAME}/store", body)
-        result_dict = json.loads(result.decode())
-        config.LOGGER.debug(f"Orthanc job with ID {result_dict['ID']} started.")
+        if StudyPrefetcher.takeFetched(resource):
+            #came from the peer, nothing to replicate
+            return
+        config.LOGGER.debug(f"Change Callback started, type: {changeType}, queueing instance {resource}")
+        #priority and size are looked up by the replication worker
+        PEER_REPLICATION.put(resource)
+    if changeType == orthanc.ChangeType.STABLE_SERIES:
+        PEER_REPLICATION.store_queue.requestFlush()
+        if len(OrthancHost.resource_cache):
+            #also covers instances fetched from the peer, which skip the invalidation above.
+            #the study is taken from the presence index, which indexed the series when it was new
+            OrthancHost.resource_cache.invalidate({resource, LOCAL_PRESENCE_INDEX.getParentID(resource)} - {None})
+    if changeType == orthanc.ChangeType.DELETED:
+        if len(OrthancHost.resource_cache):
+            OrthancHost.resource_cache.invalidate({resource})
     if changeType == orthanc.ChangeType.ORTHANC_STARTED:
-        pass
+        PEER_REPLICATION.resume()
+        LOCAL_PRESENCE_INDEX.start()
+        ANTI_ENTROPY.start()
     if changeType == orthanc.ChangeType.ORTHANC_STOPPED:
-        pass
+        PEER_REPLICATION.store_queue.requestFlush()
+
+def answer_with_etag(output, body: str, request_headers: dict, mime_type='application/json'):
+    """
+    Answer body with an ETag derived from its content, or with "304 Not Modified"
+    if the caller already holds it (If-None-Match), sparing the transfer over the WAN.
+    """
+    etag = f'"{hashlib.sha1(body.encode()).hexdigest()}"'
+    if request_headers.get("if-none-match") == etag:
+        output.SendHttpStatusCode(304)
+        return
+    output.SetHttpHeader("ETag", etag)
+    output.AnswerBuffer(body, mime_type)
+
+def delete_worklists(output, body: bytes):
+    """
+    Bulk deletion, body {"IDs": [...]} and/or {"OlderThan": "YYYYMMDD"} selecting
+    the worklists to delete by ID and/or by creation before that date.
+    """
+    try:
+        request_dict = json.loads(body.decode())
+        worklist_ids = request_dict.get("IDs", [])
+        if not isinstance(worklist_ids, list) or not all(isinstance(worklist_id, str) for worklist_id in worklist_ids):
+            raise TypeError("IDs must be a list of strings")
+        created_before = None
+        if request_dict.get("OlderThan"):
+            created_before = time.mktime(time.strptime(request_dict["OlderThan"], "%Y%m%d"))
+    except (ValueError, AttributeError, TypeError) as error:
+        message = f"Invalid bulk delete request: {error}"
+        output.SendHttpStatus(400, message, len(message))
+        return
+    result = Worklist().http_delete_many(worklist_ids, created_before=created_before)
+    for worklist_id in result["Deleted"] + result["Missing"]:
+        WORKLIST_INDEX.discard(worklist_id)
+    output.AnswerBuffer(json.dumps(result), 'application/json')
+
+def import_worklists(output, body: bytes):
+    """
+    Bulk import, body is a JSON array or NDJSON of worklists as accepted by POST /worklists.
+    Answers {"Imported": n, "Failed": n, "Results": [{"Index": i, "ID": ...} or {"Index": i, "Error": ...}]},
+    the sites are told about all new worklists by a single message.
+    """
+    try:
+        items = Worklist.parse_json_items(body)
+    except UnicodeDecodeError as error:
+        message = f"Invalid bulk import request: {error}"
+        output.SendHttpStatus(400, message, len(message))
+        return
+    results, stored_worklists = Worklist.create_worklists_from_json_list(items)
+    for worklist in stored_worklists:
+        WORKLIST_INDEX.put(worklist.filename, worklist.pydicom_dataset)
+    worklist_ids = [result["ID"] for result in results if "ID" in result]
+    if worklist_ids:
+        helpers.send_over_unix_socket({"type": "new_worklists", "content": {"ids": worklist_ids}})
+    output.AnswerBuffer(json.dumps({"Imported": len(worklist_ids),
+                                    "Failed": len(results) - len(worklist_ids),
+                                    "Results": results}), 'application/json')
 
 def worklist_worker(output, uri_path, **kwargs):
     """
@@ -104,22 +491,34 @@ def worklist_worker(output, uri_path, **kwargs):
     """
     config.LOGGER.debug(f"worklist_worker called with kwargs: {kwargs}")
     if kwargs["method"] == "GET":
-        myworklist = Worklist()
         if len(kwargs['groups']) == 1:
             worklist_id = kwargs['groups'][0]
-            if len(worklist_id) == 40:
-                worklists = myworklist.create_available_worklists_response_dict(replace_tags_with_keywords=True,
-                                                                                hashed_code=worklist_id)
-            else:
+            if len(worklist_id) != 40:
                 message = f"Invalid worklist ID {worklist_id}"
                 output.SendHttpStatus(400, message, len(message))
+                return
+            worklists = WORKLIST_INDEX.getResponse(worklist_id)
+            if worklists is None:
+                message = f"Unknown worklist ID {worklist_id}"
+                output.SendHttpStatus(404, message, len(message))
+                return
+        elif kwargs.get("get", {}).get("ids"):
+            #bulk fetch of the worklists announced by a new_worklists message
+            worklists = WORKLIST_INDEX.getResponseForIDs(kwargs["get"]["ids"].split(","))
         else:
-            worklists = myworklist.create_available_worklists_response_dict()
-        output.AnswerBuffer(str(worklists), 'application/json')
+            worklists = WORKLIST_INDEX.getResponse()
+        answer_with_etag(output, worklists, kwargs.get("headers", {}))
         
+    elif kwargs["method"] == "POST" and len(kwargs['groups']) == 1 and kwargs['groups'][0] == "delete":
+        delete_worklists(output, kwargs["body"])
+
+    elif kwargs["method"] == "POST" and len(kwargs['groups']) == 1 and kwargs['groups'][0] == "bulk":
+        import_worklists(output, kwargs["body"])
+
     elif kwargs["method"] == "POST":
         myworklist = Worklist(json=kwargs["body"])
         response_dict = myworklist.create_worklist_from_json(myworklist.json)
+        WORKLIST_INDEX.put(myworklist.filename, myworklist.pydicom_dataset)
         helpers.send_over_unix_socket({"type": "new_worklist", "content": {"id": response_dict["id"]}})
         output.AnswerBuffer(str(response_dict), 'application/json')
 
@@ -136,14 +535,28 @@ def worklist_worker(output, uri_path, **kwargs):
         except FileNotFoundError as error:
             output.SendHttpStatus(400, f"{error}", len(str(error)))
             return
+        finally:
+            WORKLIST_INDEX.discard(hashed_id_of_worklist)
         output.AnswerBuffer("{}", 'application/json')
 
 
 if "orthanc" in sys.modules:
     Worklist.create_worklists_directory()
+    Worklist.synchronize_journal()
+    orthanc.RegisterRestCallback('/curapacs/presence', presence_index_worker)
+    orthanc.RegisterRestCallback('/curapacs/summaries', presence_summary_worker)
+    orthanc.RegisterRestCallback('/curapacs/digests', digest_worker)
     if config.PARENT_NAME:
         orthanc.RegisterRestCallback('/enhancequery', enhance_query)
+        orthanc.RegisterRestCallback('/curapacs/cache', query_cache_worker)
+        orthanc.RegisterRestCallback('/curapacs/peer', peer_status_worker)
+        orthanc.RegisterRestCallback('/curapacs/replication', replication_worker)
+        orthanc.RegisterRestCallback('/curapacs/transfers', transfer_statistics_worker)
+        orthanc.RegisterRestCallback('/curapacs/prefetch', prefetch_worker)
+        orthanc.RegisterRestCallback('/curapacs/antientropy', anti_entropy_worker)
         orthanc.RegisterOnChangeCallback(on_change)
+        orthanc.RegisterMoveCallback(on_move)
     else:
         orthanc.RegisterRestCallback('/worklists', worklist_worker)
         orthanc.RegisterRestCallback('/worklists/(.*)', worklist_worker)
+        orthanc.RegisterOnChangeCallback(on_parent_change)
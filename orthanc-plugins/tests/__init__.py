@@ -0,0 +1,16 @@
+"""
+Unit tests of curapacs_python, run outside of orthanc from the orthanc-plugins directory:
+
+    python -m unittest discover -s tests -t .
+
+curapacs_python.config reads the orthanc configuration at import time, so the orthanc module
+is replaced by a stub answering a minimal configuration.
+"""
+import sys
+import json
+import types
+
+orthanc_stub = types.ModuleType("orthanc")
+orthanc_stub.GetConfiguration = lambda: json.dumps({"RegisteredUsers": {"orthanc": "orthanc"},
+                                                     "Curapacs": {"LOG_LEVEL": "WARNING"}})
+sys.modules.setdefault("orthanc", orthanc_stub)
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+from curapacs_python.PresenceIndex import PresenceIndex
+from curapacs_python.AntiEntropySync import AntiEntropySync
+
+
+class StubRemoteOrthanc:
+    """
+    Serves /curapacs/digests from a PresenceIndex, as digest_worker does.
+    """
+    url = "http://parent"
+
+    def __init__(self, presence_index):
+        self.presence_index = presence_index
+        self.requests = []
+
+    def requestData(self, request_function, url, body):
+        self.requests.append(body)
+        child_ids = body.get("ChildIDs", {})
+        return {resource_id: self.presence_index.getDigestNode(resource_id, child_ids.get(resource_id))
+                for resource_id in body["IDs"]}, {}
+
+
+class TestAntiEntropySync(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.site_index = self.createIndex("site", [("p1", "patient", None), ("st1", "study", "p1"),
+                                                    ("se1", "series", "st1"), ("i1", "instance", "se1")])
+        # the parent holds the data of other sites too
+        self.parent_index = self.createIndex("parent", [("p1", "patient", None), ("st1", "study", "p1"),
+                                                        ("se1", "series", "st1"), ("i1", "instance", "se1"),
+                                                        ("st2", "study", "p1"), ("se2", "series", "st2"),
+                                                        ("i2", "instance", "se2"), ("p2", "patient", None)])
+        self.remote_orthanc = StubRemoteOrthanc(self.parent_index)
+        self.pushed_ids = []
+        self.pulled_ids = []
+        self.sync = AntiEntropySync(self.site_index, self.remote_orthanc, self.pushed_ids.extend, self.pull)
+
+    def tearDown(self):
+        self.site_index._connection.close()
+        self.parent_index._connection.close()
+        shutil.rmtree(self.directory)
+
+    def createIndex(self, name, resources):
+        presence_index = PresenceIndex(None, path=os.path.join(self.directory, f"{name}.sqlite"))
+        presence_index.executeTransaction([("INSERT INTO resources (id, level, parent) VALUES (?, ?, ?)", resource)
+                                           for resource in resources], last_sequence=0)
+        return presence_index
+
+    def pull(self, instance_ids):
+        self.pulled_ids.extend(instance_ids)
+        return []
+
+    def test_partial_copy_of_parent_matches(self):
+        result = self.sync.synchronize()
+        self.assertEqual((result["Compared"], result["Differing"]), (1, 0))
+        self.assertEqual((self.pushed_ids, self.pulled_ids), ([], []))
+
+    def test_missing_remote_instance_is_pushed(self):
+        self.site_index.executeTransaction([("INSERT INTO resources (id, level, parent) VALUES ('i3', 'instance', 'se1')", ()),
+                                            PresenceIndex.getInvalidateStatement("i3")])
+        result = self.sync.synchronize()
+        self.assertEqual(self.pushed_ids, ["i3"])
+        self.assertEqual(result["Pushed"], 1)
+
+    def test_missing_local_instance_of_shared_series_is_pulled(self):
+        self.parent_index.executeTransaction([("INSERT INTO resources (id, level, parent) VALUES ('i4', 'instance', 'se1')", ()),
+                                              PresenceIndex.getInvalidateStatement("i4")])
+        self.sync.synchronize()
+        self.assertEqual(self.pulled_ids, ["i4"])
+        self.assertEqual(self.pushed_ids, [])
+
+    def test_child_ids_are_sent_above_series_level(self):
+        self.site_index.executeTransaction([("INSERT INTO resources (id, level, parent) VALUES ('i3', 'instance', 'se1')", ()),
+                                            PresenceIndex.getInvalidateStatement("i3")])
+        self.sync.synchronize()
+        self.assertEqual(self.remote_orthanc.requests[0]["ChildIDs"], {"p1": ["st1"]})
+        self.assertEqual(self.remote_orthanc.requests[-1]["ChildIDs"], {})
+
+
+if __name__ == "__main__":
+    unittest.main()
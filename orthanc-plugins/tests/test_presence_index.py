@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+from curapacs_python.PresenceIndex import PresenceIndex
+
+
+class StubOrthancHost:
+    """
+    Answers the requests of PresenceIndex from a dict of url path -> answer.
+    """
+    url = "http://orthanc"
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.requested_paths = []
+
+    def requestData(self, request_function, url, *args, **kwargs):
+        path = url[len(self.url):]
+        self.requested_paths.append(path)
+        return self.answers[path], {}
+
+
+class TestPresenceIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.orthanc_host = StubOrthancHost({
+            "/changes?last": {"Last": 10, "Changes": [], "Done": True},
+            "/patients?expand&since=0&limit=10": [{"ID": "p1", "MainDicomTags": {"PatientID": "4711"}}],
+            "/studies?expand&since=0&limit=10": [{"ID": "st1", "ParentPatient": "p1",
+                                                  "MainDicomTags": {"StudyInstanceUID": "1.1"}}],
+            "/series?expand&since=0&limit=10": [{"ID": "se1", "ParentStudy": "st1",
+                                                 "MainDicomTags": {"SeriesInstanceUID": "1.1.1"}}],
+            "/instances?expand&since=0&limit=10": [{"ID": "i1", "ParentSeries": "se1",
+                                                    "MainDicomTags": {"SOPInstanceUID": "1.1.1.1"}}],
+        })
+        self.index = PresenceIndex(self.orthanc_host, path=os.path.join(self.directory, "presence.sqlite"),
+                                   page_size=10)
+        self.index.build()
+
+    def tearDown(self):
+        self.index._connection.close()
+        shutil.rmtree(self.directory)
+
+    def getStoredDigest(self, resource_id):
+        return self.index.execute("SELECT digest FROM resources WHERE id = ?", (resource_id,))[0][0]
+
+    def test_build(self):
+        self.assertTrue(self.index.is_ready)
+        self.assertEqual(self.index.last_sequence, 10)
+        self.assertTrue(self.index.containsUID("1.1.1.1", "instance"))
+        self.assertEqual(self.index.getSeriesIDs({"Type": "Patient", "ID": "p1"}), ["se1"])
+
+    def test_update_applies_changes(self):
+        self.orthanc_host.answers.update({
+            "/changes?since=10&limit=10": {"Last": 14, "Done": True, "Changes": [
+                {"ChangeType": "NewSeries", "ID": "se2", "Path": "/series/se2"},
+                {"ChangeType": "NewInstance", "ID": "i2", "Path": "/instances/i2"},
+                {"ChangeType": "StableSeries", "ID": "se2", "Path": "/series/se2"},
+                {"ChangeType": "Deleted", "ID": "i1", "Path": "/instances/i1"}]},
+            "/series/se2": {"ID": "se2", "ParentStudy": "st1", "MainDicomTags": {"SeriesInstanceUID": "1.1.2"}},
+            "/series/se2/instances": [{"ID": "i2", "ParentSeries": "se2",
+                                       "MainDicomTags": {"SOPInstanceUID": "1.1.2.1"}}],
+        })
+        self.assertEqual(self.index.update(), 4)
+        self.assertEqual(self.index.last_sequence, 14)
+        self.assertFalse(self.index.contains("i1"))
+        self.assertTrue(self.index.containsUID("1.1.2.1", "instance"))
+        self.assertEqual(self.index.getParentID("i2"), "se2")
+        self.assertEqual(sorted(self.index.getSeriesIDs({"Type": "Study", "ID": "st1"})), ["se1", "se2"])
+
+    def test_invalidate_statement_resets_ancestors(self):
+        for resource_id in ["p1", "st1", "se1"]:
+            self.index.getDigest(resource_id)
+            self.assertIsNotNone(self.getStoredDigest(resource_id))
+        self.index.executeTransaction([PresenceIndex.getInvalidateStatement("i1")])
+        for resource_id in ["p1", "st1", "se1"]:
+            self.assertIsNone(self.getStoredDigest(resource_id))
+
+    def test_digest_changes_with_subtree(self):
+        digest = self.index.getDigest("p1")
+        self.assertEqual(self.index.getDigest("p1"), digest)
+        self.index.executeTransaction([("INSERT INTO resources (id, level, parent) VALUES ('i2', 'instance', 'se1')", ()),
+                                       PresenceIndex.getInvalidateStatement("i2")])
+        self.assertNotEqual(self.index.getDigest("p1"), digest)
+        self.assertEqual(self.index.getDigestNode("se1")["Children"].keys(), {"i1", "i2"})
+
+    def test_stale_digest_is_not_stored(self):
+        get_child_digests = self.index.getChildDigests
+
+        def getChildDigestsDuringChange(resource_id=None):
+            child_digests = get_child_digests(resource_id)
+            # a change is applied while the digest of resource_id is computed
+            self.index.executeTransaction([])
+            return child_digests
+
+        self.index.getChildDigests = getChildDigestsDuringChange
+        self.assertIsNotNone(self.index.getDigest("se1"))
+        self.assertIsNone(self.getStoredDigest("se1"))
+        self.index.getChildDigests = get_child_digests
+        self.index.getDigest("se1")
+        self.assertIsNotNone(self.getStoredDigest("se1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+from unittest import mock
+from curapacs_python.PresenceSummary import BloomFilter, PresenceSummaries
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        items = [f"instance-{index}" for index in range(1000)]
+        for item in items:
+            bloom_filter.add(item)
+        self.assertTrue(all(item in bloom_filter for item in items))
+        self.assertEqual(bloom_filter.count, 1000)
+
+    def test_false_positive_rate(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        for index in range(1000):
+            bloom_filter.add(f"instance-{index}")
+        false_positives = sum(f"other-{index}" in bloom_filter for index in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+
+    def test_dict_round_trip(self):
+        bloom_filter = BloomFilter(capacity=100)
+        bloom_filter.add("p1")
+        received_filter = BloomFilter.fromDict(bloom_filter.toDict())
+        self.assertIn("p1", received_filter)
+        self.assertNotIn("p2", received_filter)
+        self.assertEqual((received_filter.bit_count, received_filter.hash_count, received_filter.count),
+                         (bloom_filter.bit_count, bloom_filter.hash_count, 1))
+
+    def test_from_dict_rejects_truncated_bits(self):
+        filter_dict = BloomFilter(capacity=100).toDict()
+        filter_dict["BitCount"] *= 2
+        with self.assertRaises(ValueError):
+            BloomFilter.fromDict(filter_dict)
+
+
+class StubPresenceIndex:
+    is_ready = True
+
+    def __init__(self, resource_ids):
+        self.resource_ids = resource_ids
+
+    def getStatistics(self):
+        return {"Resources": len(self.resource_ids)}
+
+    def iterResourceIDs(self):
+        return iter(self.resource_ids)
+
+
+class TestPresenceSummaries(unittest.TestCase):
+    def runOnce(self, summaries):
+        with mock.patch("curapacs_python.PresenceSummary.time.sleep", side_effect=StopIteration):
+            with self.assertRaises(StopIteration):
+                summaries.run()
+
+    def test_publishes_local_summary(self):
+        published = []
+        summaries = PresenceSummaries(StubPresenceIndex(["p1", "st1"]), published.append)
+        self.runOnce(summaries)
+        self.assertEqual(len(published), 1)
+        self.assertIn("st1", BloomFilter.fromDict(published[0]["Filter"]))
+
+    def test_oversized_summary_is_not_published(self):
+        published = []
+        summaries = PresenceSummaries(StubPresenceIndex(["p1", "st1"]), published.append, max_message_size=100)
+        with self.assertLogs(level="ERROR"):
+            self.runOnce(summaries)
+        self.assertEqual(published, [])
+        self.assertIsNotNone(summaries.local_summary)
+
+    def test_put_and_get(self):
+        bloom_filter = BloomFilter(capacity=10)
+        bloom_filter.add("i1")
+        summaries = PresenceSummaries()
+        summaries.put("parent", bloom_filter.toDict())
+        self.assertIn("i1", summaries.get("parent"))
+        self.assertIsNone(summaries.get("other"))
+
+
+if __name__ == "__main__":
+    unittest.main()
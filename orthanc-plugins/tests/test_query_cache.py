@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+from curapacs_python.QueryCache import QueryCache
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = QueryCache(max_size=2, ttl=60)
+
+    def test_equivalent_queries_share_key(self):
+        self.assertEqual(QueryCache.getKey("study", {"PatientName": " Doe* ", "StudyDate": "*"}),
+                         QueryCache.getKey("study", {"StudyDate": "", "PatientName": "Doe*"}))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.cache.put("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual((self.cache.get("a"), self.cache.get("c")), (1, 3))
+        self.assertEqual(self.cache.getStatistics()["Evictions"], 1)
+
+    def test_entry_expires(self):
+        with mock.patch("curapacs_python.QueryCache.time.monotonic", return_value=1000):
+            self.cache.put("a", 1)
+        with mock.patch("curapacs_python.QueryCache.time.monotonic", return_value=1061):
+            self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_disabled_cache_stores_nothing(self):
+        cache = QueryCache(max_size=0, ttl=60)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_invalidate_by_resource_id(self):
+        resources = [{"ID": "st1", "ParentPatient": "p1"}]
+        self.cache.put("a", resources, QueryCache.getResourceIDs(resources))
+        self.cache.put("b", [], {"st2"})
+        self.assertEqual(self.cache.invalidate({"p1"}), 1)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), [])
+
+    def test_matches_value(self):
+        self.assertTrue(QueryCache.matchesValue("doe*", "DOE^JOHN"))
+        self.assertTrue(QueryCache.matchesValue("20240101-20241231", "20240615"))
+        self.assertTrue(QueryCache.matchesValue("1.2\\1.3", "1.3"))
+        self.assertTrue(QueryCache.matchesValue("", "anything"))
+        self.assertFalse(QueryCache.matchesValue("smith*", "DOE^JOHN"))
+        self.assertFalse(QueryCache.matchesValue("-20231231", "20240615"))
+
+    def test_invalidate_matching(self):
+        self.cache.put(QueryCache.getKey("study", {"PatientName": "Doe*"}), [])
+        self.cache.put(QueryCache.getKey("study", {"PatientName": "Smith*"}), [])
+        self.assertEqual(self.cache.invalidateMatching({"PatientName": "DOE^JOHN", "StudyDate": "20240615"}), 1)
+        self.assertIsNone(self.cache.get(QueryCache.getKey("study", {"PatientName": "Doe*"})))
+        self.assertEqual(self.cache.get(QueryCache.getKey("study", {"PatientName": "Smith*"})), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from curapacs_python.ResourceCache import ResourceCache
+
+
+def getStableSeries(series_id, instance_ids=()):
+    return {"ID": series_id, "Type": "Series", "IsStable": True, "ParentStudy": "st1",
+            "Instances": list(instance_ids)}
+
+
+class TestResourceCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResourceCache(max_size=2, ttl=60, spill_path=os.path.join(self.directory, "spill.sqlite"),
+                                   spill_size=2)
+
+    def tearDown(self):
+        self.cache._connection.close()
+        shutil.rmtree(self.directory)
+
+    def getKey(self, resource_id):
+        return ResourceCache.getKey("http://orthanc", "series", resource_id)
+
+    def test_only_final_resources_are_cached(self):
+        self.assertFalse(self.cache.put(self.getKey("se1"), {"ID": "se1", "Type": "Series", "IsStable": False}))
+        self.assertTrue(self.cache.put(self.getKey("se1"), getStableSeries("se1")))
+        self.assertTrue(self.cache.put(ResourceCache.getKey("http://orthanc", "instance", "i1"),
+                                       {"ID": "i1", "Type": "Instance"}))
+
+    def test_evicted_entries_are_spilled_and_promoted(self):
+        for series_id in ["se1", "se2", "se3"]:
+            self.cache.put(self.getKey(series_id), getStableSeries(series_id))
+        self.assertEqual(self.cache.getStatistics()["Spilled"], 1)
+        self.assertEqual(self.cache.get(self.getKey("se1")), getStableSeries("se1"))
+        statistics = self.cache.getStatistics()
+        self.assertEqual((statistics["SpillHits"], statistics["Spilled"]), (1, 1))
+        self.assertEqual(len(self.cache), 3)
+
+    def test_spill_file_is_bounded(self):
+        for series_id in ["se1", "se2", "se3", "se4", "se5"]:
+            self.cache.put(self.getKey(series_id), getStableSeries(series_id))
+        self.assertEqual(self.cache.getStatistics()["Spilled"], 2)
+        self.assertIsNone(self.cache.get(self.getKey("se1")))
+
+    def test_invalidate_drops_related_entries_in_memory_and_spilled(self):
+        self.cache.put(self.getKey("se1"), getStableSeries("se1", ["i1"]))
+        self.cache.put(self.getKey("se2"), getStableSeries("se2", ["i2"]))
+        self.cache.put(self.getKey("se3"), getStableSeries("se3", ["i3"]))
+        self.assertEqual(self.cache.invalidate({"i1", "i3"}), 2)
+        self.assertIsNone(self.cache.get(self.getKey("se1")))
+        self.assertIsNone(self.cache.get(self.getKey("se3")))
+        self.assertEqual(self.cache.get(self.getKey("se2")), getStableSeries("se2", ["i2"]))
+        self.assertEqual(self.cache.invalidate({"st1"}), 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_entry_with_zero_ttl_is_not_stored(self):
+        self.assertFalse(self.cache.put(self.getKey("se1"), getStableSeries("se1"), ttl=0))
+        self.assertIsNone(self.cache.get(self.getKey("se1")))
+
+
+if __name__ == "__main__":
+    unittest.main()
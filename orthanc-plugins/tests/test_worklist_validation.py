@@ -0,0 +1,49 @@
+import copy
+import unittest
+from curapacs_python.OrthancMWLCreator import Worklist
+
+
+SAMPLE_WORKLIST = {"PatientID": "4711", "PatientName": "Doe^John", "PatientBirthDate": "19700101",
+                   "PatientSex": "M", "AccessionNumber": "A1234", "RequestedProcedureDescription": "CT Thorax",
+                   "ScheduledProcedureStepSequence": [{"Modality": "CT", "ScheduledStationAETitle": "CT01",
+                                                       "ScheduledProcedureStepStartDate": "20240101",
+                                                       "ScheduledProcedureStepStartTime": "083000",
+                                                       "ScheduledPerformingPhysicianName": "Smith^Anna"}]}
+
+
+class TestValidateMany(unittest.TestCase):
+    def test_valid_worklists(self):
+        self.assertEqual(Worklist.validate_many([SAMPLE_WORKLIST, copy.deepcopy(SAMPLE_WORKLIST)]), [None, None])
+
+    def test_errors_are_reported_per_item(self):
+        missing_tag = copy.deepcopy(SAMPLE_WORKLIST)
+        del missing_tag["ScheduledProcedureStepSequence"][0]["ScheduledPerformingPhysicianName"]
+        wrong_type = copy.deepcopy(SAMPLE_WORKLIST)
+        wrong_type["PatientName"] = 4711
+        errors = Worklist.validate_many([missing_tag, SAMPLE_WORKLIST, wrong_type, ["not", "an", "object"]])
+        self.assertIsInstance(errors[0], KeyError)
+        self.assertIsNone(errors[1])
+        self.assertIsInstance(errors[2], TypeError)
+        self.assertIsInstance(errors[3], TypeError)
+
+    def test_matches_validate(self):
+        wrong_type = copy.deepcopy(SAMPLE_WORKLIST)
+        wrong_type["PatientName"] = 4711
+        for item in [SAMPLE_WORKLIST, wrong_type]:
+            try:
+                Worklist().validate(item)
+                expected_error = None
+            except (TypeError, ValueError, KeyError) as error:
+                expected_error = type(error)
+            error, = Worklist.validate_many([item])
+            self.assertEqual(type(error) if error is not None else None, expected_error)
+
+    def test_malformed_ndjson_line(self):
+        items = Worklist.parse_json_items(b'{"PatientID": "1"}\n{broken\n')
+        self.assertEqual(items[0], {"PatientID": "1"})
+        errors = Worklist.validate_many(items)
+        self.assertIsInstance(errors[1], ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()